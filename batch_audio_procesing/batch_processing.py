@@ -2,15 +2,15 @@ import os
 import re
 import json
 import asyncio
+import threading
 import time
-import random
 import mimetypes
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, AsyncIterator, List, Optional, Tuple
 from asyncio import Semaphore
 
 from google.cloud import bigquery, storage
 from vertexai import init
-from vertexai.generative_models import GenerativeModel, Part
+from vertexai.generative_models import GenerativeModel, GenerationConfig, Part
 from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
 from tenacity import (
@@ -20,6 +20,22 @@ from tenacity import (
     retry_if_exception_type,
     RetryError,
 )
+import metrics
+import usage
+import call_schema
+import fingerprint
+import customer_ids
+import identity_index
+import transcript_index
+import call_vectors
+import replica
+import transcript_store
+import model_scheduler
+import model_router
+import durations
+import two_phase
+import rollups
+from metrics import track, record_retry, FAILURES, BYTES_PROCESSED
 
 load_dotenv()
 
@@ -28,20 +44,91 @@ BIGQUERY_DATASET = # your BigQuery Dataset name
 BIGQUERY_TABLE = # your BigQuery Table name
 GEMINI_MODEL = "gemini-2.5-flash"
 GCS_BUCKET = os.getenv("GCS_BUCKET", "your-gcs-bucket-name")
-MAX_CONCURRENT_TASKS = 10
+MAX_CONCURRENT_TASKS = int(os.getenv("MAX_CONCURRENT_TASKS", "10"))
+AUDIO_BACKEND = os.getenv("AUDIO_BACKEND", "gcp")  # "gcp" or "fake" (offline stand-ins from fake_backends.py)
+ANALYSIS_ENGINE = os.getenv("ANALYSIS_ENGINE", "gemini")  # "gemini" (audio → Gemini) or "stt" (Speech-to-Text, then Gemini on the transcript)
+ANALYSIS_BATCHING = os.getenv("ANALYSIS_BATCHING", "0") == "1"  # stt engine: pack many transcripts into one Gemini request
+GEMINI_RETRY_MIN_WAIT = float(os.getenv("GEMINI_RETRY_MIN_WAIT", "5"))
+GEMINI_RETRY_MAX_WAIT = float(os.getenv("GEMINI_RETRY_MAX_WAIT", "60"))
+METRICS_SUMMARY_PATH = os.getenv("METRICS_SUMMARY_PATH")  # optional JSON file written at the end of a run
+CALL_ANALYSIS_SCHEMA = call_schema.response_schema()  # constrains Gemini output to CallAnalysis
+TRANSCRIPT_ANALYSIS_SCHEMA = call_schema.response_schema(exclude=("full_transcript",))  # STT engine: transcript comes from STT
+BIGQUERY_USAGE_TABLE = os.getenv("BIGQUERY_USAGE_TABLE", f"{BIGQUERY_TABLE}_token_usage")  # per-file token usage side table
+BIGQUERY_ROLLUP_TABLE = os.getenv("BIGQUERY_ROLLUP_TABLE", f"{BIGQUERY_TABLE}_daily_rollup")  # call counts per day and category
+BATCH_MODE = os.getenv("BATCH_MODE", "online")  # "online" (one request per file) or "bulk" (Vertex AI batch prediction job)
+BULK_JOB_RUNNER = os.getenv("BULK_JOB_RUNNER", "local" if AUDIO_BACKEND == "fake" else "vertex")
+BULK_OUTPUT_PREFIX = os.getenv("BULK_OUTPUT_PREFIX", f"gs://{GCS_BUCKET}/bulk_prediction")
+INSERT_CHUNK_ROWS = int(os.getenv("INSERT_CHUNK_ROWS", "500"))  # rows per BigQuery load while results stream in
+GCS_PREFIX = os.getenv("GCS_PREFIX", "batch_audio/")  # sub folder in GCS Bucket containing the audio files already uploaded
+AUDIO_EXTENSIONS = tuple(ext.strip().lower() for ext in os.getenv("AUDIO_EXTENSIONS", ".wav,.mp3").split(",") if ext.strip())
+MIN_AUDIO_BYTES = int(os.getenv("MIN_AUDIO_BYTES", "1"))
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "1000"))
+LIST_SUB_PREFIXES = os.getenv("LIST_SUB_PREFIXES", "")  # "auto" (each first-level folder) or e.g. "0,1,2,...,f" under GCS_PREFIX
+LIST_PARALLELISM = int(os.getenv("LIST_PARALLELISM", "8"))
+BULK_ONLINE_FALLBACK = os.getenv("BULK_ONLINE_FALLBACK", "1") == "1"  # re-run failed bulk lines with online calls
+
+UNIFIED_PROMPT = """
+    You are an expert call analyst. Listen to the call very very carefully and understand each and every words and numbers of the audio.
+    1️⃣ Transcribe this customer care call for Airtel.
+    2️⃣ Label speakers (Customer, Support).
+    3️⃣ Correct grammar errors.
+    4️⃣ Extract strictly in JSON:
+    {
+        "phone_number": 
+    "Extract the phone number if mentioned in the call. 
+     • If the number is exactly 10 digits → output only the 10 digits. 
+     • If the number contains 7–9 digits → output those digits only (do NOT output null). 
+     • If no number is spoken at all → output: \"Missing phone number\"",
+        "problem_solved": "Solved/Pending",
+        "problem_type": "Payment/Network/Recharge",
+        "sentiment": - "Provide a short summary of the customer's emotional tone throughout the entire call, indicating how it started, how it progressed, and how it ended in maximum 20 words.",
+        "full_transcript": "entire conversation text"
+    }
+    """
 
 try:
-    bigquery_client = bigquery.Client(project=BIGQUERY_PROJECT_ID)
-    storage_client = storage.Client()
-    init(project=BIGQUERY_PROJECT_ID, location="us-central1")
-    gemini_model = GenerativeModel(GEMINI_MODEL)
-    print("✅ Clients initialized successfully.")
+    if AUDIO_BACKEND == "fake":
+        from fake_backends import build_fake_clients
+        bigquery_client, storage_client, gemini_model = build_fake_clients(GEMINI_MODEL)
+    else:
+        bigquery_client = bigquery.Client(project=BIGQUERY_PROJECT_ID)
+        storage_client = storage.Client()
+        init(project=BIGQUERY_PROJECT_ID, location="us-central1")
+        gemini_model = GenerativeModel(GEMINI_MODEL)
+    if ANALYSIS_ENGINE == "stt":
+        from stt_async import AsyncTranscriber, STT_MAX_IN_FLIGHT
+        if AUDIO_BACKEND == "fake":
+            from fake_backends import FakeSpeechClient
+            speech_client = FakeSpeechClient()
+        else:
+            from google.cloud import speech_v1p1beta1 as speech
+            speech_client = speech.SpeechClient()
+        stt_transcriber = AsyncTranscriber(speech_client)
+    analysis_batcher = None
+    print(f"✅ Clients initialized successfully ({AUDIO_BACKEND} backend, {ANALYSIS_ENGINE} engine).")
 except Exception as e:
     print(f"❌ Error initializing clients: {e}")
     raise SystemExit(1)
 
+ANALYSIS_FIELDS = ("phone_number", "full_transcript", "problem_solved", "problem_type", "sentiment")
+_fingerprint_waiters: Dict[int, asyncio.Future] = {}  # fingerprint id → analysis of a file still being processed
+_fingerprint_lock = asyncio.Lock()  # makes an index lookup and its waiter registration atomic
+
 def generate_customer_id() -> int:
-    return random.randint(10000, 99999)
+    return customer_ids.next_customer_id()
+
+def assign_customer_id(phone_number: str) -> int:
+    """Repeat callers keep the customer_id first assigned to their phone number."""
+    return identity_index.get_index().customer_id_for(phone_number, generate_customer_id)
+
+def sync_identity_index():
+    table_id = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}"
+    try:
+        with track("identity_sync"):
+            added = identity_index.get_index().sync_from_bigquery(bigquery_client, table_id)
+        print(f"🪪 Identity index synced: {added} new phone numbers ({len(identity_index.get_index())} known).")
+    except Exception as e:
+        print(f"⚠️ Could not sync identity index from BigQuery: {e}")
 
 def clean_phone_number(phone: str) -> str:
     if not phone:
@@ -63,41 +150,68 @@ def clean_phone_number(phone: str) -> str:
     return "Missing phone number"
 
 def safe_json_parse(text: str) -> dict:
-    text = text.strip()
-    match = re.search(r"json(.*?)```", text, re.DOTALL | re.IGNORECASE)
-    if match:
-        text = match.group(1).strip()
-    text = text.replace("```", "").strip()
-    try:
-        return json.loads(text)
-    except json.JSONDecodeError:
+    parsed = call_schema.repair_json(text)
+    if parsed is None:
+        text = text.strip()
         print(f"⚠️ Failed to parse JSON, returning raw text. Content: {text[:200]}...")
         return {"raw_text": text}
+    return parsed
 
-async def insert_batch_to_bigquery(rows: List[Dict[str, Any]]):
+async def insert_batch_to_bigquery(rows: List[Dict[str, Any]]) -> bool:
+    """Loads the rows and updates the local indexes, side tables and rollups.
+    Returns False only if the rows did not reach the table (errors are printed, not raised)."""
     if not rows:
         print("ℹ️ No rows to insert.")
-        return
+        return True
     table_id = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}"
-    schema = [
+    schema = two_phase.table_schema(transcript_store.table_schema([
         bigquery.SchemaField("customer_id", "INTEGER"),
         bigquery.SchemaField("phone_number", "STRING"),
         bigquery.SchemaField("full_transcript", "STRING"),
         bigquery.SchemaField("problem_solved", "STRING"),
         bigquery.SchemaField("problem_type", "STRING"),
         bigquery.SchemaField("sentiment", "STRING"),
+    ]))
+    duplicates = sum(1 for row in rows if row.get("duplicate_of"))
+    if duplicates:
+        # Near-duplicates reuse the customer_id of the recording they matched; they never get a row of their own
+        print(f"♻️ Skipping {duplicates} near-duplicate rows.")
+        rows = [row for row in rows if not row.get("duplicate_of")]
+        if not rows:
+            return True
+    job_config = bigquery.LoadJobConfig(schema=schema, schema_update_options=two_phase.schema_update_options())
+    table_rows = [{field.name: row.get(field.name) for field in schema} for row in rows]
+    usage_rows = [
+        usage.usage_row(row["token_usage"], row["customer_id"], row.get("source_uri", ""))
+        for row in rows
+        if row.get("token_usage")
     ]
-    job_config = bigquery.LoadJobConfig(schema=schema)
+    loaded = False
     try:
+        if transcript_store.enabled():
+            with track("transcript_offload"):
+                table_rows = await asyncio.to_thread(transcript_store.offload_rows, storage_client, table_rows)
         print(f"📦 Inserting {len(rows)} rows into BigQuery...")
-        job = bigquery_client.load_table_from_json(rows, table_id, job_config=job_config)
-        await asyncio.to_thread(job.result)
+        with track("bigquery_load"):
+            job = bigquery_client.load_table_from_json(table_rows, table_id, job_config=job_config)
+            await asyncio.to_thread(job.result)
+        BYTES_PROCESSED.inc(sum(len(json.dumps(row)) for row in table_rows), stage="bigquery_load")
         if job.errors:
+            FAILURES.inc(stage="bigquery_load", error_class="JobErrors")
             print(f"❌ BigQuery job finished with errors: {job.errors}")
         else:
+            loaded = True
             print(f"✅ Successfully inserted {len(rows)} rows.")
+            await asyncio.to_thread(transcript_index.index_rows, rows)
+            await asyncio.to_thread(call_vectors.index_rows, rows)
+            await asyncio.to_thread(replica.append_rows, table_rows)
+            usage_table_id = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_USAGE_TABLE}"
+            await asyncio.to_thread(usage.insert_usage_rows, bigquery_client, usage_table_id, usage_rows)
+            rollup_table_id = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_ROLLUP_TABLE}"
+            await asyncio.to_thread(rollups.record_rows, bigquery_client, rollup_table_id, rows)
     except Exception as e:
         print(f"❌ Failed to insert batch into BigQuery: {e}")
+    return loaded
 
 RETRYABLE_EXCEPTIONS = (
     RetryError,
@@ -107,116 +221,575 @@ RETRYABLE_EXCEPTIONS = (
 )
 
 @retry(
-    wait=wait_exponential(multiplier=2, min=5, max=60),
+    wait=wait_exponential(multiplier=2, min=GEMINI_RETRY_MIN_WAIT, max=GEMINI_RETRY_MAX_WAIT),
     stop=stop_after_attempt(5),
     retry=retry_if_exception_type(RETRYABLE_EXCEPTIONS),
+    before_sleep=record_retry("gemini_call"),
 )
-async def call_gemini_async(audio_part: Part, prompt: str) -> str:
-    response = await gemini_model.generate_content_async(
-        [audio_part, prompt],
-        generation_config={
-            "temperature": 1,
-            "max_output_tokens": 8192,
-            "response_mime_type": "application/json",
-        },
-    )
-    return response.text.strip()
+async def call_gemini_async(
+    audio_part: Optional[Part],
+    prompt: str,
+    response_schema: Dict[str, Any] = CALL_ANALYSIS_SCHEMA,
+    max_output_tokens: int = 8192,
+    model_name: str = GEMINI_MODEL,
+) -> Tuple[str, Dict[str, Any]]:
+    usage.ledger.check_budget()
+    await model_scheduler.admit_async(model_scheduler.BATCH)
+    contents = [audio_part, prompt] if audio_part is not None else [prompt]
+    model = model_router.get_model(model_name, GEMINI_MODEL, gemini_model)
+    with track("gemini_call"):
+        response = await model.generate_content_async(
+            contents,
+            generation_config=GenerationConfig(
+                temperature=1,
+                max_output_tokens=max_output_tokens,
+                response_mime_type="application/json",
+                response_schema=response_schema,
+            ),
+        )
+    BYTES_PROCESSED.inc(len(response.text), stage="gemini_call")
+    token_usage = usage.record_response(response, model_name, "call_gemini_async")
+    return response.text.strip(), token_usage
+
+async def audio_size(gcs_uri: str) -> Optional[int]:
+    """Object size in bytes (one metadata request), used to route long recordings to a stronger model."""
+    try:
+        bucket_name, blob_name = gcs_uri[len("gs://"):].split("/", 1)
+        blob = storage_client.bucket(bucket_name).blob(blob_name)
+        await asyncio.to_thread(blob.reload)
+        return blob.size
+    except Exception as e:
+        print(f"⚠️ Could not read the size of {gcs_uri}: {e}")
+        return None
+
+def get_analysis_batcher():
+    """Lazily creates the micro-batcher that packs concurrent STT transcripts into one request."""
+    global analysis_batcher
+    if analysis_batcher is None:
+        from transcript_batching import BatchedAnalyzer
+        async def generate(prompt: str, schema: Dict[str, Any], max_output_tokens: int):
+            return await call_gemini_async(None, prompt, schema, max_output_tokens)
+        analysis_batcher = BatchedAnalyzer(generate)
+    return analysis_batcher
+
+def build_row(text: str, gcs_uri: str, token_usage: Optional[Dict[str, Any]], transcript: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Normalizes one model response into a BigQuery row, or returns None if it is unusable."""
+    with track("json_parse"):
+        parsed = safe_json_parse(text)
+    if transcript is not None and "raw_text" not in parsed:
+        parsed["full_transcript"] = transcript
+    if "raw_text" in parsed:
+        FAILURES.inc(stage="json_parse", error_class="InvalidJSON")
+        print(f"❌ Failed to parse JSON for {gcs_uri}. Skipping.")
+        return None
+    parsed, validation_error = call_schema.validate_call_analysis(parsed)
+    if validation_error:
+        FAILURES.inc(stage="json_parse", error_class="ValidationError")
+        print(f"❌ Invalid analysis for {gcs_uri}: {validation_error}. Skipping.")
+        return None
+    def get_string_value(data: dict, key: str) -> str:
+        value = data.get(key)
+        if value is None:
+            return ""
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return str(value)
+    phone_number = clean_phone_number(get_string_value(parsed, "phone_number"))
+    return {
+        "customer_id": assign_customer_id(phone_number),
+        "phone_number": phone_number,
+        "full_transcript": get_string_value(parsed, "full_transcript"),
+        "problem_solved": get_string_value(parsed, "problem_solved"),
+        "problem_type": get_string_value(parsed, "problem_type"),
+        "sentiment": get_string_value(parsed, "sentiment"),
+        "source_uri": gcs_uri,
+        "token_usage": token_usage,
+    }
+
+async def check_duplicate(gcs_uri: str, wait_for_in_flight: bool = True) -> Tuple[Optional[Dict[str, Any]], Optional[int]]:
+    """Fingerprints the recording before any model call.
+
+    Returns (row reusing the earlier analysis, None) for a near-duplicate. Otherwise returns
+    (None, fingerprint id to attach this file's analysis to), where the id is None if the audio
+    could not be fingerprinted. A copy of a file that is still being analyzed in this run waits
+    for that analysis, unless `wait_for_in_flight` is False.
+    """
+    if not fingerprint.FINGERPRINT_DEDUP:
+        return None, None
+    try:
+        with track("fingerprint"):
+            bucket_name, blob_name = gcs_uri[len("gs://"):].split("/", 1)
+            data = await asyncio.to_thread(storage_client.bucket(bucket_name).blob(blob_name).download_as_bytes)
+            fp = await asyncio.to_thread(fingerprint.fingerprint_audio, data, blob_name)
+        BYTES_PROCESSED.inc(len(data), stage="fingerprint")
+        if fp is None:
+            return None, None
+        index = fingerprint.get_index()
+        async with _fingerprint_lock:
+            # The SQLite lookup runs off the event loop; the lock keeps other files from registering in between
+            match, recording_id = await asyncio.to_thread(index.find_or_add, fp, gcs_uri)
+            waiter = None
+            if match is not None and match.analysis is None:
+                waiter = _fingerprint_waiters.get(recording_id)
+                if waiter is None:
+                    # Left pending by an earlier run or a failed attempt: analyze it now and attach the result
+                    match = None
+            if match is None:
+                _fingerprint_waiters[recording_id] = asyncio.get_running_loop().create_future()
+                return None, recording_id
+    except Exception as e:
+        FAILURES.inc(stage="fingerprint", error_class=type(e).__name__)
+        print(f"⚠️ Fingerprinting failed for {gcs_uri}, analyzing without dedup: {e}")
+        return None, None
+    analysis, customer_id = match.analysis, match.customer_id
+    if waiter is not None:
+        if wait_for_in_flight:
+            analysis = await asyncio.shield(waiter)
+            if analysis is None:
+                return None, None
+            customer_id = analysis["customer_id"]
+        else:
+            analysis = {}
+    await asyncio.to_thread(index.link, recording_id, gcs_uri, fp.duration_s)
+    print(f"♻️ {gcs_uri} is a near-duplicate of {match.source_uri} (score {match.score}, {match.ratio:.0%}); reusing its analysis.")
+    row = {field: analysis.get(field, "") for field in ANALYSIS_FIELDS}
+    row.update({"customer_id": customer_id, "source_uri": gcs_uri, "duplicate_of": match.source_uri, "token_usage": None})
+    return row, None
+
+def resolve_fingerprint(recording_id: Optional[int], row: Optional[Dict[str, Any]]):
+    """Stores the analysis of a fingerprinted file and wakes up copies waiting for it."""
+    if recording_id is None:
+        return
+    waiter = _fingerprint_waiters.pop(recording_id, None)
+    analysis = None
+    if row is not None:
+        analysis = {field: row[field] for field in ANALYSIS_FIELDS}
+        fingerprint.get_index().attach_analysis(recording_id, analysis, row["customer_id"])
+        analysis["customer_id"] = row["customer_id"]
+    if waiter is not None and not waiter.done():
+        waiter.set_result(analysis)
 
 async def process_audio_file(gcs_uri: str) -> Optional[Dict[str, Any]]:
     mime_type, _ = mimetypes.guess_type(gcs_uri)
     mime_type = mime_type or "audio/wav"
     print(f"\n🎧 Processing {gcs_uri} ...")
     start_time = time.time()
-    unified_prompt = """
-    You are an expert call analyst. Listen to the call very very carefully and understand each and every words and numbers of the audio.
-    1️⃣ Transcribe this customer care call for Airtel.
-    2️⃣ Label speakers (Customer, Support).
-    3️⃣ Correct grammar errors.
-    4️⃣ Extract strictly in JSON:
-    {
-        "phone_number": 
-    "Extract the phone number if mentioned in the call. 
-     • If the number is exactly 10 digits → output only the 10 digits. 
-     • If the number contains 7–9 digits → output those digits only (do NOT output null). 
-     • If no number is spoken at all → output: \"Missing phone number\"",
-        "problem_solved": "Solved/Pending",
-        "problem_type": "Payment/Network/Recharge",
-        "sentiment": - "Provide a short summary of the customer's emotional tone throughout the entire call, indicating how it started, how it progressed, and how it ended in maximum 20 words.",
-        "full_transcript": "entire conversation text"
-    }
-    """
+    fingerprint_id = None
+    row_data = None
     try:
-        audio_part = Part.from_uri(gcs_uri, mime_type=mime_type)
-        text = await call_gemini_async(audio_part, unified_prompt)
-        parsed = safe_json_parse(text)
-        if "raw_text" in parsed:
-            print(f"❌ Failed to parse JSON for {gcs_uri}. Skipping.")
+        duplicate, fingerprint_id = await check_duplicate(gcs_uri)
+        if duplicate is not None:
+            return duplicate
+        with track("process_audio_file"):
+            if ANALYSIS_ENGINE == "stt":
+                with track("stt_transcribe"):
+                    transcript = await stt_transcriber.transcribe(gcs_uri)
+            if ANALYSIS_ENGINE == "stt" and ANALYSIS_BATCHING:
+                analysis = await get_analysis_batcher().analyze(gcs_uri, transcript)
+                token_usage = analysis.pop("token_usage", None)
+                text = json.dumps(analysis)
+            elif ANALYSIS_ENGINE == "stt":
+                transcript_prompt = f"""
+    You are an expert call analyst for Airtel customer care. The transcript below was produced by
+    Speech-to-Text with speakers labeled Support and Customer; if another company is mentioned, treat it as Airtel.
+    TRANSCRIPT:
+    ---
+    {transcript}
+    ---
+    Extract strictly in JSON: phone_number (10 digits, or the 7–9 digits heard, or "Missing phone number"),
+    problem_solved (Solved/Pending), problem_type (Payment/Network/Recharge) and sentiment
+    (the customer's emotional tone from start to end in maximum 20 words).
+    """
+                text, token_usage, _ = await model_router.run_async(
+                    "call_gemini_async",
+                    model_router.plan(GEMINI_MODEL, transcript_chars=len(transcript)),
+                    lambda model_name: call_gemini_async(None, transcript_prompt, TRANSCRIPT_ANALYSIS_SCHEMA, model_name=model_name),
+                    lambda text: model_router.check_call_analysis(text, clean_phone_number, exclude=("full_transcript",)),
+                )
+            elif two_phase.enabled():
+                # Phase one: the four small fields only; complete_transcripts fills the transcript in later
+                audio_part = Part.from_uri(gcs_uri, mime_type=mime_type)
+                text, token_usage, _ = await model_router.run_async(
+                    "call_gemini_async",
+                    model_router.plan(GEMINI_MODEL),
+                    lambda model_name: call_gemini_async(
+                        audio_part, two_phase.FIELDS_PROMPT, two_phase.FIELDS_SCHEMA, two_phase.FIELDS_MAX_OUTPUT_TOKENS, model_name),
+                    lambda text: model_router.check_call_analysis(text, clean_phone_number, exclude=("full_transcript",)),
+                )
+                transcript = ""
+            else:
+                audio_part = Part.from_uri(gcs_uri, mime_type=mime_type)
+                models = model_router.tiers(GEMINI_MODEL)
+                if len(models) > 1:
+                    models = model_router.plan(GEMINI_MODEL, audio_bytes=await audio_size(gcs_uri))
+                text, token_usage, _ = await model_router.run_async(
+                    "call_gemini_async",
+                    models,
+                    lambda model_name: call_gemini_async(audio_part, UNIFIED_PROMPT, model_name=model_name),
+                    lambda text: model_router.check_call_analysis(text, clean_phone_number, require_transcript=True),
+                )
+            row_data = build_row(text, gcs_uri, token_usage, transcript if ANALYSIS_ENGINE == "stt" or two_phase.enabled() else None)
+            if row_data is not None and two_phase.enabled() and ANALYSIS_ENGINE != "stt":
+                row_data["transcript_status"] = two_phase.PENDING
+        if row_data is None:
             return None
-        customer_id = generate_customer_id()
-        def get_string_value(data: dict, key: str) -> str:
-            value = data.get(key)
-            if value is None:
-                return ""
-            if isinstance(value, (dict, list)):
-                return json.dumps(value)
-            return str(value)
-        row_data = {
-            "customer_id": customer_id,
-            "phone_number": clean_phone_number(get_string_value(parsed, "phone_number")),
-            "full_transcript": get_string_value(parsed, "full_transcript"),
-            "problem_solved": get_string_value(parsed, "problem_solved"),
-            "problem_type": get_string_value(parsed, "problem_type"),
-            "sentiment": get_string_value(parsed, "sentiment")
-        }
         total_time = round(time.time() - start_time, 2)
         print(f"✅ Completed {gcs_uri} in {total_time}s")
         return row_data
     except Exception as e:
         print(f"❌ Error processing {gcs_uri}: {e}")
         return None
+    finally:
+        resolve_fingerprint(fingerprint_id, row_data)
+
+def awaiting_transcripts(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """TWO_PHASE: the key fields of loaded rows whose transcript phase two still has to produce."""
+    if not two_phase.enabled() or ANALYSIS_ENGINE == "stt":
+        return []
+    return [
+        {key: row.get(key) for key in ("customer_id", "source_uri", *two_phase.FIELD_NAMES)}
+        for row in rows if not row.get("duplicate_of")
+    ]
+
+
+async def complete_transcripts(rows: List[Dict[str, Any]]) -> int:
+    """Phase two of TWO_PHASE: transcribes the recordings behind the loaded phase-one rows and fills their
+    transcripts in, TRANSCRIPT_UPDATE_ROWS rows per UPDATE. Returns the number of transcripts stored."""
+    table_id = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}"
+    semaphore = Semaphore(MAX_CONCURRENT_TASKS)
+    updates: List[Dict[str, Any]] = []
+    finished: List[Dict[str, Any]] = []
+    stored = 0
+
+    async def flush():
+        nonlocal stored
+        batch, done = updates[:], finished[:]
+        updates.clear()
+        finished.clear()
+        if not batch:
+            return
+        try:
+            with track("transcript_update"):
+                written = await asyncio.to_thread(
+                    two_phase.update_transcripts, bigquery_client, storage_client, table_id, batch)
+        except Exception as e:
+            print(f"❌ Failed to store {len(batch)} transcripts: {e}")
+            return
+        stored += len(done)
+        await asyncio.to_thread(replica.update_rows, written)
+        await asyncio.to_thread(transcript_index.index_rows, done)
+        await asyncio.to_thread(call_vectors.index_rows, done)
+        usage_table_id = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_USAGE_TABLE}"
+        usage_rows = [usage.usage_row(row["token_usage"], row["customer_id"], row["source_uri"]) for row in done]
+        await asyncio.to_thread(usage.insert_usage_rows, bigquery_client, usage_table_id, usage_rows)
+
+    async def transcribe(row: Dict[str, Any]):
+        async with semaphore:
+            if usage.ledger.budget_exceeded:
+                return
+            uri = row["source_uri"]
+            mime_type = mimetypes.guess_type(uri)[0] or "audio/wav"
+            transcript, token_usage = None, None
+            try:
+                with track("transcript_phase"):
+                    text, token_usage = await call_gemini_async(
+                        Part.from_uri(uri, mime_type=mime_type), two_phase.TRANSCRIPT_PROMPT, two_phase.TRANSCRIPT_SCHEMA)
+                transcript = two_phase.parse_transcript(text)
+            except Exception as e:
+                print(f"❌ Transcript phase failed for {uri}: {e}")
+            updates.append({"source_uri": uri, "full_transcript": transcript,
+                            "transcript_status": two_phase.READY if transcript else two_phase.FAILED})
+            if transcript:
+                finished.append({**row, "full_transcript": transcript, "token_usage": token_usage})
+            if len(updates) >= two_phase.TRANSCRIPT_UPDATE_ROWS:
+                await flush()
+
+    print(f"\n📝 Transcribing {len(rows)} calls (phase two)...")
+    await asyncio.gather(*(transcribe(row) for row in rows))
+    await flush()
+    print(f"📝 Stored {stored} of {len(rows)} transcripts.")
+    return stored
+
+def is_audio_blob(blob) -> bool:
+    return blob.name.lower().endswith(AUDIO_EXTENSIONS) and (blob.size or 0) >= MIN_AUDIO_BYTES
+
+class _ListingStopped(Exception):
+    pass
+
+def _list_pages(bucket_name: str, prefix: str, emit, delimiter: Optional[str] = None) -> List[str]:
+    """Lists one prefix page by page, passing each page's audio URIs to `emit` (runs in a thread).
+    With a delimiter only the objects directly under `prefix` are listed and its sub-prefixes returned."""
+    blobs = storage_client.list_blobs(bucket_name, prefix=prefix, delimiter=delimiter, page_size=LIST_PAGE_SIZE)
+    pages = iter(blobs.pages)
+    while True:
+        with track("gcs_list"):
+            page = next(pages, None)
+            if page is None:
+                break
+            uris = []
+            for blob in page:
+                if is_audio_blob(blob):
+                    uris.append(f"gs://{bucket_name}/{blob.name}")
+                    BYTES_PROCESSED.inc(blob.size, stage="gcs_list")
+        emit(uris)
+    return sorted(blobs.prefixes) if delimiter else []
+
+async def iter_audio_files(bucket_name: str = GCS_BUCKET, prefix: str = GCS_PREFIX) -> AsyncIterator[List[str]]:
+    """Yields pages of gs:// audio URIs while the listing is still running.
 
-def list_audio_files_from_gcs(bucket_name: str, prefix: str = "batch_audio/") -> List[str]: # here batch_audio is the sub folder in GCS Bucket containing the audio files already uploaded
+    With LIST_SUB_PREFIXES the listing is split into disjoint sub-prefixes listed in parallel
+    (at most LIST_PARALLELISM at once). Only a few pages are buffered: a slow consumer pauses
+    the listing instead of letting it fill memory.
+    """
+    loop = asyncio.get_running_loop()
+    pages: asyncio.Queue = asyncio.Queue(maxsize=LIST_PARALLELISM * 2)
+    stop = threading.Event()
+
+    def emit(uris: List[str]):
+        if stop.is_set():
+            raise _ListingStopped()
+        if uris:
+            asyncio.run_coroutine_threadsafe(pages.put(uris), loop).result()
+
+    async def produce():
+        try:
+            if LIST_SUB_PREFIXES == "auto":
+                sub_prefixes = await asyncio.to_thread(_list_pages, bucket_name, prefix, emit, "/")
+            else:
+                sub_prefixes = [prefix + part.strip() for part in LIST_SUB_PREFIXES.split(",") if part.strip()] or [prefix]
+            limiter = Semaphore(LIST_PARALLELISM)
+            async def list_prefix(sub_prefix: str):
+                async with limiter:
+                    await asyncio.to_thread(_list_pages, bucket_name, sub_prefix, emit)
+            await asyncio.gather(*(list_prefix(sub_prefix) for sub_prefix in sub_prefixes))
+        except _ListingStopped:
+            pass
+        except Exception as e:
+            FAILURES.inc(stage="gcs_list", error_class=type(e).__name__)
+            print(f"❌ Error listing GCS files: {e}")
+        finally:
+            await pages.put(None)
+
+    producer = asyncio.create_task(produce())
     try:
-        bucket = storage_client.bucket(bucket_name)
-        blobs = bucket.list_blobs(prefix=prefix)
-        audio_files = [
-            f"gs://{bucket_name}/{blob.name}"
-            for blob in blobs
-            if blob.name.lower().endswith((".wav", ".mp3")) and blob.size > 0
-        ]
-        print(f"🎵 Found {len(audio_files)} audio files.")
-        return audio_files
+        while (page := await pages.get()) is not None:
+            yield page
+    finally:
+        # The consumer may stop early: unblock listing threads waiting on a full queue
+        stop.set()
+        while not producer.done():
+            while not pages.empty():
+                pages.get_nowait()
+            await asyncio.sleep(0.01)
+
+def list_audio_files_from_gcs(bucket_name: str, prefix: str = GCS_PREFIX) -> List[str]:
+    audio_files: List[str] = []
+    try:
+        _list_pages(bucket_name, prefix, audio_files.extend)
     except Exception as e:
         print(f"❌ Error listing GCS files: {e}")
         return []
+    print(f"🎵 Found {len(audio_files)} audio files.")
+    return audio_files
 
 async def process_with_limit(semaphore: Semaphore, uri: str):
     async with semaphore:
+        if usage.ledger.budget_exceeded:
+            return None
         return await process_audio_file(uri)
 
-async def main():
+async def main_bulk() -> Dict[str, Any]:
+    """Backfill mode: one Vertex AI batch prediction job instead of one online request per file."""
+    import bulk_prediction
     start_total = time.time()
+    await asyncio.to_thread(sync_identity_index)
     all_files = list_audio_files_from_gcs(GCS_BUCKET)
     if not all_files:
         print("❌ No audio files found in GCS.")
-        return
-    print(f"\n🚀 Starting async processing for {len(all_files)} files...")
-    semaphore = Semaphore(MAX_CONCURRENT_TASKS)
-    tasks = [asyncio.create_task(process_with_limit(semaphore, uri)) for uri in all_files]
-    results = await asyncio.gather(*tasks)
+        return {"total_files": 0, "successful": 0, "retry_successes": 0, "final_failed": 0}
+    if ANALYSIS_ENGINE == "stt":
+        print("ℹ️ Bulk mode analyzes audio with Gemini directly; ANALYSIS_ENGINE=stt is ignored.")
+    fingerprint_ids: Dict[str, int] = {}
+    duplicate_rows: List[Dict[str, Any]] = []
+    to_analyze = all_files
+    if fingerprint.FINGERPRINT_DEDUP:
+        semaphore = Semaphore(MAX_CONCURRENT_TASKS)
+        async def dedup(uri: str):
+            async with semaphore:
+                return await check_duplicate(uri, wait_for_in_flight=False)
+        checks = await asyncio.gather(*(dedup(uri) for uri in all_files))
+        to_analyze = []
+        for uri, (duplicate, fingerprint_id) in zip(all_files, checks):
+            if duplicate is not None:
+                duplicate_rows.append(duplicate)
+                continue
+            to_analyze.append(uri)
+            if fingerprint_id is not None:
+                fingerprint_ids[uri] = fingerprint_id
+        print(f"♻️ {len(duplicate_rows)} near-duplicates will not be sent to the model.")
+    run_prefix = f"{BULK_OUTPUT_PREFIX.rstrip('/')}/{time.strftime('%Y%m%d-%H%M%S')}"
+    manifest_uri = f"{run_prefix}/requests.jsonl"
+    generation_config = {
+        "temperature": 1,
+        "maxOutputTokens": 8192,
+        "responseMimeType": "application/json",
+        "responseSchema": CALL_ANALYSIS_SCHEMA,
+    }
+    with track("bulk_manifest"):
+        count = await asyncio.to_thread(
+            bulk_prediction.write_manifest, storage_client, to_analyze, manifest_uri, UNIFIED_PROMPT, generation_config
+        )
+    print(f"📝 Wrote {count} requests to {manifest_uri}")
+    if BULK_JOB_RUNNER == "local":
+        runner = bulk_prediction.LocalBatchJobRunner(storage_client, gemini_model)
+    else:
+        runner = bulk_prediction.VertexBatchJobRunner()
+    with track("bulk_job"):
+        job = await asyncio.to_thread(runner.submit, GEMINI_MODEL, manifest_uri, f"{run_prefix}/output")
+        print(f"🚀 Submitted batch prediction job {job.resource_name}")
+        job = await asyncio.to_thread(bulk_prediction.wait_for_job, job)
+    if not job.has_succeeded:
+        print(f"❌ Batch prediction job failed: {getattr(job, 'error', job.state)}")
+        for fingerprint_id in fingerprint_ids.values():
+            resolve_fingerprint(fingerprint_id, None)
+        return {"total_files": len(all_files), "successful": 0, "retry_successes": 0, "duplicates": len(duplicate_rows),
+                "final_failed": len(to_analyze), "job": job.resource_name, "job_state": str(job.state)}
+
+    pending = set(to_analyze)
+    chunk: List[Dict[str, Any]] = []
+    successful = 0
+    for record in bulk_prediction.iter_prediction_lines(storage_client, job.output_location):
+        gcs_uri, text, usage_metadata, error = bulk_prediction.parse_prediction(record)
+        token_usage = None
+        if usage_metadata:
+            token_usage = usage.extract_usage(
+                bulk_prediction.usage_metadata_object(usage_metadata), GEMINI_MODEL, "bulk_prediction"
+            )
+            token_usage["cost_usd"] = round(token_usage["cost_usd"] * bulk_prediction.BULK_PRICE_FACTOR, 8)
+            usage.ledger.record(token_usage)
+        if error:
+            FAILURES.inc(stage="bulk_job", error_class="PredictionError")
+            print(f"❌ Batch prediction failed for {gcs_uri}: {error}")
+            continue
+        row = build_row(text, gcs_uri, token_usage)
+        resolve_fingerprint(fingerprint_ids.pop(gcs_uri, None), row)
+        if row is None:
+            continue
+        pending.discard(gcs_uri)
+        chunk.append(row)
+        successful += 1
+        if len(chunk) >= INSERT_CHUNK_ROWS:
+            await insert_batch_to_bigquery(chunk)
+            chunk = []
+    await insert_batch_to_bigquery(chunk)
+
+    for fingerprint_id in fingerprint_ids.values():
+        resolve_fingerprint(fingerprint_id, None)
+    failed_uris = [uri for uri in to_analyze if uri in pending]
+    retry_success_rows: List[Dict[str, Any]] = []
+    if failed_uris and BULK_ONLINE_FALLBACK and not usage.ledger.budget_exceeded:
+        print(f"\n🔁 Re-running {len(failed_uris)} failed files with online requests...")
+        semaphore = Semaphore(MAX_CONCURRENT_TASKS)
+        results = await asyncio.gather(*(process_with_limit(semaphore, uri) for uri in failed_uris))
+        retry_success_rows = [row for row in results if row is not None]
+        await insert_batch_to_bigquery(retry_success_rows)
+    total_time = round((time.time() - start_total) / 60, 2)
+    run_summary = {
+        "mode": "bulk",
+        "job": job.resource_name,
+        "total_files": len(all_files),
+        "successful": successful,
+        "duplicates": len(duplicate_rows),
+        "retry_successes": len(retry_success_rows),
+        "final_failed": len(failed_uris) - len(retry_success_rows),
+        "total_minutes": total_time,
+        "token_usage": usage.ledger.summary(),
+        "metrics": metrics.summary(),
+    }
+    print(f"\n📈 Run metrics:\n{json.dumps(run_summary, indent=2)}")
+    if METRICS_SUMMARY_PATH:
+        with open(METRICS_SUMMARY_PATH, "w") as f:
+            json.dump(run_summary, f, indent=2)
+    return run_summary
+
+async def main() -> Dict[str, Any]:
+    if BATCH_MODE == "bulk":
+        return await main_bulk()
+    start_total = time.time()
+    await asyncio.to_thread(sync_identity_index)
+    # STT jobs mostly wait on Google's side, so they can run far wider than Gemini audio calls
+    worker_count = STT_MAX_IN_FLIGHT if ANALYSIS_ENGINE == "stt" else MAX_CONCURRENT_TASKS
+    print(f"\n🚀 Streaming gs://{GCS_BUCKET}/{GCS_PREFIX} into {worker_count} workers...")
+    work: asyncio.Queue = asyncio.Queue(maxsize=worker_count * 2)
+    counts = {"listed": 0, "successful": 0, "duplicates": 0}
+    failed_uris: List[str] = []
+    pending_rows: List[Dict[str, Any]] = []
+    phase_one_rows: List[Dict[str, Any]] = []  # TWO_PHASE: loaded rows still waiting for their transcript
+
+    async def load(rows: List[Dict[str, Any]]):
+        if await insert_batch_to_bigquery(rows):
+            phase_one_rows.extend(awaiting_transcripts(rows))
+
+    progress = None
+
+    async def worker():
+        while (uri := await work.get()) is not None:
+            if progress is not None:
+                progress.started(uri)
+            row = None if usage.ledger.budget_exceeded else await process_audio_file(uri)
+            if progress is not None:
+                progress.finished(uri)
+            if row is None:
+                failed_uris.append(uri)
+                continue
+            if row.get("duplicate_of"):
+                counts["duplicates"] += 1
+                continue
+            counts["successful"] += 1
+            pending_rows.append(row)
+            if len(pending_rows) >= INSERT_CHUNK_ROWS:
+                rows = pending_rows[:]
+                pending_rows.clear()
+                await load(rows)
+
+    workers = [asyncio.create_task(worker()) for _ in range(worker_count)]
+    if durations.SCHEDULE_ORDER == "longest_first":
+        # LPT: the whole listing and a duration pre-pass come first, then the longest recordings start first
+        listed = [uri async for page in iter_audio_files(GCS_BUCKET, GCS_PREFIX) for uri in page]
+        lengths = await durations.probe_all(storage_client, listed)
+        order = durations.longest_first(lengths)
+        print(f"📏 {len(order)} files, {sum(lengths.values()) / 60:.1f} minutes of audio; longest first.")
+        progress = durations.Progress(order, lengths, worker_count)
+        for uri in order:
+            counts["listed"] += 1
+            await work.put(uri)
+    else:
+        async for page in iter_audio_files(GCS_BUCKET, GCS_PREFIX):
+            for uri in page:
+                counts["listed"] += 1
+                await work.put(uri)
+    for _ in workers:
+        await work.put(None)
+    await asyncio.gather(*workers)
+    await load(pending_rows)
+    if not counts["listed"]:
+        print("❌ No audio files found in GCS.")
+        return {"total_files": 0, "successful": 0, "retry_successes": 0, "final_failed": 0}
     print("\n✅ ALL FILES PROCESSED.")
-    successful_rows = [row for row in results if row is not None]
-    failed_indices = [i for i, row in enumerate(results) if row is None]
-    failed_uris = [all_files[i] for i in failed_indices]
     print(f"\n📊 Processing summary:")
-    print(f"  Total files: {len(all_files)}")
-    print(f"  Successful:  {len(successful_rows)}")
+    print(f"  Total files: {counts['listed']}")
+    print(f"  Successful:  {counts['successful']}")
+    print(f"  Duplicates:  {counts['duplicates']}")
     print(f"  Failed:      {len(failed_uris)}")
-    await insert_batch_to_bigquery(successful_rows)
     retry_success_rows: List[Dict[str, Any]] = []
-    if failed_uris:
+    if usage.ledger.budget_exceeded:
+        print(f"\n🛑 Token/cost budget exhausted, skipping retries: {usage.ledger.totals}")
+    elif failed_uris:
         print("\n🔁 Retrying failed files one by one...")
         for uri in failed_uris:
+            if usage.ledger.budget_exceeded:
+                print("🛑 Token/cost budget exhausted, stopping retries.")
+                break
             attempt = 0
             max_attempts = 5
             success_row = None
@@ -237,13 +810,30 @@ async def main():
                     await asyncio.sleep(2 * attempt)
     if retry_success_rows:
         print(f"\n📦 Inserting {len(retry_success_rows)} retry-success rows into BigQuery...")
-        await insert_batch_to_bigquery(retry_success_rows)
+        await load(retry_success_rows)
+    transcripts = await complete_transcripts(phase_one_rows) if phase_one_rows else 0
     final_failed_count = len(failed_uris) - len(retry_success_rows)
     print(f"\n📉 Retry summary:")
     print(f"  Retry successes: {len(retry_success_rows)}")
     print(f"  Final failed:    {final_failed_count}")
     total_time = round((time.time() - start_total) / 60, 2)
     print(f"\n⏰ Total time taken: {total_time} minutes")
+    run_summary = {
+        "total_files": counts["listed"],
+        "successful": counts["successful"],
+        "duplicates": counts["duplicates"],
+        "retry_successes": len(retry_success_rows),
+        "final_failed": final_failed_count,
+        "transcripts_completed": transcripts,
+        "total_minutes": total_time,
+        "token_usage": usage.ledger.summary(),
+        "metrics": metrics.summary(),
+    }
+    print(f"\n📈 Run metrics:\n{json.dumps(run_summary, indent=2)}")
+    if METRICS_SUMMARY_PATH:
+        with open(METRICS_SUMMARY_PATH, "w") as f:
+            json.dump(run_summary, f, indent=2)
+    return run_summary
 
 if __name__ == "__main__":
     asyncio.run(main())
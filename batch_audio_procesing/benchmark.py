@@ -0,0 +1,159 @@
+# benchmark.py
+# End-to-end batch throughput benchmark against the offline fake backends.
+# Example: python benchmark.py --files 2000 --concurrency 20 --latency-ms 300 --rate-limit-rate 0.02
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import resource
+import tempfile
+import contextlib
+from typing import Dict, Any, List
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is reported in KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def configure_environment(args, workdir: str):
+    os.environ["AUDIO_BACKEND"] = "fake"
+    os.environ["FAKE_BUCKET_DIR"] = os.path.join(workdir, "gcs")
+    os.environ["FAKE_SQL_DB"] = os.path.join(workdir, "warehouse.sqlite")
+    os.environ["FAKE_GEMINI_LATENCY_MS"] = str(args.latency_ms)
+    os.environ["FAKE_GEMINI_LATENCY_SIGMA"] = str(args.latency_sigma)
+    os.environ["FAKE_GEMINI_ERROR_RATE"] = str(args.error_rate)
+    os.environ["FAKE_GEMINI_429_RATE"] = str(args.rate_limit_rate)
+    os.environ["FAKE_GEMINI_SHAPES"] = args.shapes
+    os.environ["FAKE_GEMINI_MS_PER_AUDIO_S"] = str(args.ms_per_audio_s)
+    os.environ["SCHEDULE_ORDER"] = args.schedule
+    os.environ["DURATION_CACHE_DB"] = os.path.join(workdir, "durations.sqlite")
+    os.environ["FAKE_SEED"] = str(args.seed)
+    os.environ["GCS_BUCKET"] = "benchmark-bucket"
+    os.environ["MAX_CONCURRENT_TASKS"] = str(args.concurrency)
+    os.environ["GEMINI_RETRY_MIN_WAIT"] = str(args.retry_min_wait)
+    os.environ["GEMINI_RETRY_MAX_WAIT"] = str(args.retry_max_wait)
+    os.environ["ANALYSIS_ENGINE"] = args.engine
+    os.environ["ANALYSIS_BATCHING"] = "1" if args.batching else "0"
+    os.environ["FAKE_STT_LATENCY_MS"] = str(args.stt_latency_ms)
+    os.environ["STT_POLL_INITIAL_S"] = str(args.stt_poll_s)
+    os.environ["BATCH_MODE"] = args.mode
+    os.environ["LOCAL_RUNNER_CONCURRENCY"] = str(args.concurrency)
+    os.environ["BULK_POLL_INITIAL_S"] = "0.1"
+    os.environ["FINGERPRINT_DEDUP"] = "1" if args.dedup else "0"
+    os.environ["FINGERPRINT_DB"] = os.path.join(workdir, "fingerprints.sqlite")
+    os.environ["IDENTITY_DB"] = os.path.join(workdir, "identity_index.sqlite")
+    os.environ["TRANSCRIPT_INDEX_DB"] = os.path.join(workdir, "transcript_index.sqlite")
+    os.environ["SIMILARITY_DIR"] = os.path.join(workdir, "call_vectors")
+    os.environ["REPLICA_DIR"] = os.path.join(workdir, "calls_replica")
+    os.environ["CUSTOMER_ID_LEASE_DIR"] = os.path.join(workdir, "leases")
+
+
+def run_benchmark(args) -> Dict[str, Any]:
+    workdir = tempfile.mkdtemp(prefix="audio_bench_")
+    try:
+        configure_environment(args, workdir)
+        import fake_backends
+        import batch_processing as bp
+
+        fake_backends.write_synthetic_audio(
+            args.files, "benchmark-bucket", root=os.environ["FAKE_BUCKET_DIR"], seed=args.seed,
+            duplicate_rate=args.duplicate_rate, min_seconds=args.min_seconds, max_seconds=args.max_seconds,
+        )
+
+        latencies: List[float] = []
+        attempts: Dict[str, int] = {}
+        original = bp.process_audio_file
+
+        async def timed_process_audio_file(gcs_uri: str):
+            attempts[gcs_uri] = attempts.get(gcs_uri, 0) + 1
+            start = time.perf_counter()
+            try:
+                return await original(gcs_uri)
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+        bp.process_audio_file = timed_process_audio_file
+        sink = io.StringIO() if args.quiet else None
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(sink) if sink else contextlib.nullcontext():
+            summary = asyncio.run(bp.main())
+        elapsed = time.perf_counter() - start
+        bp.process_audio_file = original
+
+        model = bp.gemini_model
+        file_attempts = sum(attempts.values())
+        return {
+            "mode": args.mode,
+            "schedule": args.schedule,
+            "files": args.files,
+            "concurrency": args.concurrency,
+            "elapsed_s": round(elapsed, 3),
+            "files_per_s": round(args.files / elapsed, 2) if elapsed else 0.0,
+            "latency_p50_s": round(percentile(latencies, 50), 4),
+            "latency_p95_s": round(percentile(latencies, 95), 4),
+            "latency_p99_s": round(percentile(latencies, 99), 4),
+            "peak_rss_mb": peak_rss_mb(),
+            "model_calls": model.calls,
+            "model_rate_limited": model.rate_limited,
+            "model_errors": model.errors,
+            "tenacity_retries": int(sum(bp.metrics.RETRIES.snapshot().values())),
+            "file_reprocess_attempts": file_attempts - len(attempts),
+            "rows_loaded": bp.bigquery_client.loaded_rows.get(bp.BIGQUERY_TABLE, 0),  # call rows only
+            "summary": summary,
+        }
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline batch throughput benchmark.")
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--shapes", default="json=1", help='e.g. "json=0.9,fenced=0.08,malformed=0.02"')
+    parser.add_argument("--retry-min-wait", type=float, default=0.05)
+    parser.add_argument("--retry-max-wait", type=float, default=1.0)
+    parser.add_argument("--mode", choices=("online", "bulk"), default="online")
+    parser.add_argument("--engine", choices=("gemini", "stt"), default="gemini")
+    parser.add_argument("--stt-latency-ms", type=float, default=2000.0)
+    parser.add_argument("--batching", action="store_true", help="Batch transcript analysis (stt engine).")
+    parser.add_argument("--stt-poll-s", type=float, default=0.25)
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="Share of files that are re-encoded copies.")
+    parser.add_argument("--dedup", action="store_true", help="Enable fingerprint deduplication (FINGERPRINT_DEDUP=1).")
+    parser.add_argument("--min-seconds", type=float, default=0.2, help="Shortest synthetic recording.")
+    parser.add_argument("--max-seconds", type=float, default=2.0, help="Longest synthetic recording.")
+    parser.add_argument("--ms-per-audio-s", type=float, default=0.0, help="Extra fake model latency per second of audio.")
+    parser.add_argument("--schedule", choices=("listing", "longest_first"), default="listing", help="SCHEDULE_ORDER.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report as JSON to this path.")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary bucket/warehouse directory.")
+    parser.add_argument("--verbose", dest="quiet", action="store_false", help="Show pipeline prints.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run_benchmark(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
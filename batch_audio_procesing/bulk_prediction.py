@@ -0,0 +1,218 @@
+# bulk_prediction.py
+# Offline bulk mode: JSONL request manifest → Vertex AI batch prediction job → streamed JSONL output.
+# LocalBatchJobRunner runs the same manifest against any model object for tests and laptops.
+import os
+import re
+import json
+import time
+import mimetypes
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, Any, Iterator, Optional, Tuple
+from vertexai.generative_models import GenerationConfig, Part
+import model_scheduler
+
+# --- CONFIGURATION ---
+BULK_POLL_INITIAL_S = float(os.getenv("BULK_POLL_INITIAL_S", "30"))
+BULK_POLL_MAX_S = float(os.getenv("BULK_POLL_MAX_S", "300"))
+BULK_PRICE_FACTOR = float(os.getenv("BULK_PRICE_FACTOR", "0.5"))  # batch prediction is billed at a discount
+LOCAL_RUNNER_CONCURRENCY = int(os.getenv("LOCAL_RUNNER_CONCURRENCY", "8"))
+
+
+def split_gcs_uri(uri: str) -> Tuple[str, str]:
+    bucket, _, name = uri[len("gs://"):].partition("/")
+    return bucket, name
+
+
+def manifest_line(gcs_uri: str, prompt: str, generation_config: Dict[str, Any]) -> str:
+    mime_type = mimetypes.guess_type(gcs_uri)[0] or "audio/wav"
+    return json.dumps({
+        "request": {
+            "contents": [{
+                "role": "user",
+                "parts": [
+                    {"fileData": {"fileUri": gcs_uri, "mimeType": mime_type}},
+                    {"text": prompt},
+                ],
+            }],
+            "generationConfig": generation_config,
+        }
+    })
+
+
+def write_manifest(storage_client, gcs_uris, manifest_uri: str, prompt: str, generation_config: Dict[str, Any]) -> int:
+    """Writes one request per audio file to `manifest_uri` (gs://…/requests.jsonl). Returns the line count."""
+    count = 0
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as f:
+        for uri in gcs_uris:
+            f.write(manifest_line(uri, prompt, generation_config) + "\n")
+            count += 1
+        local_path = f.name
+    try:
+        bucket_name, blob_name = split_gcs_uri(manifest_uri)
+        storage_client.bucket(bucket_name).blob(blob_name).upload_from_filename(local_path)
+    finally:
+        os.remove(local_path)
+    return count
+
+
+def _iter_blob_lines(blob) -> Iterator[str]:
+    if hasattr(blob, "open"):
+        with blob.open("r") as f:
+            for line in f:
+                yield line
+    else:
+        yield from blob.download_as_text().splitlines()
+
+
+def iter_prediction_lines(storage_client, output_location: str) -> Iterator[Dict[str, Any]]:
+    """Streams every prediction record below `output_location` without loading whole files."""
+    bucket_name, prefix = split_gcs_uri(output_location.rstrip("/") + "/")
+    for blob in storage_client.bucket(bucket_name).list_blobs(prefix=prefix):
+        if not blob.name.endswith(".jsonl"):
+            continue
+        for line in _iter_blob_lines(blob):
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def parse_prediction(record: Dict[str, Any]) -> Tuple[str, Optional[str], Optional[Dict[str, Any]], str]:
+    """Returns (gcs_uri, response_text or None, usage_metadata dict or None, error)."""
+    gcs_uri = ""
+    try:
+        for part in record["request"]["contents"][0]["parts"]:
+            if "fileData" in part:
+                gcs_uri = part["fileData"]["fileUri"]
+    except (KeyError, IndexError, TypeError):
+        pass
+    if record.get("status"):
+        return gcs_uri, None, None, str(record["status"])
+    response = record.get("response") or {}
+    try:
+        text = "".join(p.get("text", "") for p in response["candidates"][0]["content"]["parts"])
+    except (KeyError, IndexError, TypeError):
+        return gcs_uri, None, response.get("usageMetadata"), "No candidates in response"
+    return gcs_uri, text, response.get("usageMetadata"), ""
+
+
+def usage_metadata_object(meta: Optional[Dict[str, Any]]):
+    """Adapts the JSON usageMetadata of batch output to the attribute shape usage.extract_usage reads."""
+    meta = meta or {}
+    return SimpleNamespace(usage_metadata=SimpleNamespace(
+        prompt_token_count=meta.get("promptTokenCount", 0),
+        candidates_token_count=meta.get("candidatesTokenCount", 0),
+        thoughts_token_count=meta.get("thoughtsTokenCount", 0),
+        prompt_tokens_details=[
+            SimpleNamespace(modality=SimpleNamespace(name=d.get("modality", "")), token_count=d.get("tokenCount", 0))
+            for d in meta.get("promptTokensDetails", [])
+        ],
+    ))
+
+
+def wait_for_job(job, poll_initial: float = BULK_POLL_INITIAL_S, poll_max: float = BULK_POLL_MAX_S):
+    """Polls a batch job with exponential backoff until it ends."""
+    delay = poll_initial
+    started = time.time()
+    while not job.has_ended:
+        print(f"⏳ Batch job {job.resource_name} is {job.state} ({round(time.time() - started)}s elapsed)")
+        time.sleep(delay)
+        delay = min(delay * 2, poll_max)
+        job.refresh()
+    print(f"🏁 Batch job {job.resource_name} finished with state {job.state}")
+    return job
+
+
+# --- VERTEX AI RUNNER ---
+class VertexBatchJobRunner:
+    def submit(self, source_model: str, input_dataset: str, output_uri_prefix: str):
+        from vertexai.batch_prediction import BatchPredictionJob
+        return BatchPredictionJob.submit(
+            source_model=source_model,
+            input_dataset=input_dataset,
+            output_uri_prefix=output_uri_prefix,
+        )
+
+
+# --- LOCAL STAND-IN ---
+class LocalBatchJob:
+    def __init__(self, resource_name: str, output_location: str):
+        self.resource_name = resource_name
+        self.output_location = output_location
+        self.state = "JOB_STATE_RUNNING"
+        self.error = None
+
+    @property
+    def has_ended(self) -> bool:
+        return self.state in ("JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED")
+
+    @property
+    def has_succeeded(self) -> bool:
+        return self.state == "JOB_STATE_SUCCEEDED"
+
+    def refresh(self):
+        return self
+
+
+def generation_config_from_request(config: Optional[Dict[str, Any]]) -> Optional[GenerationConfig]:
+    """The SDK form of a manifest request's REST `generationConfig` (responseSchema → response_schema, ...)."""
+    if not config:
+        return None
+    return GenerationConfig(**{re.sub(r"(?<!^)(?=[A-Z])", "_", key).lower(): value for key, value in config.items()})
+
+
+class LocalBatchJobRunner:
+    """Executes a manifest synchronously with `model.generate_content` and writes Vertex-shaped output."""
+
+    def __init__(self, storage_client, model, concurrency: int = LOCAL_RUNNER_CONCURRENCY):
+        self.storage_client = storage_client
+        self.model = model
+        self.concurrency = concurrency
+
+    def _predict(self, line: str) -> Dict[str, Any]:
+        record = json.loads(line)
+        parts = record["request"]["contents"][0]["parts"]
+        contents = [
+            Part.from_uri(p["fileData"]["fileUri"], mime_type=p["fileData"]["mimeType"]) if "fileData" in p else p["text"]
+            for p in parts
+        ]
+        try:
+            # Same constraints as Vertex batch prediction: MIME type, response schema and token limit
+            generation_config = generation_config_from_request(record["request"].get("generationConfig"))
+            model_scheduler.admit(model_scheduler.BATCH)
+            response = self.model.generate_content(contents, generation_config=generation_config)
+        except Exception as e:
+            return dict(record, status=str(e))
+        meta = getattr(response, "usage_metadata", None)
+        usage_metadata = {
+            "promptTokenCount": getattr(meta, "prompt_token_count", 0),
+            "candidatesTokenCount": getattr(meta, "candidates_token_count", 0),
+            "promptTokensDetails": [
+                {"modality": getattr(d.modality, "name", str(d.modality)), "tokenCount": d.token_count}
+                for d in (getattr(meta, "prompt_tokens_details", None) or [])
+            ],
+        }
+        return dict(record, status="", response={
+            "candidates": [{"content": {"role": "model", "parts": [{"text": response.text}]}}],
+            "usageMetadata": usage_metadata,
+        })
+
+    def submit(self, source_model: str, input_dataset: str, output_uri_prefix: str) -> LocalBatchJob:
+        run_name = f"local-batch-{int(time.time() * 1000)}"
+        output_location = f"{output_uri_prefix.rstrip('/')}/{run_name}"
+        job = LocalBatchJob(run_name, output_location)
+        bucket_name, manifest_name = split_gcs_uri(input_dataset)
+        lines = (l for l in _iter_blob_lines(self.storage_client.bucket(bucket_name).blob(manifest_name)) if l.strip())
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool, \
+                tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as out:
+            for record in pool.map(self._predict, lines):
+                out.write(json.dumps(record) + "\n")
+            local_path = out.name
+        try:
+            out_bucket, out_prefix = split_gcs_uri(output_location)
+            self.storage_client.bucket(out_bucket).blob(f"{out_prefix}/predictions.jsonl").upload_from_filename(local_path)
+        finally:
+            os.remove(local_path)
+        job.state = "JOB_STATE_SUCCEEDED"
+        return job
@@ -0,0 +1,154 @@
+# customer_ids.py
+# Coordination-free customer IDs: 41-bit millisecond timestamp | 10-bit worker | 12-bit sequence.
+# The worker is NODE_ID (one per machine/job shard) combined with a process slot leased from a
+# local directory, so parallel processes and nodes never mint the same key and no central lock is needed.
+import os
+import time
+import atexit
+import tempfile
+import threading
+from typing import Dict, Optional
+
+# --- CONFIGURATION ---
+NODE_ID = int(os.getenv("NODE_ID", "0"))  # 0–31, unique per machine / batch shard
+WORKER_ID = os.getenv("CUSTOMER_ID_WORKER_ID")  # optional explicit 0–1023 worker id (skips slot leasing)
+LEASE_DIR = os.getenv("CUSTOMER_ID_LEASE_DIR", os.path.join(tempfile.gettempdir(), "customer_id_leases"))
+EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+
+NODE_BITS = 5
+SLOT_BITS = 5
+WORKER_BITS = NODE_BITS + SLOT_BITS
+SEQUENCE_BITS = 12
+MAX_SLOT = (1 << SLOT_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SlotLease:
+    """Exclusive claim on one of 32 per-node process slots, held as an O_EXCL lease file.
+    Leases of processes that died without releasing them are reclaimed."""
+
+    def __init__(self, lease_dir: str = LEASE_DIR, node_id: int = NODE_ID):
+        self.lease_dir = lease_dir
+        self.node_id = node_id
+        self.slot: Optional[int] = None
+        self.path: Optional[str] = None
+
+    def acquire(self) -> int:
+        os.makedirs(self.lease_dir, exist_ok=True)
+        for _ in range(2):
+            for slot in range(MAX_SLOT + 1):
+                path = os.path.join(self.lease_dir, f"node{self.node_id}-slot{slot}.lease")
+                try:
+                    fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                except FileExistsError:
+                    self._reclaim_if_stale(path)
+                    continue
+                with os.fdopen(fd, "w") as f:
+                    f.write(str(os.getpid()))
+                self.slot, self.path = slot, path
+                atexit.register(self.release)
+                return slot
+        raise RuntimeError(f"All {MAX_SLOT + 1} customer ID slots on node {self.node_id} are leased ({self.lease_dir})")
+
+    @staticmethod
+    def _reclaim_if_stale(path: str):
+        try:
+            with open(path) as f:
+                pid = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return
+        if pid and not _pid_alive(pid):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def release(self):
+        if self.path and self.slot is not None:
+            try:
+                with open(self.path) as f:
+                    owned = f.read().strip() == str(os.getpid())
+                if owned:
+                    os.remove(self.path)
+            except OSError:
+                pass
+        self.slot = self.path = None
+
+
+class CustomerIdAllocator:
+    """Thread-safe Snowflake-style generator. IDs increase with time, so rows inserted together
+    cluster together. The hot path is a lock and a few integer operations: when the clock steps
+    back or 4096 IDs are minted within one millisecond, the timestamp is advanced logically
+    instead of sleeping."""
+
+    def __init__(self, node_id: int = NODE_ID, worker_id: Optional[int] = None, lease_dir: str = LEASE_DIR):
+        if not 0 <= node_id < (1 << NODE_BITS):
+            raise ValueError(f"NODE_ID must be between 0 and {(1 << NODE_BITS) - 1}, got {node_id}")
+        self.node_id = node_id
+        self.lease_dir = lease_dir
+        self._fixed_worker_id = worker_id
+        self._lease: Optional[SlotLease] = None
+        self._worker_id: Optional[int] = None
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+        if hasattr(os, "register_at_fork"):
+            # A forked child must not keep minting with its parent's slot
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+        if self._fixed_worker_id is None:
+            self._lease = None
+            self._worker_id = None
+
+    @property
+    def worker_id(self) -> int:
+        if self._worker_id is None:
+            if self._fixed_worker_id is not None:
+                if not 0 <= self._fixed_worker_id < (1 << WORKER_BITS):
+                    raise ValueError(f"Worker id must be between 0 and {(1 << WORKER_BITS) - 1}")
+                self._worker_id = self._fixed_worker_id
+            else:
+                self._lease = SlotLease(self.lease_dir, self.node_id)
+                self._worker_id = (self.node_id << SLOT_BITS) | self._lease.acquire()
+        return self._worker_id
+
+    def next_id(self) -> int:
+        with self._lock:
+            worker_id = self.worker_id
+            now = int(time.time() * 1000) - EPOCH_MS
+            if now > self._last_ms:
+                self._last_ms, self._sequence = now, 0
+            elif self._sequence < MAX_SEQUENCE:
+                self._sequence += 1
+            else:
+                self._last_ms, self._sequence = self._last_ms + 1, 0
+            return (self._last_ms << (WORKER_BITS + SEQUENCE_BITS)) | (worker_id << SEQUENCE_BITS) | self._sequence
+
+
+def decode_customer_id(customer_id: int) -> Dict[str, int]:
+    """Splits an ID into its parts, e.g. to find which worker produced a row."""
+    return {
+        "timestamp_ms": (customer_id >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH_MS,
+        "node_id": (customer_id >> (SLOT_BITS + SEQUENCE_BITS)) & ((1 << NODE_BITS) - 1),
+        "slot": (customer_id >> SEQUENCE_BITS) & MAX_SLOT,
+        "sequence": customer_id & MAX_SEQUENCE,
+    }
+
+
+allocator = CustomerIdAllocator(worker_id=int(WORKER_ID) if WORKER_ID else None)
+
+
+def next_customer_id() -> int:
+    return allocator.next_id()
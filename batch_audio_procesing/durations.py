@@ -0,0 +1,247 @@
+# durations.py
+# Duration-aware ordering for batch runs. A pre-pass learns each recording's length from (cheapest first)
+# the local cache, custom blob metadata, or the WAV/MP3 header fetched with a small ranged GCS read. The
+# files are then handed to the workers longest-first (LPT), so a long recording never starts last and
+# stretches the run while the other workers sit idle. The expected remaining time is reported as files finish.
+import os
+import time
+import heapq
+import struct
+import sqlite3
+import asyncio
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+from metrics import REGISTRY, Gauge, track
+
+# --- CONFIGURATION ---
+SCHEDULE_ORDER = os.getenv("SCHEDULE_ORDER", "listing")  # "listing" (stream as listed) or "longest_first"
+DURATION_CACHE_DB = os.getenv("DURATION_CACHE_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "durations.sqlite"))
+DURATION_HEADER_BYTES = int(os.getenv("DURATION_HEADER_BYTES", "65536"))  # size of the ranged header read
+DURATION_PROBE_PARALLELISM = int(os.getenv("DURATION_PROBE_PARALLELISM", "32"))
+PROGRESS_INTERVAL_S = float(os.getenv("PROGRESS_INTERVAL_S", "30"))
+FALLBACK_BYTES_PER_S = 16000  # 128 kbit/s, for files whose header cannot be parsed
+METADATA_KEYS = ("duration_s", "duration")
+
+EXPECTED_REMAINING_S = REGISTRY.register(Gauge(
+    "batch_expected_remaining_seconds", "Expected time until the current batch run finishes."))
+
+# MPEG audio Layer III tables, indexed by version bits (3 = MPEG-1, 2 = MPEG-2, 0 = MPEG-2.5)
+_MP3_BITRATES_KBPS = {
+    3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_BITRATES_KBPS[0] = _MP3_BITRATES_KBPS[2]
+_MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+# --- HEADER PARSING ---
+
+def wav_duration(header: bytes, size: int) -> Optional[float]:
+    """Duration of a RIFF/WAVE file from its first bytes: data chunk length / byte rate."""
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return None
+    offset, byte_rate = 12, None
+    while offset + 8 <= len(header):
+        chunk_id, length = header[offset:offset + 4], struct.unpack("<I", header[offset + 4:offset + 8])[0]
+        if chunk_id == b"fmt " and offset + 20 <= len(header):
+            byte_rate = struct.unpack("<I", header[offset + 16:offset + 20])[0]
+        elif chunk_id == b"data":
+            if not byte_rate:
+                return None
+            # Streamed writers leave the length at 0 or 0xFFFFFFFF: the data then runs to the end of the object
+            if length in (0, 0xFFFFFFFF) or offset + 8 + length > size:
+                length = max(size - offset - 8, 0)
+            return length / byte_rate
+        offset += 8 + length + (length & 1)
+    return None
+
+
+def id3_size(header: bytes) -> int:
+    """Bytes taken by a leading ID3v2 tag (0 without one)."""
+    if len(header) < 10 or header[:3] != b"ID3":
+        return 0
+    size = (header[6] & 0x7F) << 21 | (header[7] & 0x7F) << 14 | (header[8] & 0x7F) << 7 | (header[9] & 0x7F)
+    return 10 + size + (10 if header[5] & 0x10 else 0)
+
+
+def mp3_duration(header: bytes, size: int, audio_start: int = 0) -> Optional[float]:
+    """Duration of an MP3 (Layer III) stream from its first frame: the Xing/Info or VBRI frame count for
+    VBR files, otherwise the constant bitrate. `header` starts at `audio_start` (after any ID3v2 tag)."""
+    for i in range(min(len(header) - 4, 4096)):
+        b0, b1, b2, b3 = header[i:i + 4]
+        if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+            continue
+        version, layer = (b1 >> 3) & 3, (b1 >> 1) & 3
+        bitrate_index, rate_index = b2 >> 4, (b2 >> 2) & 3
+        if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+            continue  # reserved values, or not Layer III
+        sample_rate = _MP3_SAMPLE_RATES[version][rate_index]
+        samples_per_frame = 1152 if version == 3 else 576
+        mono = (b3 >> 6) == 3
+        side_info = (17 if mono else 32) if version == 3 else (9 if mono else 17)
+        xing = i + 4 + side_info
+        if header[xing:xing + 4] in (b"Xing", b"Info") and xing + 12 <= len(header):
+            flags = struct.unpack(">I", header[xing + 4:xing + 8])[0]
+            if flags & 1:
+                frames = struct.unpack(">I", header[xing + 8:xing + 12])[0]
+                return frames * samples_per_frame / sample_rate
+        vbri = i + 4 + 32
+        if header[vbri:vbri + 4] == b"VBRI" and vbri + 18 <= len(header):
+            frames = struct.unpack(">I", header[vbri + 14:vbri + 18])[0]
+            return frames * samples_per_frame / sample_rate
+        bitrate = _MP3_BITRATES_KBPS[version][bitrate_index] * 1000
+        return max(size - audio_start - i, 0) * 8 / bitrate
+    return None
+
+
+# --- CACHE ---
+
+class DurationCache:
+    """gs:// URI → (object size, seconds). An entry whose size no longer matches the object is ignored."""
+
+    def __init__(self, path: str = DURATION_CACHE_DB):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS durations (
+                uri TEXT PRIMARY KEY, size INTEGER NOT NULL, seconds REAL NOT NULL, source TEXT NOT NULL
+            ) WITHOUT ROWID
+        """)
+
+    def get(self, uri: str) -> Optional[Tuple[int, float]]:
+        with self.lock:
+            return self.conn.execute("SELECT size, seconds FROM durations WHERE uri = ?", (uri,)).fetchone()
+
+    def put(self, uri: str, size: int, seconds: float, source: str):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO durations VALUES (?, ?, ?, ?)", (uri, size, seconds, source))
+            self.conn.commit()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> DurationCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = DurationCache()
+        return _cache
+
+
+# --- PROBING ---
+
+def probe(storage_client, gcs_uri: str) -> Tuple[float, str]:
+    """(seconds, source) for one recording; source is cache, metadata, header or estimate."""
+    bucket_name, blob_name = gcs_uri[len("gs://"):].split("/", 1)
+    blob = storage_client.bucket(bucket_name).blob(blob_name)
+    blob.reload()
+    size = blob.size or 0
+    cached = get_cache().get(gcs_uri)
+    if cached is not None and cached[0] == size:
+        return cached[1], "cache"
+    seconds, source = None, "metadata"
+    for key in METADATA_KEYS:
+        try:
+            seconds = float((blob.metadata or {})[key])
+            break
+        except (KeyError, ValueError):
+            continue
+    if seconds is None:
+        source = "header"
+        header = blob.download_as_bytes(start=0, end=min(DURATION_HEADER_BYTES, size) - 1) if size else b""
+        seconds = wav_duration(header, size)
+        if seconds is None:
+            audio_start = id3_size(header)
+            if audio_start >= len(header) and audio_start < size:
+                header = blob.download_as_bytes(start=audio_start, end=min(audio_start + DURATION_HEADER_BYTES, size) - 1)
+            else:
+                header = header[audio_start:]
+            seconds = mp3_duration(header, size, audio_start)
+    if seconds is None:
+        return size / FALLBACK_BYTES_PER_S, "estimate"
+    get_cache().put(gcs_uri, size, seconds, source)
+    return seconds, source
+
+
+async def probe_all(storage_client, uris: Iterable[str]) -> Dict[str, float]:
+    """Durations of all `uris`, probed DURATION_PROBE_PARALLELISM at a time."""
+    limiter = asyncio.Semaphore(DURATION_PROBE_PARALLELISM)
+    sources: Dict[str, int] = {}
+
+    async def one(uri: str) -> Tuple[str, float]:
+        async with limiter:
+            try:
+                seconds, source = await asyncio.to_thread(probe, storage_client, uri)
+            except Exception as e:
+                print(f"⚠️ Could not read the duration of {uri}: {e}")
+                seconds, source = 0.0, "unknown"
+            sources[source] = sources.get(source, 0) + 1
+            return uri, seconds
+
+    with track("duration_probe"):
+        durations = dict(await asyncio.gather(*(one(uri) for uri in uris)))
+    print(f"⏱️ Probed {len(durations)} durations ({', '.join(f'{n} from {s}' for s, n in sorted(sources.items()))}).")
+    return durations
+
+
+def longest_first(durations: Dict[str, float]) -> List[str]:
+    return sorted(durations, key=durations.get, reverse=True)
+
+
+# --- PROGRESS ---
+
+class Progress:
+    """Expected remaining time of a longest-first run. Processing time is fitted as a + b·duration over the
+    files finished so far; the queued files are then list-scheduled onto the workers as they will really be."""
+
+    def __init__(self, order: List[str], durations: Dict[str, float], workers: int):
+        self.queue = list(order)
+        self.durations = durations
+        self.workers = workers
+        self.next_index = 0
+        self.running: Dict[str, float] = {}
+        self.n = self.sx = self.sy = self.sxx = self.sxy = 0.0
+        self.last_report = time.monotonic()
+
+    def started(self, uri: str):
+        self.running[uri] = time.monotonic()
+        self.next_index += 1
+
+    def finished(self, uri: str):
+        started = self.running.pop(uri, None)
+        if started is not None:
+            x, y = self.durations.get(uri, 0.0), time.monotonic() - started
+            self.n, self.sx, self.sy = self.n + 1, self.sx + x, self.sy + y
+            self.sxx, self.sxy = self.sxx + x * x, self.sxy + x * y
+        if time.monotonic() - self.last_report >= PROGRESS_INTERVAL_S:
+            self.last_report = time.monotonic()
+            eta = self.expected_remaining()
+            if eta is not None:
+                done = self.next_index - len(self.running)
+                print(f"⏳ {done}/{len(self.queue)} files done, about {eta:.0f}s remaining.")
+
+    def predict(self, seconds: float) -> float:
+        if self.n == 0:
+            return 0.0
+        denominator = self.n * self.sxx - self.sx * self.sx
+        if self.n < 2 or denominator <= 1e-9:
+            return self.sy / self.n
+        slope = (self.n * self.sxy - self.sx * self.sy) / denominator
+        slope = max(slope, 0.0)
+        return max((self.sy - slope * self.sx) / self.n + slope * seconds, 0.0)
+
+    def expected_remaining(self) -> Optional[float]:
+        if self.n == 0:
+            return None
+        now = time.monotonic()
+        free_at = [max(self.predict(self.durations.get(uri, 0.0)) - (now - started), 0.0) for uri, started in self.running.items()]
+        free_at += [0.0] * max(self.workers - len(free_at), 0)
+        heapq.heapify(free_at)
+        for uri in self.queue[self.next_index:]:
+            heapq.heapreplace(free_at, free_at[0] + self.predict(self.durations.get(uri, 0.0)))
+        eta = max(free_at) if free_at else 0.0
+        EXPECTED_REMAINING_S.set(eta)
+        return eta
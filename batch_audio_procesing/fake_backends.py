@@ -0,0 +1,553 @@
+# fake_backends.py
+# Offline stand-ins for GCS, Vertex AI Gemini and BigQuery.
+# Selected with AUDIO_BACKEND=fake so the pipeline and the web apps can be run and benchmarked on a laptop.
+import os
+import re
+import json
+import time
+import wave
+import array
+import random
+import sqlite3
+import asyncio
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+from datetime import timedelta
+from typing import Dict, Any, List, Optional
+from google.api_core import exceptions as google_exceptions
+
+# --- CONFIGURATION ---
+FAKE_BUCKET_DIR = os.getenv("FAKE_BUCKET_DIR", os.path.join(os.path.dirname(__file__), ".fake_gcs"))
+FAKE_SQL_DB = os.getenv("FAKE_SQL_DB", ":memory:")
+FAKE_GEMINI_LATENCY_MS = float(os.getenv("FAKE_GEMINI_LATENCY_MS", "800"))
+FAKE_GEMINI_LATENCY_SIGMA = float(os.getenv("FAKE_GEMINI_LATENCY_SIGMA", "0.5"))  # lognormal spread
+FAKE_GEMINI_ERROR_RATE = float(os.getenv("FAKE_GEMINI_ERROR_RATE", "0"))
+FAKE_GEMINI_429_RATE = float(os.getenv("FAKE_GEMINI_429_RATE", "0"))
+FAKE_GEMINI_MS_PER_AUDIO_S = float(os.getenv("FAKE_GEMINI_MS_PER_AUDIO_S", "0"))  # extra latency per second of WAV audio
+FAKE_GEMINI_SHAPES = os.getenv("FAKE_GEMINI_SHAPES", "json=1")  # e.g. "json=0.8,fenced=0.15,malformed=0.05"
+FAKE_SEED = os.getenv("FAKE_SEED")
+
+PROBLEM_TYPES = ["Network", "Recharge", "Payment"]
+PROBLEM_STATUSES = ["Solved", "Pending"]
+SENTIMENTS = [
+    "Started frustrated about the failed recharge, calmed down once the agent explained, ended satisfied.",
+    "Customer was anxious about slow internet, stayed impatient, ended unhappy as the issue remains pending.",
+    "Polite and neutral throughout the call, ended relieved after the payment was confirmed.",
+]
+
+
+# --- STORAGE (directory-backed bucket) ---
+class FakeBlob:
+    def __init__(self, bucket: "FakeBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+        self.metadata: Optional[Dict[str, str]] = None
+        self.content_type: Optional[str] = None
+
+    @property
+    def path(self) -> Path:
+        return self.bucket.root / self.name
+
+    @property
+    def size(self) -> Optional[int]:
+        try:
+            return self.path.stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def reload(self):
+        pass
+
+    def upload_from_filename(self, filename: str, **kwargs):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(filename, "rb") as src, open(self.path, "wb") as dst:
+            dst.write(src.read())
+
+    def upload_from_file(self, file_obj, **kwargs):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "wb") as dst:
+            dst.write(file_obj.read())
+
+    def upload_from_string(self, data, **kwargs):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_bytes(data.encode("utf-8") if isinstance(data, str) else data)
+
+    def download_as_bytes(self, start: Optional[int] = None, end: Optional[int] = None, **kwargs) -> bytes:
+        with open(self.path, "rb") as f:
+            if start is None:
+                return f.read() if end is None else f.read(end + 1)
+            f.seek(start)
+            return f.read() if end is None else f.read(end - start + 1)
+
+    def download_as_text(self, **kwargs) -> str:
+        return self.download_as_bytes().decode("utf-8")
+
+    def open(self, mode: str = "r", **kwargs):
+        if "w" in mode:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        return open(self.path, mode, encoding=None if "b" in mode else "utf-8")
+
+    def delete(self):
+        self.path.unlink(missing_ok=True)
+
+
+class FakeBucket:
+    def __init__(self, root: Path, name: str):
+        self.root = root / name
+        self.name = name
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix: str = "", delimiter: Optional[str] = None, page_size: Optional[int] = None, **kwargs):
+        return FakeBlobIterator(self, prefix or "", delimiter, page_size or 1000)
+
+
+class FakeBlobIterator:
+    """Paged listing like google.api_core's HTTPIterator: iterate blobs or `.pages`; with a
+    delimiter, `.prefixes` holds the "sub-folders" seen once the pages have been consumed."""
+
+    def __init__(self, bucket: FakeBucket, prefix: str, delimiter: Optional[str], page_size: int):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.delimiter = delimiter
+        self.page_size = page_size
+        self.prefixes = set()
+
+    def _names(self):
+        base = self.bucket.root / self.prefix.rsplit("/", 1)[0] if "/" in self.prefix else self.bucket.root
+        if not base.exists():
+            return
+        for dirpath, dirnames, filenames in os.walk(base):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                name = (Path(dirpath) / filename).relative_to(self.bucket.root).as_posix()
+                if not name.startswith(self.prefix):
+                    continue
+                rest = name[len(self.prefix):]
+                if self.delimiter and self.delimiter in rest:
+                    self.prefixes.add(self.prefix + rest[: rest.index(self.delimiter) + 1])
+                    continue
+                yield name
+
+    @property
+    def pages(self):
+        page = []
+        for name in self._names():
+            page.append(FakeBlob(self.bucket, name))
+            if len(page) >= self.page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+
+class FakeStorageClient:
+    def __init__(self, root: str = FAKE_BUCKET_DIR):
+        self.root = Path(root)
+
+    def bucket(self, bucket_name: str) -> FakeBucket:
+        return FakeBucket(self.root, bucket_name)
+
+    def list_blobs(self, bucket_or_name, prefix: str = "", **kwargs):
+        bucket = bucket_or_name if isinstance(bucket_or_name, FakeBucket) else self.bucket(bucket_or_name)
+        return bucket.list_blobs(prefix=prefix, **kwargs)
+
+
+# --- GEMINI (configurable latency, errors and response shapes) ---
+class FakeModalityTokenCount:
+    def __init__(self, modality: str, token_count: int):
+        self.modality = SimpleNamespace(name=modality)
+        self.token_count = token_count
+
+
+class FakeUsageMetadata:
+    def __init__(self, text_token_count: int, audio_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = text_token_count + audio_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = self.prompt_token_count + candidates_token_count
+        self.prompt_tokens_details = [FakeModalityTokenCount("TEXT", text_token_count)]
+        if audio_token_count:
+            self.prompt_tokens_details.append(FakeModalityTokenCount("AUDIO", audio_token_count))
+
+
+class FakeResponse:
+    def __init__(self, text: str, usage_metadata: FakeUsageMetadata):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+def _parse_shapes(spec: str) -> Dict[str, float]:
+    shapes = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, weight = item.split("=", 1)
+            shapes[name.strip()] = float(weight)
+    return shapes or {"json": 1.0}
+
+
+class FakeGeminiModel:
+    """Mimics GenerativeModel.generate_content(_async) with injectable latency and failures."""
+
+    def __init__(
+        self,
+        model_name: str = "fake-gemini",
+        latency_ms: float = FAKE_GEMINI_LATENCY_MS,
+        latency_sigma: float = FAKE_GEMINI_LATENCY_SIGMA,
+        error_rate: float = FAKE_GEMINI_ERROR_RATE,
+        rate_limit_rate: float = FAKE_GEMINI_429_RATE,
+        shapes: str = FAKE_GEMINI_SHAPES,
+        seed: Optional[str] = FAKE_SEED,
+        ms_per_audio_s: float = FAKE_GEMINI_MS_PER_AUDIO_S,
+    ):
+        self.model_name = model_name
+        self.latency_ms = latency_ms
+        self.ms_per_audio_s = ms_per_audio_s
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.shapes = _parse_shapes(shapes)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.rate_limited = 0
+        self.errors = 0
+
+    def _draw(self):
+        with self.lock:
+            self.calls += 1
+            mu = self.latency_ms / 1000.0
+            latency = mu * self.rng.lognormvariate(0, self.latency_sigma) if self.latency_sigma else mu
+            roll = self.rng.random()
+            shape = self.rng.choices(list(self.shapes), weights=list(self.shapes.values()))[0]
+            if roll < self.rate_limit_rate:
+                self.rate_limited += 1
+                failure = google_exceptions.ResourceExhausted("429 Resource exhausted (fake)")
+            elif roll < self.rate_limit_rate + self.error_rate:
+                self.errors += 1
+                failure = google_exceptions.InternalServerError("500 Internal error (fake)")
+            else:
+                failure = None
+            return latency, failure, shape, self.rng.randrange(1 << 30)
+
+    def _audio_latency(self, contents) -> float:
+        """Longer recordings take longer: ms_per_audio_s for every second of WAV audio in the fake bucket."""
+        if not self.ms_per_audio_s:
+            return 0.0
+        seconds = 0.0
+        for part in contents if isinstance(contents, list) else [contents]:
+            uri = getattr(getattr(part, "file_data", None), "file_uri", "") if not isinstance(part, str) else ""
+            if not uri.startswith("gs://"):
+                continue
+            try:
+                with wave.open(str(Path(FAKE_BUCKET_DIR) / uri[len("gs://"):]), "rb") as w:
+                    seconds += w.getnframes() / w.getframerate()
+            except (OSError, wave.Error, EOFError):
+                continue
+        return seconds * self.ms_per_audio_s / 1000.0
+
+    @staticmethod
+    def _analysis(rng: random.Random) -> Dict[str, Any]:
+        turns = rng.randint(4, 12)
+        transcript = "\n".join(
+            f"{'Support' if i % 2 == 0 else 'Customer'}: synthetic utterance number {i} about my plan."
+            for i in range(turns)
+        )
+        return {
+            "phone_number": str(rng.randint(6000000000, 9999999999)) if rng.random() > 0.1 else "Missing phone number",
+            "problem_solved": rng.choice(PROBLEM_STATUSES),
+            "problem_type": rng.choice(PROBLEM_TYPES),
+            "sentiment": rng.choice(SENTIMENTS),
+            "full_transcript": transcript,
+        }
+
+    @staticmethod
+    def _sql(prompt: str) -> Optional[str]:
+        """A plausible answer to the NL→SQL prompts of nlp_sql.py: filters on the category the question names."""
+        rollup = re.search(r"Table `([^`]+)`, one row per group", prompt)
+        if rollup:
+            return f"SELECT problem_type, SUM(call_count) AS calls FROM `{rollup.group(1)}` GROUP BY problem_type ORDER BY calls DESC"
+        table = re.search(r"Use table `([^`]+)`", prompt)
+        if not table:
+            return None
+        question = re.search(r'User Question: "(.*)"', prompt)
+        words = (question.group(1) if question else "").lower()
+        conditions = [f"LOWER(problem_type) = '{t.lower()}'" for t in PROBLEM_TYPES if t.lower() in words]
+        conditions += [f"LOWER(problem_solved) = '{s.lower()}'" for s in PROBLEM_STATUSES if s.lower() in words]
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        return (f"SELECT customer_id, phone_number, problem_type, problem_solved, sentiment "
+                f"FROM `{table.group(1)}`{where} LIMIT 10")
+
+    def _build_response(self, contents, shape: str, seed: int) -> FakeResponse:
+        rng = random.Random(seed)
+        prompt = "\n".join(p for p in (contents if isinstance(contents, list) else [contents]) if isinstance(p, str))
+        parts = contents if isinstance(contents, list) else [contents]
+        text_tokens = sum(len(p) for p in parts if isinstance(p, str)) // 4
+        answer = self._sql(prompt)
+        if answer is None and "The database returned:" in prompt:
+            # Result interpretation: plain text, one block per returned record
+            records = len(re.findall(r"^  \{", prompt, re.MULTILINE))  # top-level objects of the indented JSON result
+            answer = f"The query returned {records} record(s).\n\n" + "\n\n".join(
+                f"Record {n}: \n{rng.choice(SENTIMENTS)}" for n in range(1, records + 1))
+        if answer is not None:
+            return FakeResponse(answer, FakeUsageMetadata(text_tokens, 0, len(answer) // 4))
+        call_ids = re.findall(r"^### CALL (.+)$", prompt, re.MULTILINE)
+        if call_ids:
+            # Batched transcript analysis: one keyed element per call, no transcript
+            payload = []
+            for call_id in call_ids:
+                item = {"call_id": call_id.strip(), **self._analysis(rng)}
+                item.pop("full_transcript")
+                payload.append(item)
+        else:
+            payload = self._analysis(rng)
+        text = json.dumps(payload, indent=2)
+        if shape == "fenced":
+            text = f"```json\n{text}\n```"
+        elif shape == "malformed":
+            text = text[: max(1, len(text) // 2)]
+        elif shape == "trailing_comma":
+            text = text[:-1].rstrip() + ",\n" + text[-1]
+        audio_tokens = 32 * rng.randint(30, 600) if any(not isinstance(p, str) for p in parts) else 0  # ~32 tokens/s
+        return FakeResponse(text, FakeUsageMetadata(text_tokens, audio_tokens, len(text) // 4))
+
+    async def generate_content_async(self, contents, generation_config=None, **kwargs) -> FakeResponse:
+        latency, failure, shape, seed = self._draw()
+        await asyncio.sleep(latency + self._audio_latency(contents))
+        if failure:
+            raise failure
+        return self._build_response(contents, shape, seed)
+
+    def generate_content(self, contents, generation_config=None, **kwargs) -> FakeResponse:
+        latency, failure, shape, seed = self._draw()
+        time.sleep(latency + self._audio_latency(contents))
+        if failure:
+            raise failure
+        return self._build_response(contents, shape, seed)
+
+
+# --- SPEECH-TO-TEXT (long-running operations that finish after a simulated delay) ---
+FAKE_STT_LATENCY_MS = float(os.getenv("FAKE_STT_LATENCY_MS", "3000"))
+
+
+class FakeOperation:
+    def __init__(self, ready_at: float, response):
+        self.ready_at = ready_at
+        self.response = response
+
+    def done(self) -> bool:
+        return time.monotonic() >= self.ready_at
+
+    def result(self, timeout: Optional[float] = None):
+        if not self.done():
+            time.sleep(max(0.0, self.ready_at - time.monotonic()))
+        return self.response
+
+
+class FakeSpeechClient:
+    """Mimics SpeechClient.long_running_recognize with diarized v1p1beta1-style results:
+    untagged per-segment results followed by one aggregate result carrying speaker tags."""
+
+    def __init__(self, latency_ms: float = FAKE_STT_LATENCY_MS, seed: Optional[str] = FAKE_SEED):
+        self.latency_ms = latency_ms
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.operations = 0
+
+    def long_running_recognize(self, config=None, audio=None, **kwargs) -> FakeOperation:
+        with self.lock:
+            self.operations += 1
+            delay = self.latency_ms / 1000.0 * self.rng.uniform(0.5, 1.5)
+            turns = self.rng.randint(4, 10)
+        words, t = [], 0.0
+        for turn in range(turns):
+            for w in f"synthetic utterance {turn} about my recharge".split():
+                words.append(SimpleNamespace(word=w, speaker_tag=1 + turn % 2, start_time=timedelta(seconds=t)))
+                t += 0.4
+        segments = [
+            SimpleNamespace(alternatives=[SimpleNamespace(
+                transcript=" ".join(w.word for w in chunk),
+                words=[SimpleNamespace(word=w.word, speaker_tag=0, start_time=w.start_time) for w in chunk],
+            )])
+            for chunk in (words[: len(words) // 2], words[len(words) // 2:])
+        ]
+        segments.append(SimpleNamespace(alternatives=[SimpleNamespace(transcript="", words=words)]))
+        return FakeOperation(time.monotonic() + delay, SimpleNamespace(results=segments))
+
+
+# --- BIGQUERY (in-process SQLite sink) ---
+SQLITE_TYPES = {"INTEGER": "INTEGER", "INT64": "INTEGER", "FLOAT": "REAL", "FLOAT64": "REAL", "BOOLEAN": "INTEGER"}
+
+
+def _local_table_name(table_id: str) -> str:
+    return table_id.strip("`").split(".")[-1]
+
+
+def _translate_sql(sql: str) -> str:
+    return re.sub(r"`([^`]+)`", lambda m: _local_table_name(m.group(1)), sql)
+
+
+class FakeSchemaField:
+    def __init__(self, name: str, field_type: str):
+        self.name = name
+        self.field_type = field_type
+
+
+class FakeTable:
+    def __init__(self, table_id: str, schema: List[FakeSchemaField], labels: Optional[Dict[str, str]] = None):
+        self.table_id = table_id
+        self.schema = schema
+        self.labels = labels or {}
+
+
+class FakeJob:
+    def __init__(self, rows: Optional[List[Dict[str, Any]]] = None, errors=None):
+        self.rows = rows or []
+        self.errors = errors
+
+    def result(self, *args, **kwargs):
+        return self
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class FakeDatasetRef:
+    def __init__(self, dataset_id: str):
+        self.dataset_id = dataset_id
+
+    def table(self, table_id: str) -> str:
+        return f"{self.dataset_id}.{table_id}"
+
+
+class FakeBigQueryClient:
+    def __init__(self, db_path: str = FAKE_SQL_DB):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        self.loaded_rows: Dict[str, int] = {}  # rows loaded per table
+        self.conn.execute("CREATE TABLE IF NOT EXISTS _fake_table_labels (name TEXT PRIMARY KEY, labels TEXT)")
+
+    def _ensure_table(self, name: str, schema) -> None:
+        columns = ", ".join(
+            f"{field.name} {SQLITE_TYPES.get(field.field_type.upper(), 'TEXT')}" for field in schema
+        )
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {name} ({columns})")
+        existing = {r["name"] for r in self.conn.execute(f"PRAGMA table_info({name})")}
+        for field in schema:
+            if field.name not in existing:
+                self.conn.execute(
+                    f"ALTER TABLE {name} ADD COLUMN {field.name} {SQLITE_TYPES.get(field.field_type.upper(), 'TEXT')}"
+                )
+
+    def load_table_from_json(self, rows: List[Dict[str, Any]], table_id: str, job_config=None) -> FakeJob:
+        name = _local_table_name(table_id)
+        schema = getattr(job_config, "schema", None) or [FakeSchemaField(k, "STRING") for k in rows[0]]
+        columns = [field.name for field in schema]
+        with self.lock:
+            if getattr(job_config, "create_disposition", None) == "CREATE_NEVER" and not self.conn.execute(
+                    f"PRAGMA table_info({name})").fetchall():
+                raise google_exceptions.NotFound(f"Not found: Table {table_id} (fake)")
+            self._ensure_table(name, schema)
+            if getattr(job_config, "write_disposition", None) == "WRITE_TRUNCATE":
+                self.conn.execute(f"DELETE FROM {name}")
+            self.conn.executemany(
+                f"INSERT INTO {name} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                [tuple(row.get(c) for c in columns) for row in rows],
+            )
+            self.conn.commit()
+            self.loaded_rows[name] = self.loaded_rows.get(name, 0) + len(rows)
+        return FakeJob()
+
+    def query(self, sql: str, job_config=None, **kwargs) -> FakeJob:
+        with self.lock:
+            if ";" in sql.strip().rstrip(";"):
+                # Multi-statement scripts (e.g. BEGIN TRANSACTION; ...; COMMIT TRANSACTION;) return no rows
+                self.conn.executescript(_translate_sql(sql))
+                return FakeJob()
+            params = {p.name: p.value for p in getattr(job_config, "query_parameters", None) or []}
+            if params:
+                # Named query parameters: BigQuery's @name is sqlite's :name
+                sql = re.sub(r"@(\w+)", r":\1", sql)
+            cursor = self.conn.execute(_translate_sql(sql), params)
+            rows = [dict(r) for r in cursor.fetchall()]
+            self.conn.commit()
+        return FakeJob(rows)
+
+    def dataset(self, dataset_id: str) -> FakeDatasetRef:
+        return FakeDatasetRef(dataset_id)
+
+    def get_table(self, table_ref: str) -> FakeTable:
+        name = _local_table_name(str(table_ref))
+        with self.lock:
+            info = self.conn.execute(f"PRAGMA table_info({name})").fetchall()
+            labels = self.conn.execute("SELECT labels FROM _fake_table_labels WHERE name = ?", (name,)).fetchone()
+        if not info:
+            raise google_exceptions.NotFound(f"Not found: Table {table_ref} (fake)")
+        schema = [FakeSchemaField(r["name"], r["type"] or "STRING") for r in info]
+        return FakeTable(name, schema, json.loads(labels["labels"]) if labels else {})
+
+    def update_table(self, table: FakeTable, fields: List[str]) -> FakeTable:
+        if "labels" in fields:
+            with self.lock:
+                self.conn.execute("INSERT OR REPLACE INTO _fake_table_labels VALUES (?, ?)",
+                                  (table.table_id, json.dumps(table.labels)))
+                self.conn.commit()
+        return table
+
+
+def build_fake_clients(model_name: str = "fake-gemini"):
+    """Returns (bigquery_client, storage_client, gemini_model) backed by local stand-ins."""
+    return FakeBigQueryClient(), FakeStorageClient(), FakeGeminiModel(model_name)
+
+
+# --- SYNTHETIC DATA ---
+def write_synthetic_audio(
+    count: int,
+    bucket_name: str,
+    prefix: str = "batch_audio/",
+    root: str = FAKE_BUCKET_DIR,
+    min_seconds: float = 0.2,
+    max_seconds: float = 2.0,
+    sample_rate: int = 8000,
+    seed: int = 0,
+    duplicate_rate: float = 0.0,
+) -> List[str]:
+    """Writes `count` small mono WAV files into the fake bucket and returns their gs:// URIs.
+    With `duplicate_rate`, that share of files are re-encoded copies of an earlier file
+    (lower gain, leading silence, twice the sample rate) as produced by a re-export."""
+    rng = random.Random(seed)
+    target = Path(root) / bucket_name / prefix
+    target.mkdir(parents=True, exist_ok=True)
+    uris = []
+    originals: List[bytes] = []
+    for i in range(count):
+        path = target / f"call_{i:06d}.wav"
+        rate = sample_rate
+        if originals and rng.random() < duplicate_rate:
+            source = array.array("h", rng.choice(originals))
+            samples = array.array("h", [0] * rng.randint(0, sample_rate // 4))
+            for value in source:
+                value = int(value * 0.7)
+                samples.extend((value, value))
+            pcm = samples.tobytes()
+            rate = sample_rate * 2
+        else:
+            frames = int(sample_rate * rng.uniform(min_seconds, max_seconds))
+            pcm = rng.randbytes(frames * 2)
+            originals.append(pcm)
+        with wave.open(str(path), "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(rate)
+            w.writeframes(pcm)
+        uris.append(f"gs://{bucket_name}/{prefix}{path.name}")
+    return uris
@@ -0,0 +1,139 @@
+# hedging.py
+# Hedged Gemini requests for interactive paths. A call that is still running after the call site's usual
+# latency (HEDGE_PERCENTILE of recent calls) gets one duplicate; the first success wins and the other is
+# cancelled. A hedge budget caps duplicates at HEDGE_BUDGET_RATIO of requests so cost stays bounded, and
+# the whole exchange is bounded by the current request deadline (see deadlines.py).
+import os
+import time
+import asyncio
+import threading
+from collections import defaultdict, deque
+from typing import Deque, Dict, Optional
+import usage
+import deadlines
+import model_scheduler
+from metrics import REGISTRY, Counter
+
+# --- CONFIGURATION ---
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "1") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY_S = float(os.getenv("HEDGE_MIN_DELAY_S", "1.0"))
+HEDGE_BUDGET_RATIO = float(os.getenv("HEDGE_BUDGET_RATIO", "0.1"))  # at most one hedge per 10 requests
+HEDGE_MIN_SAMPLES = 20  # no hedging until a call site's latency is known
+LATENCY_SAMPLES = 200
+
+HEDGES = REGISTRY.register(Counter(
+    "model_hedges_total", "Hedged model requests by call site and outcome (fired, won, lost).", ("call_site", "outcome")))
+
+
+class _LatencyTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+
+    def record(self, call_site: str, seconds: float):
+        with self.lock:
+            self.samples[call_site].append(seconds)
+
+    def hedge_delay(self, call_site: str) -> Optional[float]:
+        with self.lock:
+            samples = sorted(self.samples[call_site])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY_S, samples[min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE / 100))])
+
+
+class _HedgeBudget:
+    """Token bucket: every request earns HEDGE_BUDGET_RATIO tokens, every hedge spends one."""
+
+    def __init__(self, cap: float = 10.0):
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.cap = cap
+
+    def earn(self):
+        with self.lock:
+            self.tokens = min(self.cap, self.tokens + HEDGE_BUDGET_RATIO)
+
+    def spend(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+_latency = _LatencyTracker()
+_budget = _HedgeBudget()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    # One background loop for all callers, so the SDK's async client and cancellation work from Flask threads
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="hedged-model-calls", daemon=True).start()
+        return _loop
+
+
+async def _hedge(model, priority: str, args, kwargs):
+    usage.ledger.check_budget()
+    await model_scheduler.admit_async(priority)
+    return await model.generate_content_async(*args, **kwargs)
+
+
+async def _race(model, call_site: str, timeout: Optional[float], priority: str, args, kwargs):
+    start = time.monotonic()
+    primary = asyncio.ensure_future(model.generate_content_async(*args, **kwargs))
+    pending, hedge, errors = {primary}, None, []
+    _budget.earn()
+    try:
+        delay = _latency.hedge_delay(call_site) if HEDGE_REQUESTS else None
+        if delay is not None and (timeout is None or delay < timeout):
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done and _budget.spend():
+                hedge = asyncio.ensure_future(_hedge(model, priority, args, kwargs))
+                pending.add(hedge)
+                HEDGES.inc(call_site=call_site, outcome="fired")
+        while pending:
+            left = None if timeout is None else timeout - (time.monotonic() - start)
+            if left is not None and left <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=left, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            succeeded = [task for task in done if task.exception() is None]
+            errors.extend(task.exception() for task in done if task.exception() is not None)
+            if succeeded:
+                winner = succeeded[0]
+                _latency.record(call_site, time.monotonic() - start)
+                if hedge is not None:
+                    HEDGES.inc(call_site=call_site, outcome="won" if winner is hedge else "lost")
+                return winner.result(), [task.result() for task in succeeded[1:]]
+        if errors and not pending:
+            raise errors[-1]
+        raise deadlines.DeadlineExceeded(f"{call_site} did not answer within the request deadline")
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def generate(model, model_name: str, call_site: str, *args, **kwargs):
+    """`model.generate_content(*args, **kwargs)` bounded by the request deadline and hedged after the
+    call site's usual latency. Returns the winning response; the caller records its usage as before."""
+    timeout = deadlines.remaining()
+    # The loop thread does not see the caller's context, so the hedge is admitted in the caller's class
+    priority = model_scheduler.PRIORITY.get()
+    future = asyncio.run_coroutine_threadsafe(_race(model, call_site, timeout, priority, args, kwargs), _get_loop())
+    try:
+        response, extra = future.result()
+    except BaseException:
+        future.cancel()
+        raise
+    for duplicate in extra:
+        # Both copies finished together: the duplicate was paid for, so it is accounted too
+        usage.record_response(duplicate, model_name, f"{call_site}_hedge")
+    return response
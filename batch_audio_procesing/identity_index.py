@@ -0,0 +1,123 @@
+# identity_index.py
+# Repeat-caller resolution: normalized 10-digit phone number → stable customer_id.
+# Kept in an embedded SQLite file with an in-memory cache, and caught up incrementally from BigQuery.
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+from google.api_core import exceptions as google_exceptions
+from customer_ids import WORKER_BITS, SEQUENCE_BITS
+
+# --- CONFIGURATION ---
+IDENTITY_DB = os.getenv("IDENTITY_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "identity_index.sqlite"))
+IDENTITY_SYNC_LAG_S = int(os.getenv("IDENTITY_SYNC_LAG_S", "3600"))  # re-scan IDs minted this long before the watermark
+
+
+def normalize_phone(phone: Optional[str]) -> Optional[str]:
+    """Returns the 10 digits of a complete phone number, or None ("Missing"/"Incomplete" never match)."""
+    digits = re.sub(r"\D", "", phone or "")
+    return digits if len(digits) == 10 else None
+
+
+class IdentityIndex:
+    """Thread-safe phone → customer_id map. Mappings never change once written, so the in-memory
+    cache only needs to consult SQLite on a miss (where another process may have won the insert)."""
+
+    def __init__(self, path: str = IDENTITY_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS identities (
+                phone TEXT PRIMARY KEY,
+                customer_id INTEGER NOT NULL,
+                first_seen TEXT
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS identities_by_customer ON identities (customer_id);
+            CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value INTEGER);
+        """)
+        self.cache: Dict[str, int] = dict(self.conn.execute("SELECT phone, customer_id FROM identities"))
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def lookup(self, phone: Optional[str]) -> Optional[int]:
+        key = normalize_phone(phone)
+        return self.cache.get(key) if key else None
+
+    def _claim(self, phone: str, customer_id: int) -> int:
+        # INSERT OR IGNORE + read back: whichever process inserted first owns the mapping
+        self.conn.execute(
+            "INSERT OR IGNORE INTO identities (phone, customer_id, first_seen) VALUES (?, ?, ?)",
+            (phone, customer_id, datetime.now(timezone.utc).isoformat()),
+        )
+        (owner,) = self.conn.execute("SELECT customer_id FROM identities WHERE phone = ?", (phone,)).fetchone()
+        self.cache[phone] = owner
+        return owner
+
+    def customer_id_for(self, phone: Optional[str], new_customer_id: Callable[[], int]) -> int:
+        """Returns the existing customer_id for this phone number or registers a new one.
+        Calls without a complete number always get a new ID."""
+        key = normalize_phone(phone)
+        if key is None:
+            return new_customer_id()
+        existing = self.cache.get(key)
+        if existing is not None:
+            return existing
+        with self.lock, self.conn:
+            return self._claim(key, new_customer_id())
+
+    def phones_for(self, customer_id: int) -> List[str]:
+        with self.lock:
+            return [phone for (phone,) in self.conn.execute(
+                "SELECT phone FROM identities WHERE customer_id = ? ORDER BY phone", (customer_id,)
+            )]
+
+    def sync_from_bigquery(self, bigquery_client, table_id: str) -> int:
+        """Adds mappings for rows loaded since the last sync (by any process or node).
+
+        customer_ids are time-ordered, so the largest ID seen is the watermark; the scan restarts
+        IDENTITY_SYNC_LAG_S earlier to pick up rows that other workers minted earlier but loaded later.
+        The earliest customer_id seen for a phone number wins. Returns the number of new mappings."""
+        try:
+            bigquery_client.get_table(table_id)
+        except google_exceptions.NotFound:
+            return 0  # fresh deployment: the first load creates the table, so there is nothing to catch up on
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM sync_state WHERE key = 'watermark'").fetchone()
+        watermark = row[0] if row else 0
+        since = max(watermark - ((IDENTITY_SYNC_LAG_S * 1000) << (WORKER_BITS + SEQUENCE_BITS)), 0)
+        query = (
+            f"SELECT customer_id, phone_number FROM `{table_id}` "
+            f"WHERE customer_id > {int(since)} AND LENGTH(phone_number) = 10 ORDER BY customer_id"
+        )
+        added = 0
+        with self.lock, self.conn:
+            for result in bigquery_client.query(query).result():
+                customer_id, phone = int(result["customer_id"]), normalize_phone(result["phone_number"])
+                watermark = max(watermark, customer_id)
+                if phone is None or phone in self.cache:
+                    continue
+                self._claim(phone, customer_id)
+                added += 1
+            self.conn.execute(
+                "INSERT INTO sync_state (key, value) VALUES ('watermark', ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (watermark,),
+            )
+        return added
+
+
+_index: Optional[IdentityIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> IdentityIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = IdentityIndex()
+        return _index
@@ -0,0 +1,435 @@
+# ingest_daemon.py
+# Continuous ingestion: each new recording is analyzed within seconds of landing in the bucket instead of
+# waiting for the next run of batch_processing.py and its full re-listing. Object-finalize notifications come
+# from a Pub/Sub subscription on the bucket (INGEST_SOURCE=pubsub) or, offline, from a poller watching the
+# fake bucket directory (INGEST_SOURCE=local). Redelivered notifications are deduplicated in a SQLite ledger,
+# a notification is acknowledged only once its row is loaded, and SIGTERM/SIGINT stop intake and drain the
+# work already in flight before the process exits.
+import os
+import json
+import time
+import signal
+import sqlite3
+import asyncio
+import threading
+from pathlib import Path
+from datetime import datetime
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+import batch_processing as bp
+import usage
+import metrics
+from metrics import REGISTRY, Counter, Histogram, track
+
+# --- CONFIGURATION ---
+INGEST_SOURCE = os.getenv("INGEST_SOURCE", "local" if bp.AUDIO_BACKEND == "fake" else "pubsub")
+PUBSUB_SUBSCRIPTION = os.getenv("PUBSUB_SUBSCRIPTION", "")  # projects/<project>/subscriptions/<name>
+INGEST_LEDGER_DB = os.getenv("INGEST_LEDGER_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ingest_ledger.sqlite"))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(bp.MAX_CONCURRENT_TASKS)))
+INGEST_FLUSH_S = float(os.getenv("INGEST_FLUSH_S", "2"))  # longest a finished row waits for its BigQuery load
+INGEST_POLL_S = float(os.getenv("INGEST_POLL_S", "0.5"))  # local source: directory scan interval
+INGEST_DRAIN_TIMEOUT_S = float(os.getenv("INGEST_DRAIN_TIMEOUT_S", "120"))
+INGEST_CLAIM_TTL_S = float(os.getenv("INGEST_CLAIM_TTL_S", "900"))  # a crashed daemon's claim can be retaken after this
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "5"))  # then the notification is acknowledged as failed
+INGEST_LEDGER_RETENTION_S = 7 * 24 * 3600  # Pub/Sub never redelivers older messages
+INGEST_METRICS_PORT = int(os.getenv("INGEST_METRICS_PORT", "0"))  # serve /metrics on this port; 0 = off
+
+EVENTS = REGISTRY.register(Counter(
+    "ingest_events_total",
+    "Object notifications by outcome (loaded, redelivered, busy, duplicate_recording, ignored, retried, failed, requeued).",
+    ("outcome",)))
+FRESHNESS = REGISTRY.register(Histogram(
+    "ingest_freshness_seconds", "Time from an object being written to its row being loaded."))
+
+
+@dataclass
+class ObjectEvent:
+    bucket: str
+    name: str
+    generation: str
+    size: int
+    created: float  # epoch seconds the object was written
+    ack: Callable[[], None] = field(default=lambda: None, repr=False)
+    nack: Callable[[], None] = field(default=lambda: None, repr=False)
+
+    @property
+    def uri(self) -> str:
+        return f"gs://{self.bucket}/{self.name}"
+
+    @property
+    def key(self) -> str:
+        return f"{self.uri}#{self.generation}"
+
+
+def wanted(event: ObjectEvent) -> bool:
+    """Same filter as the batch listing: audio under GCS_PREFIX and not too small."""
+    return (
+        event.name.startswith(bp.GCS_PREFIX)
+        and event.name.lower().endswith(bp.AUDIO_EXTENSIONS)
+        and event.size >= bp.MIN_AUDIO_BYTES
+    )
+
+
+class IngestLedger:
+    """(object, generation) → state. The first daemon to claim a notification processes it; notifications of
+    finished objects are acknowledged without work, and a claim older than INGEST_CLAIM_TTL_S can be retaken."""
+
+    def __init__(self, path: str = INGEST_LEDGER_DB):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS events (
+                key TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute("DELETE FROM events WHERE state != 'processing' AND updated_at < ?", (time.time() - INGEST_LEDGER_RETENTION_S,))
+
+    def claim(self, key: str) -> str:
+        """Returns "claimed", "done" (already processed or given up) or "busy" (being processed elsewhere)."""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self.conn.execute("SELECT state, updated_at FROM events WHERE key = ?", (key,)).fetchone()
+                if row is not None and row[0] in ("done", "failed"):
+                    result = "done"
+                elif row is not None and row[0] == "processing" and row[1] > now - INGEST_CLAIM_TTL_S:
+                    result = "busy"
+                else:
+                    self.conn.execute(
+                        "INSERT INTO events (key, state, updated_at) VALUES (?, 'processing', ?) "
+                        "ON CONFLICT (key) DO UPDATE SET state = 'processing', updated_at = excluded.updated_at",
+                        (key, now))
+                    result = "claimed"
+                self.conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def finish(self, keys: List[str], state: str = "done"):
+        with self.lock:
+            self.conn.executemany(
+                "UPDATE events SET state = ?, updated_at = ? WHERE key = ?", [(state, time.time(), key) for key in keys])
+
+    def release(self, key: str, failed: bool = True) -> int:
+        """Gives a claim back (counting a failed attempt). Returns the attempts so far."""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE events SET state = 'pending', updated_at = ?, attempts = attempts + ? WHERE key = ?",
+                (time.time(), int(failed), key))
+            row = self.conn.execute("SELECT attempts FROM events WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else 0
+
+
+# --- SOURCES ---
+
+class LocalSource:
+    """Stand-in for a Pub/Sub subscription: scans the fake bucket directory and delivers a finalize event for
+    every new or rewritten audio file once its size has stopped changing (mtime serves as the generation).
+    A nacked event is delivered again on a later scan; `publish` injects (re)deliveries by hand."""
+
+    def __init__(self, bucket: str = bp.GCS_BUCKET, prefix: str = bp.GCS_PREFIX, root: Optional[str] = None):
+        from fake_backends import FAKE_BUCKET_DIR
+        self.bucket = bucket
+        self.prefix = prefix
+        self.root = Path(root or FAKE_BUCKET_DIR) / bucket
+        self.delivered: Dict[str, str] = {}  # name -> generation
+        self.sizes: Dict[str, int] = {}
+        self.deliver: Optional[Callable[[ObjectEvent], None]] = None
+
+    def publish(self, event: ObjectEvent):
+        self.deliver(event)
+
+    def _event(self, name: str, stat) -> ObjectEvent:
+        generation = str(stat.st_mtime_ns)
+        def nack():
+            if self.delivered.get(name) == generation:
+                del self.delivered[name]
+        return ObjectEvent(self.bucket, name, generation, stat.st_size, stat.st_mtime, nack=nack)
+
+    def _scan(self) -> List[ObjectEvent]:
+        events = []
+        base = self.root / self.prefix
+        for path in base.rglob("*") if base.exists() else ():
+            if not path.is_file():
+                continue
+            name = path.relative_to(self.root).as_posix()
+            stat = path.stat()
+            generation = str(stat.st_mtime_ns)
+            if self.delivered.get(name) == generation:
+                continue
+            if self.sizes.get(name) != stat.st_size:
+                self.sizes[name] = stat.st_size  # still being written, or first seen: wait for one more scan
+                continue
+            self.delivered[name] = generation
+            events.append(self._event(name, stat))
+        return events
+
+    async def run(self, deliver: Callable[[ObjectEvent], None], closed: asyncio.Event):
+        self.deliver = deliver
+        print(f"👀 Watching {self.root / self.prefix} for new recordings...")
+        while not closed.is_set():
+            for event in await asyncio.to_thread(self._scan):
+                deliver(event)
+            try:
+                await asyncio.wait_for(closed.wait(), INGEST_POLL_S)
+            except asyncio.TimeoutError:
+                pass
+
+
+def parse_notification(message) -> Optional[ObjectEvent]:
+    """ObjectEvent of a Cloud Storage Pub/Sub notification, or None for other event types."""
+    attributes = message.attributes
+    if attributes.get("eventType") != "OBJECT_FINALIZE":
+        return None
+    try:
+        payload = json.loads(message.data.decode("utf-8"))
+    except ValueError:
+        payload = {}
+    created = payload.get("timeCreated")
+    try:
+        created_at = datetime.fromisoformat(created.replace("Z", "+00:00")).timestamp() if created else None
+    except ValueError:
+        created_at = None
+    return ObjectEvent(
+        attributes.get("bucketId", payload.get("bucket", "")),
+        attributes.get("objectId", payload.get("name", "")),
+        attributes.get("objectGeneration", str(payload.get("generation", ""))),
+        int(payload.get("size", 0) or 0),
+        created_at or message.publish_time.timestamp(),
+        ack=message.ack,
+        nack=message.nack,
+    )
+
+
+class PubSubSource:
+    """Streaming pull on PUBSUB_SUBSCRIPTION (a Cloud Storage notification with payload format JSON_API_V1).
+    Flow control keeps at most twice the worker count of messages leased at once."""
+
+    def __init__(self, subscription: str = PUBSUB_SUBSCRIPTION, max_messages: int = INGEST_WORKERS * 2):
+        if not subscription:
+            raise ValueError("Set PUBSUB_SUBSCRIPTION to the bucket notification subscription.")
+        self.subscription = subscription
+        self.max_messages = max_messages
+
+    async def run(self, deliver: Callable[[ObjectEvent], None], closed: asyncio.Event):
+        from google.cloud import pubsub_v1
+        loop = asyncio.get_running_loop()
+
+        def callback(message):
+            event = parse_notification(message)
+            if event is None:
+                EVENTS.inc(outcome="ignored")
+                message.ack()
+                return
+            loop.call_soon_threadsafe(deliver, event)
+
+        subscriber = pubsub_v1.SubscriberClient()
+        future = subscriber.subscribe(
+            self.subscription, callback, flow_control=pubsub_v1.types.FlowControl(max_messages=self.max_messages))
+        print(f"📬 Listening on {self.subscription}...")
+        try:
+            # The stream stays open while draining so the final acks still reach Pub/Sub
+            await closed.wait()
+        finally:
+            future.cancel()
+            try:
+                await asyncio.to_thread(future.result, 30)
+            except Exception:
+                pass
+            subscriber.close()
+
+
+def build_source():
+    if INGEST_SOURCE == "pubsub":
+        return PubSubSource()
+    if INGEST_SOURCE == "local":
+        return LocalSource()
+    raise ValueError(f"Unknown INGEST_SOURCE {INGEST_SOURCE!r} (expected pubsub or local)")
+
+
+# --- DAEMON ---
+
+class IngestDaemon:
+    def __init__(self, source, ledger: Optional[IngestLedger] = None, workers: int = INGEST_WORKERS):
+        self.source = source
+        self.ledger = ledger or IngestLedger()
+        self.workers = workers
+        self.stopping = False
+        self.queue: Optional[asyncio.Queue] = None
+        self.stopped: Optional[asyncio.Event] = None
+        self.pending: List[Tuple[ObjectEvent, Dict]] = []
+        self.awaiting_transcripts: List[Dict] = []  # TWO_PHASE: loaded rows for transcript_loop
+        self.transcripts_queued: Optional[asyncio.Event] = None
+
+    def deliver(self, event: ObjectEvent):
+        """Called by the source for every notification (on the event loop)."""
+        if self.stopping:
+            EVENTS.inc(outcome="requeued")
+            event.nack()  # another replica (or this one after a restart) picks it up
+            return
+        if not wanted(event):
+            EVENTS.inc(outcome="ignored")
+            event.ack()
+            return
+        self.queue.put_nowait(event)
+
+    def request_stop(self):
+        if not self.stopping:
+            print("\n🛑 Stopping: no new notifications are taken, in-flight work is drained...")
+            self.stopping = True
+            self.stopped.set()
+
+    async def handle(self, event: ObjectEvent):
+        state = await asyncio.to_thread(self.ledger.claim, event.key)
+        if state == "done":
+            EVENTS.inc(outcome="redelivered")
+            event.ack()
+            return
+        if state == "busy":
+            EVENTS.inc(outcome="busy")
+            event.nack()
+            return
+        try:
+            with track("ingest_event"):
+                row = None if usage.ledger.budget_exceeded else await bp.process_audio_file(event.uri)
+        except asyncio.CancelledError:
+            await asyncio.to_thread(self.ledger.release, event.key, False)
+            event.nack()
+            raise
+        if row is None:
+            attempts = await asyncio.to_thread(self.ledger.release, event.key)
+            if attempts >= INGEST_MAX_ATTEMPTS:
+                await asyncio.to_thread(self.ledger.finish, [event.key], "failed")
+                EVENTS.inc(outcome="failed")
+                print(f"❌ Giving up on {event.uri} after {attempts} attempts.")
+                event.ack()
+            else:
+                EVENTS.inc(outcome="retried")
+                event.nack()
+            return
+        if row.get("duplicate_of"):
+            await asyncio.to_thread(self.ledger.finish, [event.key])
+            EVENTS.inc(outcome="duplicate_recording")
+            event.ack()
+            return
+        self.pending.append((event, row))
+        if len(self.pending) >= bp.INSERT_CHUNK_ROWS:
+            await self.flush()
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        if await bp.insert_batch_to_bigquery([row for _, row in batch]):
+            await asyncio.to_thread(self.ledger.finish, [event.key for event, _ in batch])
+            awaiting = bp.awaiting_transcripts([row for _, row in batch])
+            if awaiting:
+                self.awaiting_transcripts.extend(awaiting)
+                self.transcripts_queued.set()
+            now = time.time()
+            for event, _ in batch:
+                FRESHNESS.observe(max(now - event.created, 0.0))
+                EVENTS.inc(outcome="loaded")
+                event.ack()
+        else:
+            for event, _ in batch:
+                await asyncio.to_thread(self.ledger.release, event.key)
+                EVENTS.inc(outcome="retried")
+                event.nack()
+
+    async def worker(self):
+        while (event := await self.queue.get()) is not None:
+            await self.handle(event)
+
+    async def transcript_loop(self):
+        """TWO_PHASE: fills in the transcripts of loaded rows in the background, one batch at a time, so
+        phase two never delays the acks. Returns once stopping and nothing is left."""
+        while True:
+            await self.transcripts_queued.wait()
+            self.transcripts_queued.clear()
+            rows, self.awaiting_transcripts = self.awaiting_transcripts, []
+            if rows:
+                try:
+                    await bp.complete_transcripts(rows)
+                except Exception as e:
+                    print(f"❌ Transcript phase failed for {len(rows)} rows: {e}")
+            if self.stopping and not self.awaiting_transcripts:
+                return
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(INGEST_FLUSH_S)
+            await self.flush()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.queue, self.stopped, self.transcripts_queued = asyncio.Queue(), asyncio.Event(), asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.request_stop)
+            except (NotImplementedError, RuntimeError):
+                pass  # e.g. Windows, or not on the main thread
+        await asyncio.to_thread(bp.sync_identity_index)
+        closed = asyncio.Event()
+        source_task = asyncio.create_task(self.source.run(self.deliver, closed))
+        workers = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+        flusher = asyncio.create_task(self.flush_loop())
+        transcriber = asyncio.create_task(self.transcript_loop())
+        print(f"🚀 Ingesting with {self.workers} workers (source: {type(self.source).__name__}).")
+        stop_requested = asyncio.create_task(self.stopped.wait())
+        await asyncio.wait([source_task, stop_requested], return_when=asyncio.FIRST_COMPLETED)
+        stop_requested.cancel()
+        if source_task.done() and source_task.exception() is not None:
+            print(f"❌ Notification source failed: {source_task.exception()}")
+        self.stopping = True
+        # Queued notifications have not been started: hand them back, then let each worker finish its current one
+        while not self.queue.empty():
+            event = self.queue.get_nowait()
+            if event is not None:
+                EVENTS.inc(outcome="requeued")
+                event.nack()
+        for _ in workers:
+            self.queue.put_nowait(None)
+        done, unfinished = await asyncio.wait(workers, timeout=INGEST_DRAIN_TIMEOUT_S)
+        for task in unfinished:
+            task.cancel()
+        await asyncio.gather(*unfinished, return_exceptions=True)
+        flusher.cancel()
+        await asyncio.gather(flusher, return_exceptions=True)
+        await self.flush()
+        closed.set()
+        # Rows already loaded still get their transcripts
+        self.transcripts_queued.set()
+        try:
+            await asyncio.wait_for(transcriber, INGEST_DRAIN_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            print(f"⚠️ {len(self.awaiting_transcripts)}+ transcripts not completed; their rows stay 'pending'.")
+        await asyncio.gather(source_task, return_exceptions=True)
+        print(f"👋 Ingestion stopped: {json.dumps(EVENTS.snapshot())}")
+
+
+def serve_metrics(port: int):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200 if self.path == "/metrics" else 404)
+            self.send_header("Content-Type", metrics.PROMETHEUS_CONTENT_TYPE)
+            self.end_headers()
+            self.wfile.write(body if self.path == "/metrics" else b"")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, name="ingest-metrics", daemon=True).start()
+    print(f"📈 Metrics on http://0.0.0.0:{port}/metrics")
+
+
+if __name__ == "__main__":
+    if INGEST_METRICS_PORT:
+        serve_metrics(INGEST_METRICS_PORT)
+    asyncio.run(IngestDaemon(build_source()).run())
@@ -0,0 +1,187 @@
+# model_router.py
+# Model cascade: every call starts on the cheapest model in MODEL_CASCADE that its input is likely to suit
+# (judged from cheap signals: audio size, transcript length, question complexity) and is repeated on the
+# next stronger model only when the answer fails validation. Escalations and the spend saved against
+# always using the strongest model are exported as metrics.
+import os
+import re
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+import usage
+from call_schema import parse_call_analysis, validate_call_analysis
+from metrics import REGISTRY, Counter
+
+# --- CONFIGURATION ---
+# Cheapest first, e.g. "gemini-2.5-flash-lite,gemini-2.5-flash,gemini-2.5-pro". Empty keeps each call site's model.
+MODEL_CASCADE = [name.strip() for name in os.getenv("MODEL_CASCADE", "").split(",") if name.strip()]
+CASCADE_AUDIO_BYTES = int(os.getenv("CASCADE_AUDIO_BYTES", str(4 * 1024 * 1024)))  # larger recordings skip a tier
+CASCADE_TRANSCRIPT_CHARS = int(os.getenv("CASCADE_TRANSCRIPT_CHARS", "6000"))
+CASCADE_QUESTION_WORDS = int(os.getenv("CASCADE_QUESTION_WORDS", "20"))
+
+# Phrases that usually need grouping, windows or several conditions in the generated SQL
+COMPLEX_QUESTION_PATTERN = re.compile(
+    r"\b(compare|comparison|versus|vs|trend|over time|per|each|by (day|week|month)|average|avg|ratio|"
+    r"percent(age)?|share|rank|top \d+|between|excluding|except|both|neither|repeat|more than|less than)\b",
+    re.IGNORECASE,
+)
+
+CASCADE_CALLS = REGISTRY.register(Counter(
+    "model_cascade_calls_total", "Routed model calls by call site and the model that answered.", ("call_site", "model")))
+ESCALATIONS = REGISTRY.register(Counter(
+    "model_cascade_escalations_total", "Answers rejected by validation and retried on a stronger model.",
+    ("call_site", "from_model", "to_model", "reason")))
+CASCADE_COST_USD = REGISTRY.register(Counter(
+    "model_cascade_cost_usd_total",
+    "Spend of routed calls (actual, all attempts) and what the answers would have cost on the strongest model (baseline).",
+    ("call_site", "kind")))
+
+_models: Dict[str, Any] = {}
+_models_lock = threading.Lock()
+
+
+def tiers(default_model: str) -> List[str]:
+    return MODEL_CASCADE or [default_model]
+
+
+def is_complex_question(question: str, previous_sql: str = "") -> bool:
+    """Follow-ups, long questions and questions with several analytical phrases go to a stronger model."""
+    if previous_sql:
+        return True
+    if len(question.split()) > CASCADE_QUESTION_WORDS:
+        return True
+    return len(COMPLEX_QUESTION_PATTERN.findall(question)) >= 2
+
+
+def plan(
+    default_model: str,
+    audio_bytes: Optional[int] = None,
+    transcript_chars: Optional[int] = None,
+    question: Optional[str] = None,
+    previous_sql: str = "",
+) -> List[str]:
+    """Models to try, in order, for one call with the given signals."""
+    models = tiers(default_model)
+    start = 0
+    if audio_bytes is not None and audio_bytes > CASCADE_AUDIO_BYTES:
+        start += 1
+    if transcript_chars is not None and transcript_chars > CASCADE_TRANSCRIPT_CHARS:
+        start += 1
+    if question is not None and is_complex_question(question, previous_sql):
+        start += 1
+    return models[min(start, len(models) - 1):]
+
+
+def get_model(name: str, default_name: str, default_model):
+    """The GenerativeModel for `name`, reusing the call site's own model (and the fake backend) where possible."""
+    if name == default_name or os.getenv("AUDIO_BACKEND", "gcp") == "fake":
+        return default_model
+    with _models_lock:
+        if name not in _models:
+            from vertexai.generative_models import GenerativeModel
+            _models[name] = GenerativeModel(name)
+        return _models[name]
+
+
+# --- VALIDATION ---
+# Checks return None for an acceptable answer, otherwise a short reason (used as a metric label).
+
+def check_phone(raw_phone: str, clean_phone_number: Optional[Callable[[str], str]] = None) -> Optional[str]:
+    """Digits were heard but do not clean up to a number: the model probably misheard or invented them.
+    Without the caller's `clean_phone_number`, 7 to 10 digits count as plausible."""
+    digits = re.sub(r"\D", "", raw_phone or "")
+    if not digits:
+        return None
+    if clean_phone_number is None:
+        return None if 7 <= len(digits) <= 10 else "implausible_phone"
+    return "implausible_phone" if clean_phone_number(raw_phone) == "Missing phone number" else None
+
+
+def check_call_analysis(
+    text: str,
+    clean_phone_number: Callable[[str], str],
+    exclude: Sequence[str] = (),
+    require_transcript: bool = False,
+) -> Optional[str]:
+    """Schema, enum values and phone-number plausibility of one call analysis response."""
+    parsed, error = parse_call_analysis(text, exclude)
+    if error:
+        return "invalid_json" if error.startswith("No JSON") else "schema"
+    if require_transcript and not parsed.get("full_transcript", "").strip():
+        return "empty_transcript"
+    return check_phone(parsed.get("phone_number", ""), clean_phone_number)
+
+
+def check_analysis_fields(data: Dict[str, Any], clean_phone_number: Optional[Callable[[str], str]] = None) -> Optional[str]:
+    """`check_call_analysis` for an already-parsed dict without a transcript."""
+    parsed, error = validate_call_analysis(data, exclude=("full_transcript",))
+    if error:
+        return "schema"
+    return check_phone(parsed.get("phone_number", ""), clean_phone_number)
+
+
+def check_sql(text: str, allow_none: bool = False) -> Optional[str]:
+    sql = text.strip().replace("```sql", "").replace("```", "").strip()
+    if allow_none and sql.upper() == "NONE":
+        return None
+    if not sql.lower().startswith(("select", "with")):
+        return "not_sql"
+    return None
+
+
+def check_text(text: str) -> Optional[str]:
+    return None if text.strip() else "empty"
+
+
+# --- CASCADE ---
+
+def _record(call_site: str, model: str, spent: List[Optional[Dict[str, Any]]], final_usage: Optional[Dict[str, Any]]):
+    CASCADE_CALLS.inc(call_site=call_site, model=model)
+    actual = sum((u or {}).get("cost_usd", 0) for u in spent)
+    baseline = actual
+    if final_usage:
+        baseline = usage.price_tokens(
+            MODEL_CASCADE[-1] if MODEL_CASCADE else model,
+            final_usage.get("text_tokens", 0), final_usage.get("audio_tokens", 0), final_usage.get("output_tokens", 0))
+    CASCADE_COST_USD.inc(actual, call_site=call_site, kind="actual")
+    CASCADE_COST_USD.inc(baseline, call_site=call_site, kind="baseline")
+
+
+def run(
+    call_site: str,
+    models: List[str],
+    attempt: Callable[[str], Tuple[Any, Optional[Dict[str, Any]]]],
+    check: Callable[[Any], Optional[str]],
+) -> Tuple[Any, Optional[Dict[str, Any]], str]:
+    """Calls `attempt(model)` -> (answer, token_usage) on each model in turn until `check(answer)` passes.
+    Returns (answer, token_usage, model); the strongest model's answer is returned even if it fails too."""
+    spent = []
+    for i, model in enumerate(models):
+        answer, token_usage = attempt(model)
+        spent.append(token_usage)
+        reason = check(answer)
+        if reason is None or i == len(models) - 1:
+            break
+        ESCALATIONS.inc(call_site=call_site, from_model=model, to_model=models[i + 1], reason=reason)
+        print(f"⤴️ {call_site}: {model} answer rejected ({reason}); escalating to {models[i + 1]}.")
+    _record(call_site, model, spent, token_usage)
+    return answer, token_usage, model
+
+
+async def run_async(
+    call_site: str,
+    models: List[str],
+    attempt: Callable[[str], Awaitable[Tuple[Any, Optional[Dict[str, Any]]]]],
+    check: Callable[[Any], Optional[str]],
+) -> Tuple[Any, Optional[Dict[str, Any]], str]:
+    """`run` for coroutine attempts."""
+    spent = []
+    for i, model in enumerate(models):
+        answer, token_usage = await attempt(model)
+        spent.append(token_usage)
+        reason = check(answer)
+        if reason is None or i == len(models) - 1:
+            break
+        ESCALATIONS.inc(call_site=call_site, from_model=model, to_model=models[i + 1], reason=reason)
+        print(f"⤴️ {call_site}: {model} answer rejected ({reason}); escalating to {models[i + 1]}.")
+    _record(call_site, model, spent, token_usage)
+    return answer, token_usage, model
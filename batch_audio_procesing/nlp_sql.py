@@ -1,9 +1,26 @@
 import os
+import re
 import json
+import html
+import time
 from google.cloud import bigquery
+from google.api_core import exceptions as google_exceptions
 from vertexai import init
 from vertexai.generative_models import GenerativeModel
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
+from metrics import track
+import usage
+import model_scheduler
+import model_router
+import hedging
+import deadlines
+import identity_index
+import transcript_index
+import call_vectors
+import sessions
+import replica
+import transcript_store
+import rollups
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -12,22 +29,38 @@ BIGQUERY_PROJECT_ID = # your Google Cloud Project ID
 BIGQUERY_DATASET = # your BigQuery Dataset name
 BIGQUERY_TABLE = # your BigQuery Table name
 GEMINI_MODEL = "gemini-2.5-flash"  # Fast & cost-efficient
+BIGQUERY_ROLLUP_TABLE = os.getenv("BIGQUERY_ROLLUP_TABLE", f"{BIGQUERY_TABLE}_daily_rollup")  # see rollups.py
+AUDIO_BACKEND = os.getenv("AUDIO_BACKEND", "gcp")  # "gcp" or "fake" (offline stand-ins from fake_backends.py)
 
 # --- INITIALIZE VERTEX AI CLIENTS ---
 try:
-    # Authenticate with Application Default Credentials (ADC)
-    # Ensure you've run: gcloud auth application-default login
-    init(project=BIGQUERY_PROJECT_ID, location="us-central1")
-
-    gemini_model = GenerativeModel(GEMINI_MODEL)
-    bigquery_client = bigquery.Client(project=BIGQUERY_PROJECT_ID)
-
-    print("✅ Vertex AI Gemini and BigQuery initialized successfully.")
+    if AUDIO_BACKEND == "fake":
+        from fake_backends import build_fake_clients
+        bigquery_client, _, gemini_model = build_fake_clients(GEMINI_MODEL)
+    else:
+        # Authenticate with Application Default Credentials (ADC)
+        # Ensure you've run: gcloud auth application-default login
+        init(project=BIGQUERY_PROJECT_ID, location="us-central1")
+
+        gemini_model = GenerativeModel(GEMINI_MODEL)
+        bigquery_client = bigquery.Client(project=BIGQUERY_PROJECT_ID)
+
+    print(f"✅ Vertex AI Gemini and BigQuery initialized successfully ({AUDIO_BACKEND} backend).")
 except Exception as e:
     print(f"❌ Error initializing clients: {e}")
     print("Make sure you have run 'gcloud auth application-default login' and have the right project access.")
     exit()
 
+# --- HELPER: MODEL CALL ---
+def generate(model_name: str, call_site: str, prompt: str):
+    """One budgeted, scheduled and hedged Gemini call. Returns (text, token_usage)."""
+    usage.ledger.check_budget()
+    model_scheduler.admit()
+    model = model_router.get_model(model_name, GEMINI_MODEL, gemini_model)
+    response = hedging.generate(model, model_name, call_site, prompt)
+    token_usage = usage.record_response(response, model_name, call_site)
+    return response.text.strip(), token_usage
+
 # --- HELPER: FETCH SCHEMA ---
 def get_table_schema(project_id: str, dataset_id: str, table_id: str) -> str:
     """Retrieves and formats the BigQuery table schema for Gemini prompt."""
@@ -41,11 +74,240 @@ def get_table_schema(project_id: str, dataset_id: str, table_id: str) -> str:
         print(f"Error fetching BigQuery schema: {e}")
         return "Error: Could not retrieve schema."
 
+# --- HELPER: REPEAT-CALLER LOOKUP ---
+def identity_hints(question: str) -> str:
+    """Maps 10-digit phone numbers in the question to their customer_id so per-customer
+    questions filter on the key instead of scanning phone_number strings."""
+    hints = []
+    try:
+        index = identity_index.get_index()
+        for phone in re.findall(r"(?<!\d)\d{10}(?!\d)", question):
+            customer_id = index.lookup(phone)
+            if customer_id is not None:
+                hints.append(
+                    f"    - Phone number {phone} belongs to customer_id {customer_id}. For this customer's calls "
+                    f"or history filter with customer_id = {customer_id} instead of matching phone_number."
+                )
+    except Exception as e:
+        print(f"Identity lookup skipped: {e}")
+    return "\n".join(hints)
+
+# --- KEYWORD SEARCH (local transcript index) ---
+KEYWORD_TRIGGER = re.compile(
+    r"\b(?:mention(?:s|ed|ing)?|contain(?:s|ed|ing)?|say(?:s|ing)?|said|talk(?:s|ed|ing)?\s+about|"
+    r"keywords?|transcripts?\s+(?:with|about|containing|including))\b\s*(?P<terms>.+)$",
+    re.IGNORECASE,
+)
+KEYWORD_STOPWORDS = {
+    "a", "an", "the", "word", "words", "term", "terms", "phrase", "keyword", "keywords", "in", "their",
+    "transcript", "transcripts", "call", "calls", "of", "to", "about", "any", "please", "and", "or", "something",
+}
+PROBLEM_TYPES = {"network": "Network", "recharge": "Recharge", "payment": "Payment"}
+PROBLEM_STATES = {"pending": "Pending", "unsolved": "Pending", "unresolved": "Pending", "solved": "Solved", "resolved": "Solved"}
+
+
+def parse_keyword_question(question: str) -> Optional[Dict[str, Any]]:
+    """Recognizes "calls that mention roaming" / 'transcripts with "sim swap"' style questions.
+    Category words before the keyword part (e.g. "pending network calls mentioning ...") become filters."""
+    quoted = re.findall(r'"([^"]+)"|“([^”]+)”', question)
+    trigger = KEYWORD_TRIGGER.search(question)
+    if not trigger and not quoted:
+        return None
+    head = question[:trigger.start()] if trigger else re.sub(r'"[^"]*"|“[^”]*”', " ", question)
+    tail = trigger.group("terms") if trigger else ""
+    terms = [a or b for a, b in quoted]
+    unquoted = re.sub(r'"[^"]*"|“[^”]*”', " ", tail)
+    terms += [w for w in re.findall(r"[\w'-]+", unquoted.lower()) if w not in KEYWORD_STOPWORDS]
+    if not terms:
+        return None
+    head_words = re.findall(r"\w+", head.lower())
+    return {
+        "terms": terms,
+        "any_term": bool(re.search(r"\bor\b", tail, re.IGNORECASE)),
+        "problem_type": next((PROBLEM_TYPES[w] for w in head_words if w in PROBLEM_TYPES), None),
+        "problem_solved": next((PROBLEM_STATES[w] for w in head_words if w in PROBLEM_STATES), None),
+        "count_only": bool(re.search(r"\bhow many\b|\bcount\b|\bnumber of\b", head, re.IGNORECASE)),
+    }
+
+
+def answer_keyword_question(question: str, limit: int = 10) -> Optional[Dict[str, Any]]:
+    """Answers keyword questions from the local FTS index in milliseconds, without BigQuery or Gemini.
+    Returns None when the question is not keyword-style or the index is empty (the SQL path answers it)."""
+    parsed = parse_keyword_question(question)
+    if parsed is None:
+        return None
+    index = transcript_index.get_index()
+    if len(index) == 0:
+        return None
+    with track("transcript_search"):
+        found = index.search(parsed["terms"], parsed["any_term"], parsed["problem_type"], parsed["problem_solved"],
+                             limit=limit, highlight=("\x02", "\x03"))
+    joiner = " or " if parsed["any_term"] else " and "
+    label = joiner.join(f"'{html.escape(term)}'" for term in parsed["terms"])
+    scope = " ".join(filter(None, [parsed["problem_solved"], parsed["problem_type"]]))
+    lines = [f"{found['total']} {scope + ' ' if scope else ''}call(s) mention {label}."]
+    if not parsed["count_only"]:
+        for n, match in enumerate(found["matches"], 1):
+            snippet = html.escape(match["snippet"] or "").replace("\x02", "<mark>").replace("\x03", "</mark>")
+            lines.append(
+                f"{n}. Customer {match['customer_id']} ({html.escape(str(match['phone_number']))}) — "
+                f"{html.escape(str(match['problem_type']))}, {html.escape(str(match['problem_solved']))}: {snippet}"
+            )
+        if found["total"] > len(found["matches"]):
+            lines.append(f"Showing the {len(found['matches'])} best matches.")
+    for match in found["matches"]:
+        match["snippet"] = (match["snippet"] or "").replace("\x02", "").replace("\x03", "")
+    return {"response": "\n".join(lines), "total": found["total"], "matches": found["matches"], "query": parsed}
+
+# --- SIMILAR CALLS (local vectors) ---
+SIMILARITY_QUESTION = re.compile(
+    r"\b(?:like|similar\s+to|resembl\w*|similar\s+(?:calls?|cases?|issues?)\s+(?:to|for|as))\s+"
+    r"(?:(?:the\s+)?(?:calls?|cases?|ones?)\s+(?:of|from|by)\s+|(?:that|those)\s+of\s+)?customer(?:[\s_]*id)?\s*(?:#|no\.?|number)?\s*(?P<customer_id>\d+)",
+    re.IGNORECASE,
+)
+
+
+def answer_similarity_question(question: str, limit: int = 10) -> Optional[Dict[str, Any]]:
+    """Answers "calls like customer 20462" from the local vector index, without BigQuery or Gemini.
+    Returns None when the question is not a similarity question or the index is empty."""
+    found = SIMILARITY_QUESTION.search(question)
+    if not found:
+        return None
+    index = call_vectors.get_index()
+    if len(index) == 0:
+        return None
+    customer_id = int(found.group("customer_id"))
+    with track("similar_calls"):
+        matches = index.similar_to_customer(customer_id, limit)
+    if matches is None:
+        return {"response": f"No analyzed calls from customer {customer_id} are indexed yet.", "matches": []}
+    lines = [f"Calls most similar to customer {customer_id}'s calls:"]
+    for n, match in enumerate(matches, 1):
+        lines.append(
+            f"{n}. Customer {match['customer_id']} ({html.escape(str(match['phone_number']))}) — "
+            f"{html.escape(str(match['problem_type']))}, {html.escape(str(match['problem_solved']))}, "
+            f"similarity {match['similarity']:.2f}: {html.escape(str(match['sentiment']))}"
+        )
+    return {"response": "\n".join(lines), "matches": matches}
+
+# --- FOLLOW-UPS (session result cache) ---
+def fetch_call_columns(customer_ids: List[int], columns: List[str]) -> List[Dict[str, Any]]:
+    """Point lookup of extra columns for calls already in a session's result set."""
+    columns = [c for c in columns if c in transcript_index.FIELDS and c != "customer_id"]
+    if "full_transcript" in columns and transcript_store.enabled():
+        columns.append("transcript_uri")  # offloaded transcripts are fetched by execute_query
+    ids = ", ".join(str(int(customer_id)) for customer_id in customer_ids)
+    if not columns or not ids:
+        return []
+    return execute_query(
+        f"SELECT customer_id, {', '.join(columns)} FROM `{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}` "
+        f"WHERE customer_id IN ({ids})"
+    )
+
+
+def answer_follow_up(session: "sessions.Session", question: str) -> Optional[str]:
+    """Answers a follow-up about the session's previous result set locally, without Gemini.
+    Returns None when the question needs new data (the SQL path answers it)."""
+    with track("session_follow_up"):
+        answer = sessions.answer_follow_up(session, question, fetch=fetch_call_columns)
+    return html.escape(answer, quote=False) if answer is not None else None
+
+# --- DASHBOARD QUESTIONS (daily rollup table) ---
+AGGREGATE_QUESTION = re.compile(
+    r"\b(?:how many|count|counts|number of|total|breakdown|break down|distribution|percent\w*|ratio|share|"
+    r"proportion|trend\w*|per day|daily|by day|each day|per week|weekly|per month|monthly|over time|"
+    r"most common|least common|compare|vs|versus|statistics|stats|summary|summari[sz]e)\b",
+    re.IGNORECASE,
+)
+ROW_LEVEL_QUESTION = re.compile(
+    r"\b(?:transcripts?|phone|customers?|callers?|customer_id|mention\w*|contain\w*|sa(?:y|ys|id)|who|list|"
+    r"details?|names?|unique|distinct)\b|\d{5,}",
+    re.IGNORECASE,
+)
+ROLLUP_RECHECK_S = 300  # a rollup table that is missing or not rebuilt yet is looked up again after this long
+_rollup_available = False
+_rollup_checked_at = 0.0
+
+
+def is_aggregate_question(question: str) -> bool:
+    """Counts by category, status, sentiment or day that never need an individual call."""
+    return bool(AGGREGATE_QUESTION.search(question)) and not ROW_LEVEL_QUESTION.search(question)
+
+
+def rollup_sql(question: str) -> str:
+    """Writes SQL against the rollup table, or returns "" when it cannot answer the question."""
+    global _rollup_available, _rollup_checked_at
+    rollup_table = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_ROLLUP_TABLE}"
+    # Only a rebuilt table is remembered for good: `rollups.py --rebuild` may run after startup
+    if not _rollup_available and time.monotonic() - _rollup_checked_at >= ROLLUP_RECHECK_S:
+        _rollup_checked_at = time.monotonic()
+        try:
+            _rollup_available = rollups.is_rebuilt(bigquery_client, rollup_table)
+        except Exception as e:
+            print(f"Error checking the rollup table: {e}")
+    if not _rollup_available:
+        return ""
+    prompt = f"""
+    You are an expert BigQuery SQL translator. Answer the question from a pre-aggregated rollup table.
+
+    Table `{rollup_table}`, one row per group with its number of calls:
+      day (DATE, UTC day the call was analyzed; NULL for older calls of unknown date),
+      problem_type (STRING: Network, Recharge, Payment),
+      problem_solved (STRING: Pending, Solved),
+      sentiment_label (STRING: positive, negative, mixed, neutral),
+      call_count (INTEGER), compacted (BOOLEAN, ignore it)
+
+    User Question: "{question}"
+
+    Rules:
+    - Return only the SQL query (no explanations or markdown).
+    - Several rows can share the same group: always aggregate with SUM(call_count), never COUNT(*).
+    - Compare problem_type / problem_solved with LOWER(), e.g. LOWER(problem_type) = 'network'.
+    - "unsolved", "unresolved", "pending" → Pending; "resolved", "fixed" → Solved.
+    - Good/happy/satisfied → sentiment_label = 'positive'; bad/angry/frustrated → 'negative'.
+    - For trends group by day (or DATE_TRUNC(day, WEEK/MONTH)) and ORDER BY it; "today" is CURRENT_DATE().
+    - For "most common" or "top", ORDER BY the sum DESC and LIMIT.
+    - If the question cannot be answered from these columns alone, return exactly: NONE
+    """
+    print("-> Converting NL to rollup SQL using Gemini...")
+    with track("nl_to_sql"):
+        text, _, _ = model_router.run(
+            "nl_to_sql_rollup",
+            model_router.plan(GEMINI_MODEL, question=question),
+            lambda model_name: generate(model_name, "nl_to_sql_rollup", prompt),
+            lambda text: model_router.check_sql(text, allow_none=True),
+        )
+    sql_query = text.replace("```sql", "").replace("```", "").strip()
+    if sql_query.upper() == "NONE" or not sql_query.lower().startswith(("select", "with")):
+        return ""
+    return sql_query
+
 # --- 1️⃣ NL → SQL ---
-def nl_to_sql(question: str, schema_info: str) -> str:
+def nl_to_sql(question: str, schema_info: str, previous_sql: str = "") -> str:
     """
     Converts a user's natural language question into a BigQuery SQL query.
+    Dashboard-style aggregates are answered from the daily rollup table when it exists.
+    `previous_sql` is the query behind the session's last answer, for questions that refer back to it.
     """
+    offload_rule = """
+    - Full transcripts of newer calls are stored outside the table: their full_transcript is NULL and
+      transcript_uri, transcript_length and transcript_excerpt (the first few hundred characters) are set.
+      Whenever you select full_transcript, also select transcript_uri (the text is fetched for you).
+      For keyword conditions on the transcript use LOWER(COALESCE(full_transcript, transcript_excerpt)).
+      Do not select full_transcript or use SELECT * unless the user asks to see transcripts.
+""" if transcript_store.enabled() else ""
+    follow_up = previous_sql and sessions.FOLLOW_UP_CUE.search(question)
+    follow_up_rule = f"""
+    - This is a follow-up question. "Those", "them", "these" etc. refer to the rows returned by the previous query:
+      {previous_sql}
+      Restrict the new query to those rows (reuse its conditions).
+""" if follow_up else ""
+    if is_aggregate_question(question) and not follow_up:
+        sql_query = rollup_sql(question)
+        if sql_query:
+            return sql_query
+
+    customer_hints = identity_hints(question)
     prompt = f"""
     You are an expert BigQuery SQL translator.
     Convert the user's natural language question into a valid BigQuery Standard SQL query.
@@ -79,7 +341,7 @@ def nl_to_sql(question: str, schema_info: str) -> str:
     - If user includes "network issue", "network problem", or "network related to recharge":
         • Apply `LOWER(problem_type) = 'network'`
         • If user also mentions recharge, add transcript keyword search:
-            AND LOWER(transcript) LIKE '%recharge%'
+            AND LOWER(full_transcript) LIKE '%recharge%'
 
     - Map user phrases to problem_solved:
           • "unsolved", "not solved", "unresolved", "pending issue" → `LOWER(problem_solved) = 'pending'`
@@ -118,6 +380,8 @@ def nl_to_sql(question: str, schema_info: str) -> str:
     - If user says "invalid phone number", treat it same as "Incomplete phone number".
     - If user asks for "phone number present", return only rows where LENGTH(phone_number) = 10.
     - If user asks for "all phone numbers", return customer_id and phone_number only.
+    - A customer_id identifies a caller across all of their calls (repeat callers share it).
+{customer_hints}{offload_rule}{follow_up_rule}
 
 
 
@@ -125,17 +389,43 @@ def nl_to_sql(question: str, schema_info: str) -> str:
 
     print("-> Converting NL to SQL using Gemini...")
 
-    response = gemini_model.generate_content(prompt)
-    sql_query = response.text.strip().replace("```sql", "").replace("```", "").strip()
+    with track("nl_to_sql"):
+        text, _, _ = model_router.run(
+            "nl_to_sql",
+            model_router.plan(GEMINI_MODEL, question=question, previous_sql=previous_sql if follow_up else ""),
+            lambda model_name: generate(model_name, "nl_to_sql", prompt),
+            model_router.check_sql,
+        )
+    sql_query = text.replace("```sql", "").replace("```", "").strip()
 
     return sql_query
 
 # --- 2️⃣ Execute SQL ---
 def execute_query(sql_query: str) -> List[Dict[str, Any]]:
-    """Executes SQL query in BigQuery and returns rows as list of dicts."""
+    """Executes SQL query in BigQuery and returns rows as list of dicts.
+    With QUERY_ENGINE=replica, queries on the call table run on the local replica first (see replica.py).
+    Offloaded transcripts are fetched for the first rows that point to one (see transcript_store.py)."""
     print(f"-> Executing SQL: {sql_query}")
-    query_job = bigquery_client.query(sql_query)
-    return [dict(row) for row in query_job]
+    rows = replica.query(sql_query, f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}")
+    if rows is None:
+        # Inside a request, BigQuery cancels the job itself once the request deadline has passed
+        timeout = deadlines.remaining()
+        job_config = bigquery.QueryJobConfig(job_timeout_ms=int(timeout * 1000)) if timeout else None
+        try:
+            with track("bigquery_query"):
+                query_job = bigquery_client.query(sql_query, job_config=job_config, timeout=timeout)
+                rows = [dict(row) for row in query_job.result(timeout=deadlines.remaining())]
+        except deadlines.DeadlineExceeded:
+            raise
+        except Exception as e:
+            # A result wait that ran out, or a job BigQuery cancelled at job_timeout_ms, is the request deadline
+            if timeout is not None and (isinstance(e, (TimeoutError, google_exceptions.DeadlineExceeded)) or deadlines.expired()):
+                raise deadlines.DeadlineExceeded("BigQuery query did not finish within the request deadline") from e
+            raise
+    if transcript_store.enabled():
+        with track("transcript_fetch"):
+            transcript_store.hydrate(rows)
+    return rows
 
 # --- 3️⃣ Interpret Results (SQL → Natural Language) ---
 def interpret_results(question: str, raw_result: List[Dict[str, Any]]) -> str:
@@ -195,8 +485,14 @@ def interpret_results(question: str, raw_result: List[Dict[str, Any]]) -> str:
     """
 
     print("-> Interpreting results using Gemini...")
-    response = gemini_model.generate_content(prompt)
-    return response.text.strip()
+    with track("interpret_results"):
+        text, _, _ = model_router.run(
+            "interpret_results",
+            model_router.plan(GEMINI_MODEL, transcript_chars=len(prompt)),
+            lambda model_name: generate(model_name, "interpret_results", prompt),
+            model_router.check_text,
+        )
+    return text
 
 # --- 4️⃣ INTERACTIVE CONSOLE LOOP ---
 def interactive_nl2sql_analysis():
@@ -210,6 +506,7 @@ def interactive_nl2sql_analysis():
     print(f"Connected to: {BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}")
     print("Ask questions about customer calls, e.g., 'What is the most common problem type?'")
     print("Type 'exit' or 'quit' to stop.\n")
+    session = sessions.store.get(None)
 
     while True:
         user_input = input("Your Question > ").strip()
@@ -220,12 +517,20 @@ def interactive_nl2sql_analysis():
             continue
 
         try:
-            sql_query = nl_to_sql(user_input, schema)
+            follow_up = answer_follow_up(session, user_input)
+            if follow_up is not None:
+                print("\n--- Answer ---")
+                print(html.unescape(follow_up))
+                print("--------------\n")
+                continue
+
+            sql_query = nl_to_sql(user_input, schema, session.previous_sql)
             if not sql_query.lower().startswith("select"):
                 print("⚠️ Gemini did not produce a SELECT query. Try rephrasing your question.")
                 continue
 
             query_results = execute_query(sql_query)
+            session.remember(user_input, query_results, sql_query)
             if not query_results:
                 print("ℹ️ Query executed successfully but returned no results.")
                 continue
@@ -0,0 +1,372 @@
+# replica.py
+# Local columnar replica of the call table: Parquet files queried in-process with DuckDB. With
+# QUERY_ENGINE=replica, ingest appends every committed batch as a Parquet part, and execute_query runs the
+# BigQuery SQL from nl_to_sql against the replica (translated to DuckDB's dialect). Anything the replica
+# cannot answer (other tables, unsupported syntax, a stale copy) falls back to BigQuery.
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from metrics import track, FAILURES
+
+# --- CONFIGURATION ---
+QUERY_ENGINE = os.getenv("QUERY_ENGINE", "bigquery").lower()  # "replica" maintains and queries the local copy
+REPLICA_DIR = os.getenv("REPLICA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "calls_replica"))
+REPLICA_MAX_AGE_S = int(os.getenv("REPLICA_MAX_AGE_S", "86400"))  # time since the last full refresh; 0 = no limit
+REPLICA_MAX_PARTS = int(os.getenv("REPLICA_MAX_PARTS", "64"))  # appended parts are merged beyond this
+EXPORT_CHUNK_ROWS = 200_000
+COLUMNS = {
+    "customer_id": "BIGINT",
+    "phone_number": "VARCHAR",
+    "full_transcript": "VARCHAR",
+    "problem_solved": "VARCHAR",
+    "problem_type": "VARCHAR",
+    "sentiment": "VARCHAR",
+    "transcript_uri": "VARCHAR",  # set when transcripts are offloaded (see transcript_store.py)
+    "transcript_length": "BIGINT",
+    "transcript_excerpt": "VARCHAR",
+    "source_uri": "VARCHAR",  # set in two-phase mode (see two_phase.py); phase two updates rows by it
+    "transcript_status": "VARCHAR",
+}
+MANIFEST = "manifest.json"
+LOCK_STALE_S = 120
+
+_duckdb = None
+_warned = False
+
+
+def enabled() -> bool:
+    """True when QUERY_ENGINE=replica and DuckDB is installed (it is an optional dependency)."""
+    global _duckdb, _warned
+    if QUERY_ENGINE != "replica":
+        return False
+    if _duckdb is None:
+        try:
+            import duckdb
+            _duckdb = duckdb
+        except ImportError:
+            if not _warned:
+                print("⚠️ QUERY_ENGINE=replica needs `pip install duckdb`; using BigQuery.")
+                _warned = True
+            return False
+    return True
+
+
+# --- STORAGE ---
+_thread_lock = threading.Lock()
+
+
+@contextmanager
+def _locked():
+    """Serializes manifest updates across threads and processes sharing REPLICA_DIR."""
+    os.makedirs(REPLICA_DIR, exist_ok=True)
+    path = os.path.join(REPLICA_DIR, ".lock")
+    with _thread_lock:
+        while True:
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(path) > LOCK_STALE_S:
+                        os.remove(path)  # left behind by a crashed writer
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            os.remove(path)
+
+
+def read_manifest() -> Dict[str, Any]:
+    try:
+        with open(os.path.join(REPLICA_DIR, MANIFEST), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"files": [], "refreshed_at": 0}
+
+
+def _write_manifest(manifest: Dict[str, Any]):
+    path = os.path.join(REPLICA_DIR, MANIFEST)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def _copy_to_parquet(select_sql: str, prefix: str, conn=None, stamp: Optional[str] = None) -> str:
+    """Writes the result of a DuckDB SELECT to a new Parquet file in REPLICA_DIR; returns its name. The
+    name carries `stamp` (default: now, in milliseconds), which refresh_from_bigquery compares."""
+    name = f"{prefix}-{stamp or int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}.parquet"
+    path = os.path.join(REPLICA_DIR, name)
+    own = conn is None
+    conn = conn or _duckdb.connect()
+    try:
+        conn.execute(f"COPY ({select_sql}) TO '{path}.tmp' (FORMAT parquet, COMPRESSION zstd)")
+    finally:
+        if own:
+            conn.close()
+    os.replace(path + ".tmp", path)
+    return name
+
+
+@contextmanager
+def _staged(rows: List[Dict[str, Any]], names: Iterable[str]):
+    """Yields a DuckDB expression reading `rows` (only the columns `names`) from a staging file."""
+    # Rows go through newline-delimited JSON so DuckDB loads them in one vectorized read
+    names = list(names)
+    staging = os.path.join(REPLICA_DIR, f".{uuid.uuid4().hex}.jsonl")
+    with open(staging, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps({name: row.get(name) for name in names}) + "\n")
+    columns = ", ".join(f"'{name}': '{COLUMNS[name]}'" for name in names)
+    try:
+        yield f"read_json('{staging}', format='newline_delimited', columns={{{columns}}})"
+    finally:
+        os.remove(staging)
+
+
+def _write_rows(rows: List[Dict[str, Any]], prefix: str) -> str:
+    with _staged(rows, COLUMNS) as source:
+        return _copy_to_parquet(f"SELECT * FROM {source}", prefix)
+
+
+def _merge(files: List[str], prefix: str) -> str:
+    paths = ", ".join(f"'{os.path.join(REPLICA_DIR, name)}'" for name in files)
+    return _copy_to_parquet(f"SELECT * FROM read_parquet([{paths}], union_by_name = true)", prefix)
+
+
+def _remove(files: Iterable[str]):
+    for name in files:
+        try:
+            os.remove(os.path.join(REPLICA_DIR, name))
+        except FileNotFoundError:
+            pass
+
+
+def append_rows(rows: List[Dict[str, Any]]):
+    """Appends freshly loaded rows as a Parquet part. The replica is a derived copy, so failures are
+    logged and never fail ingest (the next refresh repairs it, and a stale copy falls back to BigQuery)."""
+    rows = [row for row in rows if not row.get("duplicate_of")]
+    if not rows or not enabled():
+        return
+    try:
+        with _locked():
+            manifest = read_manifest()
+            manifest["files"].append(_write_rows(rows, "part"))
+            merged = []
+            if len(manifest["files"]) > REPLICA_MAX_PARTS:
+                merged = manifest["files"]
+                manifest["files"] = [_merge(merged, "base")]
+            _write_manifest(manifest)
+            _remove(merged)
+    except Exception as e:
+        print(f"⚠️ Could not update the query replica: {e}")
+
+
+def update_rows(updates: List[Dict[str, Any]]):
+    """Applies phase-two updates (see two_phase.update_transcripts) to rows already in the replica,
+    matched on source_uri. Only the parts holding those rows are rewritten; like append_rows, failures
+    are logged and never fail ingest."""
+    updates = [row for row in updates if row.get("source_uri")]
+    if not updates or not enabled():
+        return
+    columns = sorted({name for row in updates for name in row if name in COLUMNS} - {"source_uri"})
+    try:
+        with _locked():
+            manifest = read_manifest()
+            rewritten = {}
+            conn = _duckdb.connect()
+            try:
+                with _staged(updates, ["source_uri", *columns]) as source:
+                    conn.execute(f"CREATE TEMP TABLE updates AS SELECT * FROM {source}")
+                for name in manifest["files"]:
+                    path = os.path.join(REPLICA_DIR, name)
+                    present = {row[0] for row in conn.execute(f"DESCRIBE SELECT * FROM read_parquet('{path}')").fetchall()}
+                    if "source_uri" not in present or not conn.execute(
+                            f"SELECT 1 FROM read_parquet('{path}') WHERE source_uri IN (SELECT source_uri FROM updates) LIMIT 1"
+                    ).fetchone():
+                        continue
+                    conn.execute(f"CREATE OR REPLACE TEMP TABLE part AS SELECT * FROM read_parquet('{path}')")
+                    for column in columns:
+                        if column not in present:
+                            conn.execute(f"ALTER TABLE part ADD COLUMN {column} {COLUMNS[column]}")
+                    assignments = ", ".join(f"{column} = updates.{column}" for column in columns)
+                    conn.execute(f"UPDATE part SET {assignments} FROM updates WHERE part.source_uri = updates.source_uri")
+                    # The rewrite keeps the part's original stamp, so a running refresh still sees its age
+                    prefix, stamp = name.split("-")[:2]
+                    rewritten[name] = _copy_to_parquet("SELECT * FROM part", prefix, conn, stamp)
+            finally:
+                conn.close()
+            if rewritten:
+                manifest["files"] = [rewritten.get(name, name) for name in manifest["files"]]
+                _write_manifest(manifest)
+                _remove(rewritten)
+    except Exception as e:
+        print(f"⚠️ Could not update the query replica: {e}")
+
+
+def refresh_from_bigquery(bigquery_client, table_id: str) -> int:
+    """Replaces the replica with a full export of the call table. Parts appended while the export runs
+    are kept. Returns the number of rows exported."""
+    if not enabled():
+        raise RuntimeError("Set QUERY_ENGINE=replica and install duckdb to build the replica.")
+    os.makedirs(REPLICA_DIR, exist_ok=True)
+    started = time.time()
+    exported, files, batch = 0, [], []
+    columns = [name for name in COLUMNS if name in {field.name for field in bigquery_client.get_table(table_id).schema}]
+    for row in bigquery_client.query(f"SELECT {', '.join(columns)} FROM `{table_id}`").result():
+        batch.append({name: row[name] for name in columns})
+        if len(batch) >= EXPORT_CHUNK_ROWS:
+            files.append(_write_rows(batch, "base"))
+            exported, batch = exported + len(batch), []
+    if batch:
+        files.append(_write_rows(batch, "base"))
+        exported += len(batch)
+    with _locked():
+        old = read_manifest()["files"]
+        newer = [name for name in old if name.startswith("part-") and int(name.split("-")[1]) / 1000 > started]
+        _write_manifest({"files": files + newer, "refreshed_at": started})
+        _remove(name for name in old if name not in newer)
+    return exported
+
+
+# --- DIALECT TRANSLATION ---
+UNSUPPORTED = re.compile(r"\b(?:INFORMATION_SCHEMA|ML\.\w+|SAFE\.\w+|NET\.\w+|KEYS\.\w+|AEAD\.\w+)\b", re.IGNORECASE)
+REWRITES = [
+    (re.compile(r"\bSAFE_CAST\s*\(", re.IGNORECASE), "TRY_CAST("),
+    (re.compile(r"\bREGEXP_CONTAINS\s*\(", re.IGNORECASE), "regexp_matches("),
+    (re.compile(r"\bAS\s+STRING\b", re.IGNORECASE), "AS VARCHAR"),
+    (re.compile(r"\bAS\s+INT64\b", re.IGNORECASE), "AS BIGINT"),
+    (re.compile(r"\bAS\s+FLOAT64\b", re.IGNORECASE), "AS DOUBLE"),
+    (re.compile(r"\bAS\s+BOOL\b", re.IGNORECASE), "AS BOOLEAN"),
+]
+ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "\\": "\\", "'": "'", '"': '"', "`": "`", "?": "?"}
+LITERAL = re.compile(r"""(?P<raw>\b[rR])?(?P<quote>['"`])""")
+
+
+def _tokens(sql: str) -> List[Tuple[str, str]]:
+    """Splits SQL into ("code" | "string" | "identifier", text) pieces, decoding BigQuery escapes."""
+    pieces, pos = [], 0
+    while True:
+        found = LITERAL.search(sql, pos)
+        if not found:
+            pieces.append(("code", sql[pos:]))
+            return pieces
+        pieces.append(("code", sql[pos:found.start()]))
+        quote, raw, i, body = found.group("quote"), bool(found.group("raw")), found.end(), []
+        while i < len(sql) and sql[i] != quote:
+            if sql[i] == "\\" and i + 1 < len(sql):
+                body.append(sql[i:i + 2] if raw else ESCAPES.get(sql[i + 1], sql[i + 1]))
+                i += 2
+            else:
+                body.append(sql[i])
+                i += 1
+        if i >= len(sql):
+            raise ValueError("unterminated literal")
+        pieces.append(("identifier" if quote == "`" else "string", "".join(body)))
+        pos = i + 1
+
+
+def translate(sql: str, table_id: str) -> Optional[str]:
+    """Translates a BigQuery SELECT over `table_id` to DuckDB SQL over the replica view `calls`.
+    Returns None for statements the replica cannot answer."""
+    sql = sql.strip().rstrip(";")
+    if not re.match(r"(?:SELECT|WITH)\b", sql, re.IGNORECASE):
+        return None
+    try:
+        pieces = _tokens(sql)
+    except ValueError:
+        return None
+    out = []
+    for kind, text in pieces:
+        if kind == "string":
+            out.append("'" + text.replace("'", "''") + "'")
+        elif kind == "identifier":
+            if text == table_id:
+                out.append("calls")
+            elif "." in text:
+                return None  # another table (e.g. the rollup table)
+            else:
+                out.append('"' + text.replace('"', '""') + '"')
+        else:
+            if UNSUPPORTED.search(text):
+                return None
+            text = re.sub(rf"(?<![\w.]){re.escape(table_id)}(?![\w.])", "calls", text)
+            for pattern, replacement in REWRITES:
+                text = pattern.sub(replacement, text)
+            out.append(text)
+    return "".join(out)
+
+
+# --- QUERIES ---
+class _Reader:
+    """A DuckDB connection whose `calls` view covers the files of the current manifest."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.conn = None
+        self.version = None
+        self.refreshed_at = 0
+
+    def cursor(self):
+        path = os.path.join(REPLICA_DIR, MANIFEST)
+        version = os.stat(path).st_mtime_ns
+        with self.lock:
+            if version != self.version:
+                manifest = read_manifest()
+                if not manifest["files"]:
+                    raise FileNotFoundError("the replica is empty")
+                conn = _duckdb.connect()
+                conn.execute("SET default_null_order = 'nulls_first_on_asc_last_on_desc'")  # BigQuery's order
+                files = ", ".join(f"'{os.path.join(REPLICA_DIR, name)}'" for name in manifest["files"])
+                conn.execute(f"CREATE VIEW calls AS SELECT * FROM read_parquet([{files}], union_by_name = true)")
+                self.conn, self.version, self.refreshed_at = conn, version, manifest.get("refreshed_at", 0)
+            return self.conn.cursor(), self.refreshed_at
+
+
+_reader = _Reader()
+
+
+def query(sql: str, table_id: str) -> Optional[List[Dict[str, Any]]]:
+    """Runs a query on the replica. Returns None (use BigQuery) when the replica is disabled, missing or
+    stale, or cannot run the statement; fallbacks are counted as replica_query failures by reason."""
+    if not enabled():
+        return None
+    duck_sql = translate(sql, table_id)
+    if duck_sql is None:
+        FAILURES.inc(stage="replica_query", error_class="Unsupported")
+        return None
+    try:
+        cursor, refreshed_at = _reader.cursor()
+    except FileNotFoundError:
+        FAILURES.inc(stage="replica_query", error_class="Missing")
+        return None
+    if REPLICA_MAX_AGE_S and time.time() - refreshed_at > REPLICA_MAX_AGE_S:
+        FAILURES.inc(stage="replica_query", error_class="Stale")
+        return None
+    try:
+        with track("replica_query"):
+            result = cursor.execute(duck_sql)
+            names = [column[0] for column in result.description]
+            return [dict(zip(names, row)) for row in result.fetchall()]
+    except Exception as e:
+        print(f"Replica could not run the query ({type(e).__name__}); using BigQuery.")
+        return None
+    finally:
+        cursor.close()
+
+
+if __name__ == "__main__":
+    if "--refresh" not in sys.argv:
+        print("Usage: QUERY_ENGINE=replica python replica.py --refresh   (exports the call table to the replica)")
+        raise SystemExit(1)
+    from nlp_sql import bigquery_client, BIGQUERY_PROJECT_ID, BIGQUERY_DATASET, BIGQUERY_TABLE
+    count = refresh_from_bigquery(bigquery_client, f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}")
+    print(f"✅ Replica refreshed: {count} rows in {REPLICA_DIR}.")
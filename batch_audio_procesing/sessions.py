@@ -0,0 +1,235 @@
+# sessions.py
+# Conversational /ask sessions: the last result set of each session is kept in a bounded columnar cache,
+# and follow-ups that refine it ("of those, which are still pending?") or drill into it ("show the
+# transcript for the second one") are answered locally instead of generating and running new SQL.
+import os
+import re
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set
+from rollups import sentiment_label
+
+# --- CONFIGURATION ---
+SESSION_TTL_S = int(os.getenv("SESSION_TTL_S", "1800"))
+SESSION_MAX = int(os.getenv("SESSION_MAX", "1000"))  # least recently used sessions are dropped beyond this
+SESSION_MAX_ROWS = int(os.getenv("SESSION_MAX_ROWS", "5000"))  # larger results are not cached
+FOLLOW_UP_LIST_ROWS = 20
+
+COLUMN_WORDS = [
+    (r"transcripts?|conversation", "full_transcript"),
+    (r"sentiments?|mood|emotion", "sentiment"),
+    (r"phone(?:\s+numbers?)?|mobile", "phone_number"),
+    (r"problem\s+types?|categor(?:y|ies)|complaint\s+types?", "problem_type"),
+    (r"status|resolution|solved\s+status", "problem_solved"),
+    (r"customer[\s_]*ids?", "customer_id"),
+]
+ORDINALS = {"first": 1, "second": 2, "third": 3, "fourth": 4, "fifth": 5, "sixth": 6, "seventh": 7,
+            "eighth": 8, "ninth": 9, "tenth": 10, "last": -1}
+# "the second one", "the 3rd result", "row 4": a position in the previous answer. A bare ordinal ("the first
+# call") only counts together with a FOLLOW_UP_CUE ("the first of those"), since it usually asks for new data.
+ORDINAL = re.compile(
+    r"\b(?:(?P<word>first|second|third|fourth|fifth|sixth|seventh|eighth|ninth|tenth|last)(?!\s+\d)(?P<word_noun>\s+(?:one|row|result|record))?"
+    r"|(?P<nth>\d{1,4})(?:st|nd|rd|th)(?P<nth_noun>\s*(?:one|row|result|record))?|(?:row|result|record)\s*(?:number\s*|no\.?\s*|#\s*)?(?P<num>\d{1,4}))\b",
+    re.IGNORECASE,
+)
+# Explicit references to the previous answer; words like "still", "same" or "ones" alone are not enough
+FOLLOW_UP_CUE = re.compile(
+    r"\b(?:those|these|them|of\s+which|among\s+(?:those|these|them)|the\s+above|(?:the\s+)?previous\s+(?:results?|answer|list|calls?)|"
+    r"that\s+list|this\s+one|that\s+one)\b",
+    re.IGNORECASE,
+)
+# A question about all calls, or about another customer, needs new data even when it contains a cue
+NEW_SUBJECT = re.compile(r"\b(?:all|every|everyone|everything|overall)\b|\bcustomer[\s_]*(?:id)?\s*(?:#|no\.?|number)?\s*\d+|\d{5,}", re.IGNORECASE)
+# "not solved", "other than payment": the filters below cannot express exclusions, so these go to SQL
+NEGATION = re.compile(r"\b(?:not|never|except|excluding|other\s+than|apart\s+from|besides)\b|n't\b", re.IGNORECASE)
+MENTION = re.compile(r"\b(?:mention(?:s|ed|ing)?|contain(?:s|ed|ing)?|sa(?:y|ys|id))\s+[\"']?(?P<term>[\w' -]+?)[\"']?\s*\??$", re.IGNORECASE)
+FILTERS = [
+    (r"\b(?:pending|unsolved|unresolved|open)\b", "problem_solved", "Pending"),
+    (r"\b(?:solved|resolved|fixed|closed)\b", "problem_solved", "Solved"),
+    (r"\bnetwork\b", "problem_type", "Network"),
+    (r"\brecharge\b", "problem_type", "Recharge"),
+    (r"\bpayment\b", "problem_type", "Payment"),
+    (r"\b(?:missing|no|without)\s+phone", "phone_number", "Missing phone number"),
+    (r"\b(?:incomplete|invalid)\s+phone", "phone_number", "Incomplete phone number"),
+    (r"\b(?:positive|happy|satisfied|good)\b", "sentiment", "positive"),
+    (r"\b(?:negative|angry|frustrated|unhappy|bad|upset)\b", "sentiment", "negative"),
+]
+
+
+class ResultSet:
+    """A query result held column-wise: one list per column, all of the same length."""
+
+    def __init__(self, rows: List[Dict[str, Any]], question: str = "", sql: str = ""):
+        self.question = question
+        self.sql = sql
+        self.columns: Dict[str, List[Any]] = {}
+        for row in rows:
+            for name in row:
+                self.columns.setdefault(name, [])
+        for name, values in self.columns.items():
+            values.extend(row.get(name) for row in rows)
+        self.length = len(rows)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def row(self, i: int) -> Dict[str, Any]:
+        return {name: values[i] for name, values in self.columns.items()}
+
+    def take(self, indices: List[int], question: str = "") -> "ResultSet":
+        subset = ResultSet([], question, self.sql)
+        subset.columns = {name: [values[i] for i in indices] for name, values in self.columns.items()}
+        subset.length = len(indices)
+        return subset
+
+    def add_column(self, name: str, values: List[Any]):
+        self.columns[name] = values
+
+
+class Session:
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.last: Optional[ResultSet] = None
+        self.touched = time.time()
+        self.lock = threading.Lock()
+
+    def remember(self, question: str, rows: List[Dict[str, Any]], sql: str = ""):
+        """Caches a fresh result set; results too large to hold are forgotten (follow-ups go to SQL)."""
+        self.last = ResultSet(rows, question, sql) if 0 < len(rows) <= SESSION_MAX_ROWS else None
+
+    @property
+    def previous_sql(self) -> str:
+        return self.last.sql if self.last else ""
+
+
+class SessionStore:
+    def __init__(self):
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_id: Optional[str]) -> Session:
+        now = time.time()
+        with self.lock:
+            for stale in [sid for sid, s in self.sessions.items() if now - s.touched > SESSION_TTL_S]:
+                del self.sessions[stale]
+            session = self.sessions.get(session_id) if session_id else None
+            if session is None:
+                session = Session(session_id or uuid.uuid4().hex)
+                self.sessions[session.id] = session
+                while len(self.sessions) > SESSION_MAX:
+                    self.sessions.popitem(last=False)
+            self.sessions.move_to_end(session.id)
+            session.touched = now
+            return session
+
+
+store = SessionStore()
+
+
+# --- FOLLOW-UPS ---
+def _requested_columns(question: str) -> List[str]:
+    return [column for pattern, column in COLUMN_WORDS if re.search(rf"\b(?:{pattern})\b", question, re.IGNORECASE)]
+
+
+def _ordinal(question: str, cued: bool) -> Optional[int]:
+    found = ORDINAL.search(question)
+    if not found:
+        return None
+    if not cued and (found.group("word") and not found.group("word_noun") or found.group("nth") and not found.group("nth_noun")):
+        return None
+    if found.group("word"):
+        return ORDINALS[found.group("word").lower()]
+    return int(found.group("nth") or found.group("num"))
+
+
+def _ensure_columns(result: ResultSet, columns: List[str], fetch: Optional[Callable]) -> bool:
+    """Fills columns the cached result lacks with one point lookup by customer_id (never a scan)."""
+    missing = [c for c in columns if c not in result.columns]
+    if not missing:
+        return True
+    if fetch is None or "customer_id" not in result.columns:
+        return False
+    fetched = fetch(sorted({c for c in result.columns["customer_id"] if c is not None}), missing)
+    by_customer: Dict[Any, List[Dict[str, Any]]] = {}
+    for row in fetched:
+        by_customer.setdefault(row["customer_id"], []).append(row)
+    shared = [c for c in ("phone_number", "problem_type", "problem_solved") if c in result.columns]
+    for column in missing:
+        values = []
+        for i in range(len(result)):
+            candidates = by_customer.get(result.columns["customer_id"][i], [])
+            # A repeat caller has several calls: prefer the one agreeing with the columns we already have
+            best = next((r for r in candidates if all(r.get(c) == result.columns[c][i] for c in shared if c in r)),
+                        candidates[0] if candidates else {})
+            values.append(best.get(column))
+        result.add_column(column, values)
+    return True
+
+
+def _describe_row(number: int, row: Dict[str, Any], columns: List[str]) -> str:
+    head = f"{number}."
+    if "customer_id" in row:
+        head += f" Customer {row['customer_id']}"
+    if row.get("phone_number"):
+        head += f" ({row['phone_number']})"
+    details = [f"{name}: {row[name]}" for name in (columns or row) if name not in ("customer_id", "phone_number") and name in row]
+    return head + " — " + "; ".join(details)
+
+
+def answer_follow_up(session: Session, question: str, fetch: Optional[Callable] = None) -> Optional[str]:
+    """Answers a follow-up from the session's last result set, or returns None when the question needs new
+    data. The answer's rows become the session's new result set, so refinements can be chained.
+    `fetch(customer_ids, columns)` may return extra columns for cached calls by point lookup."""
+    result = session.last
+    if result is None or NEW_SUBJECT.search(question):
+        return None
+    cued = bool(FOLLOW_UP_CUE.search(question))
+    position = _ordinal(question, cued)
+    if not cued and position is None or NEGATION.search(question):
+        return None
+    columns = _requested_columns(question)
+
+    # Drill into one row: "show the transcript for the second one"
+    if position is not None:
+        index = position - 1 if position > 0 else len(result) + position
+        if not 0 <= index < len(result) or not _ensure_columns(result, columns, fetch):
+            return None
+        session.last = result.take([index], question)
+        return _describe_row(index + 1, result.row(index), columns)
+
+    # Refine: "of those, which are still pending / mention roaming / had angry customers?"
+    conditions = [(column, value) for pattern, column, value in FILTERS if re.search(pattern, question, re.IGNORECASE)]
+    mention = MENTION.search(question)
+    needed = [column for column, _ in conditions] + (["full_transcript"] if mention else []) + columns
+    if not conditions and not mention:
+        # Only a column word ("phone numbers of those"): the SQL path answers it with the previous query's conditions
+        return None
+    if not _ensure_columns(result, needed, fetch):
+        return None
+    # Values of one column are alternatives ("pending or solved"); different columns must all match
+    allowed: Dict[str, Set[str]] = {}
+    for column, value in conditions:
+        allowed.setdefault(column, set()).add(value.lower())
+    keep = []
+    for i in range(len(result)):
+        ok = True
+        for column, values in allowed.items():
+            cell = result.columns[column][i]
+            cell = sentiment_label(cell) if column == "sentiment" else str(cell or "").lower()
+            ok = ok and cell in values
+        if mention:
+            ok = ok and mention.group("term").strip().lower() in str(result.columns["full_transcript"][i] or "").lower()
+        if ok:
+            keep.append(i)
+    subset = result.take(keep, question)
+    session.last = subset
+    label = [" or ".join(value for c, value in conditions if c == column) for column in allowed] + ([f"mentions '{mention.group('term').strip()}'"] if mention else [])
+    summary = f"{len(subset)} of the {len(result)} previous results match: {', '.join(label)}."
+    if re.search(r"\bhow many\b|\bcount\b|\bnumber of\b", question, re.IGNORECASE):
+        return summary
+    lines = [summary] + [_describe_row(i + 1, subset.row(i), columns) for i in range(min(len(subset), FOLLOW_UP_LIST_ROWS))]
+    if len(subset) > FOLLOW_UP_LIST_ROWS:
+        lines.append(f"… and {len(subset) - FOLLOW_UP_LIST_ROWS} more.")
+    return "\n".join(lines)
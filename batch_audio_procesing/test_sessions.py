@@ -0,0 +1,51 @@
+# test_sessions.py
+# Follow-up questions answered from a session's cached rows (see sessions.py). Run with `python -m pytest`.
+import sessions
+
+ROWS = [
+    {"customer_id": 1, "problem_type": "Network", "problem_solved": "Solved", "sentiment": "happy and satisfied"},
+    {"customer_id": 2, "problem_type": "Network", "problem_solved": "Pending", "sentiment": "angry and frustrated"},
+    {"customer_id": 3, "problem_type": "Payment", "problem_solved": "Pending", "sentiment": "upset"},
+    {"customer_id": 4, "problem_type": "Recharge", "problem_solved": "Solved", "sentiment": "good"},
+]
+
+
+def ask(question):
+    session = sessions.Session("test")
+    session.remember("show the latest calls", ROWS, "SELECT * FROM calls")
+    return sessions.answer_follow_up(session, question), session
+
+
+def test_negated_status_goes_to_sql():
+    assert ask("of those, which are not solved?")[0] is None
+
+
+def test_negated_problem_type_goes_to_sql():
+    assert ask("which of them were not network issues?")[0] is None
+
+
+def test_negated_count_goes_to_sql():
+    assert ask("how many of those are not payment?")[0] is None
+
+
+def test_other_negations_go_to_sql():
+    for question in ("of those, which weren't solved?", "which of these except payment?",
+                     "which of them other than network?", "of those, excluding recharge?"):
+        assert ask(question)[0] is None, question
+
+
+def test_values_of_one_column_are_alternatives():
+    answer, session = ask("which of those are pending or solved?")
+    assert answer.startswith("4 of the 4 previous results match: Pending or Solved.")
+    assert len(session.last) == 4
+
+
+def test_different_columns_must_all_match():
+    answer, session = ask("of those, which network calls are still pending?")
+    assert answer.startswith("1 of the 4 previous results match: Pending, Network.")
+    assert session.last.columns["customer_id"] == [2]
+
+
+def test_plain_refinement():
+    answer, session = ask("how many of those are solved?")
+    assert answer == "2 of the 4 previous results match: Solved."
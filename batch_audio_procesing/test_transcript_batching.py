@@ -0,0 +1,54 @@
+# test_transcript_batching.py
+# Batched transcript analysis (see transcript_batching.py). Run with `python -m pytest`.
+import re
+import json
+import asyncio
+import transcript_batching
+
+THINKING_TOKENS = 3000  # what the fake model spends thinking before it answers
+TOKENS_PER_ITEM = 60
+
+
+def item(key):
+    return {"call_id": key, "phone_number": "9876543210", "problem_solved": "Solved",
+            "problem_type": "Network", "sentiment": "calm throughout"}
+
+
+def fake_model(calls):
+    async def generate(prompt, schema, max_output_tokens):
+        keys = re.findall(r"^### CALL (\S+)$", prompt, re.MULTILINE)
+        calls.append((len(keys), max_output_tokens))
+        text = json.dumps([item(key) for key in keys])
+        # Thinking counts against the limit; whatever is left is all the answer gets
+        room = max(0, max_output_tokens - THINKING_TOKENS) * len(text) // (TOKENS_PER_ITEM * len(keys))
+        return text[:room]
+    return generate
+
+
+def test_truncated_output_does_not_cascade_into_single_item_calls(monkeypatch):
+    monkeypatch.setattr(transcript_batching, "ANALYSIS_BATCH_THINKING_TOKENS", 0)
+    monkeypatch.setattr(transcript_batching, "OUTPUT_TOKENS_PER_ITEM", 40)
+    transcripts = {f"call-{i}": f"Support: hello {i}\nCustomer: my network is down" for i in range(25)}
+    calls = []
+    results = asyncio.run(transcript_batching.analyze_transcripts_batched(transcripts, fake_model(calls)))
+    assert all(isinstance(results[key], dict) for key in transcripts)
+    assert all(keys > 1 for keys, _ in calls)
+    assert len(calls) <= 4
+
+
+def test_default_budget_leaves_room_for_thinking():
+    transcripts = {f"call-{i}": "Support: hello\nCustomer: recharge failed" for i in range(25)}
+    calls = []
+    results = asyncio.run(transcript_batching.analyze_transcripts_batched(transcripts, fake_model(calls)))
+    assert all(isinstance(results[key], dict) for key in transcripts)
+    assert [keys for keys, _ in calls] == [25]
+
+
+def test_invalid_entries_are_still_split():
+    async def generate(prompt, schema, max_output_tokens):
+        keys = re.findall(r"^### CALL (\S+)$", prompt, re.MULTILINE)
+        return json.dumps([dict(item(key), problem_type="Unknown") if key == "bad" else item(key) for key in keys])
+    transcripts = {"a": "Support: hi", "bad": "Support: hi", "c": "Support: hi"}
+    results = asyncio.run(transcript_batching.analyze_transcripts_batched(transcripts, generate))
+    assert isinstance(results["a"], dict) and isinstance(results["c"], dict)
+    assert isinstance(results["bad"], Exception)
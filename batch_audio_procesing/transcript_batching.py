@@ -0,0 +1,243 @@
+# transcript_batching.py
+# Multi-transcript analysis: pack many transcripts into one Gemini request under a token budget,
+# validate each element of the keyed JSON array separately and re-split failures into smaller batches.
+import os
+import json
+import asyncio
+from typing import Dict, Any, List, Awaitable, Callable, Optional, Tuple
+from call_schema import CallAnalysis, repair_json_array, response_schema, validate_call_analysis
+
+# --- CONFIGURATION ---
+ANALYSIS_BATCH_TOKEN_BUDGET = int(os.getenv("ANALYSIS_BATCH_TOKEN_BUDGET", "60000"))  # input tokens per request
+ANALYSIS_BATCH_MAX_ITEMS = int(os.getenv("ANALYSIS_BATCH_MAX_ITEMS", "25"))
+ANALYSIS_BATCH_LINGER_S = float(os.getenv("ANALYSIS_BATCH_LINGER_S", "0.5"))  # wait for more transcripts before flushing
+ANALYSIS_BATCH_CONCURRENCY = int(os.getenv("ANALYSIS_BATCH_CONCURRENCY", "4"))
+# Gemini 2.5 models count thinking tokens against max_output_tokens, so every request gets a thinking
+# allowance on top of the ~120 tokens of JSON each call needs
+ANALYSIS_BATCH_THINKING_TOKENS = int(os.getenv("ANALYSIS_BATCH_THINKING_TOKENS", "4096"))
+OUTPUT_TOKENS_PER_ITEM = 256
+MAX_OUTPUT_TOKENS = 65535
+
+BATCH_PREAMBLE = """
+You are an expert Airtel customer care call analyst. Below are several call transcripts, each starting
+with a line "### CALL <call_id>". Speakers are labeled Support and Customer; if another company is
+mentioned, treat it as Airtel. For EVERY call return one JSON object in a JSON array with:
+- "call_id": the exact id from the header
+- "phone_number": the 10-digit number mentioned, the 7–9 digits heard if incomplete, or "Missing phone number"
+- "problem_solved": "Solved" or "Pending"
+- "problem_type": one of "Payment", "Network", "Recharge"
+- "sentiment": the customer's emotional tone from start to end, maximum 20 words
+Return only the JSON array, one element per call, in the same order.
+"""
+
+GenerateFn = Callable[[str, Dict[str, Any], int], Awaitable[Any]]
+USAGE_FIELDS = ("prompt_tokens", "audio_tokens", "text_tokens", "output_tokens", "total_tokens", "cost_usd")
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for packing decisions
+    return len(text) // 4 + 1
+
+
+def batch_response_schema() -> Dict[str, Any]:
+    item = response_schema(CallAnalysis, exclude=("full_transcript",))
+    item = dict(item, properties={"call_id": {"type": "STRING", "description": "Id from the ### CALL header"}, **item["properties"]})
+    item["required"] = list(item["properties"])
+    item["property_ordering"] = list(item["properties"])
+    return {"type": "ARRAY", "items": item}
+
+
+def pack_batches(transcripts: Dict[str, str], token_budget: int = ANALYSIS_BATCH_TOKEN_BUDGET,
+                 max_items: int = ANALYSIS_BATCH_MAX_ITEMS) -> List[List[str]]:
+    """Greedy, order-preserving packing of keys into batches that fit the token budget.
+    A transcript bigger than the budget still gets a batch of its own."""
+    budget = token_budget - estimate_tokens(BATCH_PREAMBLE)
+    batches: List[List[str]] = []
+    current: List[str] = []
+    used = 0
+    for key, transcript in transcripts.items():
+        cost = estimate_tokens(transcript) + 10
+        if current and (used + cost > budget or len(current) >= max_items):
+            batches.append(current)
+            current, used = [], 0
+        current.append(key)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+def output_token_budget(items: int) -> int:
+    return min(MAX_OUTPUT_TOKENS, ANALYSIS_BATCH_THINKING_TOKENS + OUTPUT_TOKENS_PER_ITEM * items)
+
+
+def build_batch_prompt(transcripts: Dict[str, str], keys: List[str]) -> str:
+    parts = [BATCH_PREAMBLE]
+    for key in keys:
+        parts.append(f"### CALL {key}\n{transcripts[key]}\n")
+    return "\n".join(parts)
+
+
+def parse_batch_response(text: str, keys: List[str]) -> Tuple[Dict[str, Dict[str, Any]], List[str]]:
+    """Returns ({key: validated analysis}, [keys that must be retried])."""
+    try:
+        items = json.loads(text)
+        truncated = False
+    except (json.JSONDecodeError, TypeError):
+        items = repair_json_array(text or "")
+        truncated = True
+    if not isinstance(items, list):
+        return {}, list(keys)
+    if truncated and items:
+        # The last element of a repaired (truncated) array may be cut short; re-analyze it
+        items = items[:-1]
+    expected = set(keys)
+    results: Dict[str, Dict[str, Any]] = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        key = str(item.get("call_id", "")).strip()
+        if key not in expected or key in results:
+            continue
+        analysis, error = validate_call_analysis(item, exclude=("full_transcript",))
+        if analysis is not None:
+            analysis.pop("call_id", None)
+            results[key] = analysis
+    return results, [key for key in keys if key not in results]
+
+
+def is_cut_off(text: str) -> bool:
+    """True when a response stops before its JSON array is closed, i.e. it ran out of output tokens."""
+    try:
+        json.loads(text)
+        return False
+    except (json.JSONDecodeError, TypeError):
+        text = (text or "").strip()
+        return not text or text.startswith("[")
+
+
+def apportion_usage(token_usage: Dict[str, Any], transcripts: Dict[str, str], keys: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Splits one batched call's usage across its transcripts in proportion to their length."""
+    weights = {key: estimate_tokens(transcripts[key]) for key in keys}
+    total = sum(weights.values()) or 1
+    shares = {}
+    for key, weight in weights.items():
+        share = dict(token_usage)
+        for field in USAGE_FIELDS:
+            value = token_usage.get(field, 0) * weight / total
+            share[field] = round(value, 8) if field == "cost_usd" else int(round(value))
+        shares[key] = share
+    return shares
+
+
+async def analyze_transcripts_batched(
+    transcripts: Dict[str, str],
+    generate: GenerateFn,
+    token_budget: int = ANALYSIS_BATCH_TOKEN_BUDGET,
+    max_items: int = ANALYSIS_BATCH_MAX_ITEMS,
+    concurrency: int = ANALYSIS_BATCH_CONCURRENCY,
+) -> Dict[str, Any]:
+    """Analyzes many transcripts with as few requests as possible.
+
+    `generate(prompt, schema, max_output_tokens)` performs one model call and returns its text, or
+    (text, token_usage) in which case each result carries its share of the usage as "token_usage".
+    A response cut off by the output-token limit is continued by asking again for the missing entries
+    together, with twice the limit. Entries missing from or invalid in a complete response are split in
+    half and retried until a single transcript fails on its own, in which case its value is an Exception.
+    """
+    results: Dict[str, Any] = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    schema = batch_response_schema()
+
+    async def run(keys: List[str], max_output_tokens: int = 0):
+        prompt = build_batch_prompt(transcripts, keys)
+        max_output_tokens = max(max_output_tokens, output_token_budget(len(keys)))
+        cut_off = False
+        try:
+            async with semaphore:
+                text = await generate(prompt, schema, max_output_tokens)
+            token_usage = None
+            if isinstance(text, tuple):
+                text, token_usage = text
+            cut_off = is_cut_off(text)
+            parsed, failed = parse_batch_response(text, keys)
+            if token_usage:
+                for key, share in apportion_usage(token_usage, transcripts, keys).items():
+                    if key in parsed:
+                        parsed[key]["token_usage"] = share
+        except Exception as e:
+            if len(keys) == 1:
+                results[keys[0]] = e
+                return
+            parsed, failed = {}, keys
+        results.update(parsed)
+        if not failed:
+            return
+        if cut_off and max_output_tokens < MAX_OUTPUT_TOKENS:
+            # The answers were fine but did not fit: splitting would only multiply the requests
+            await run(failed, min(MAX_OUTPUT_TOKENS, 2 * max_output_tokens))
+            return
+        if len(failed) == 1 and len(keys) == 1:
+            results[failed[0]] = ValueError("Model returned no valid analysis for this transcript")
+            return
+        middle = (len(failed) + 1) // 2
+        await asyncio.gather(*(run(chunk) for chunk in (failed[:middle], failed[middle:]) if chunk))
+
+    await asyncio.gather(*(run(keys) for keys in pack_batches(transcripts, token_budget, max_items)))
+    return results
+
+
+class BatchedAnalyzer:
+    """Micro-batches concurrent `analyze(key, transcript)` calls into multi-transcript requests.
+    Flushes when the pending transcripts fill the token budget or after a short linger."""
+
+    def __init__(self, generate: GenerateFn, token_budget: int = ANALYSIS_BATCH_TOKEN_BUDGET,
+                 max_items: int = ANALYSIS_BATCH_MAX_ITEMS, linger: float = ANALYSIS_BATCH_LINGER_S,
+                 concurrency: int = ANALYSIS_BATCH_CONCURRENCY):
+        self.generate = generate
+        self.token_budget = token_budget
+        self.max_items = max_items
+        self.linger = linger
+        self.concurrency = concurrency
+        self._pending: Dict[str, Tuple[str, asyncio.Future]] = {}
+        self._pending_tokens = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+
+    async def analyze(self, key: str, transcript: str) -> Dict[str, Any]:
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = (transcript, future)
+        self._pending_tokens += estimate_tokens(transcript)
+        if self._pending_tokens >= self.token_budget or len(self._pending) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.linger, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        pending, self._pending, self._pending_tokens = self._pending, {}, 0
+        task = asyncio.ensure_future(self._run(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, pending: Dict[str, Tuple[str, asyncio.Future]]):
+        transcripts = {key: transcript for key, (transcript, _) in pending.items()}
+        try:
+            results = await analyze_transcripts_batched(
+                transcripts, self.generate, self.token_budget, self.max_items, self.concurrency
+            )
+        except Exception as e:
+            results = {key: e for key in transcripts}
+        for key, (_, future) in pending.items():
+            if future.done():
+                continue
+            outcome = results.get(key, ValueError("Transcript was not analyzed"))
+            if isinstance(outcome, Exception):
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
@@ -0,0 +1,144 @@
+# transcript_index.py
+# Local full-text index over call transcripts (SQLite FTS5), filled from the same rows loaded into
+# BigQuery so keyword questions are answered with ranked, highlighted matches without a table scan.
+import os
+import sys
+import hashlib
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+import transcript_store
+
+# --- CONFIGURATION ---
+TRANSCRIPT_INDEX_DB = os.getenv("TRANSCRIPT_INDEX_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "transcript_index.sqlite"))
+FIELDS = ("customer_id", "phone_number", "problem_type", "problem_solved", "sentiment", "full_transcript")
+
+
+def call_key(row: Dict[str, Any]) -> str:
+    # Rows carry no call id (repeat callers share customer_id), so a call is its customer plus transcript
+    return hashlib.sha1(f"{row.get('customer_id')}\x00{row.get('full_transcript') or ''}".encode("utf-8")).hexdigest()
+
+
+def match_expression(terms: Iterable[str], any_term: bool = False) -> str:
+    """Builds an FTS5 query from plain words or phrases; quoting keeps user text from being parsed as syntax."""
+    quoted = ['"' + term.replace('"', '""') + '"' for term in terms if term.strip()]
+    return (" OR " if any_term else " AND ").join(quoted)
+
+
+class TranscriptIndex:
+    """Thread-safe FTS5 index. `calls` holds the analyzed rows and `calls_fts` indexes their transcript
+    and sentiment as an external-content table kept current by triggers, so adds are incremental."""
+
+    def __init__(self, path: str = TRANSCRIPT_INDEX_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS calls (
+                id INTEGER PRIMARY KEY,
+                call_key TEXT NOT NULL UNIQUE,
+                customer_id INTEGER,
+                phone_number TEXT,
+                problem_type TEXT,
+                problem_solved TEXT,
+                sentiment TEXT,
+                full_transcript TEXT,
+                source_uri TEXT
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS calls_fts USING fts5(
+                full_transcript, sentiment, content='calls', content_rowid='id',
+                tokenize='porter unicode61 remove_diacritics 2'
+            );
+            CREATE TRIGGER IF NOT EXISTS calls_ai AFTER INSERT ON calls BEGIN
+                INSERT INTO calls_fts (rowid, full_transcript, sentiment) VALUES (new.id, new.full_transcript, new.sentiment);
+            END;
+            CREATE TRIGGER IF NOT EXISTS calls_ad AFTER DELETE ON calls BEGIN
+                INSERT INTO calls_fts (calls_fts, rowid, full_transcript, sentiment) VALUES ('delete', old.id, old.full_transcript, old.sentiment);
+            END;
+        """)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM calls").fetchone()[0]
+
+    def add_rows(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """Indexes analyzed rows (BigQuery row dicts, optionally with source_uri). Re-adding a call is a no-op."""
+        values = [
+            (call_key(row), *(row.get(field) for field in FIELDS), row.get("source_uri"))
+            for row in rows
+            if row.get("full_transcript") and not row.get("duplicate_of")
+        ]
+        if not values:
+            return 0
+        with self.lock, self.conn:
+            return self.conn.executemany(
+                f"INSERT OR IGNORE INTO calls (call_key, {', '.join(FIELDS)}, source_uri) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                values,
+            ).rowcount
+
+    def search(self, terms: List[str], any_term: bool = False, problem_type: Optional[str] = None,
+               problem_solved: Optional[str] = None, limit: int = 20,
+               highlight: tuple = ("[", "]")) -> Dict[str, Any]:
+        """Returns {"total": matching calls, "matches": best `limit` calls by BM25 with a highlighted snippet}."""
+        expression = match_expression(terms, any_term)
+        if not expression:
+            return {"total": 0, "matches": []}
+        filters, params = "", [expression]
+        if problem_type:
+            filters += " AND LOWER(c.problem_type) = LOWER(?)"
+            params.append(problem_type)
+        if problem_solved:
+            filters += " AND LOWER(c.problem_solved) = LOWER(?)"
+            params.append(problem_solved)
+        base = f"FROM calls_fts JOIN calls c ON c.id = calls_fts.rowid WHERE calls_fts MATCH ?{filters}"
+        with self.lock:
+            total = self.conn.execute(f"SELECT COUNT(*) {base}", params).fetchone()[0]
+            rows = self.conn.execute(
+                f"SELECT c.customer_id, c.phone_number, c.problem_type, c.problem_solved, c.sentiment, c.source_uri, "
+                f"snippet(calls_fts, 0, ?, ?, '…', 16) AS snippet, bm25(calls_fts, 1.0, 0.3) AS score "
+                f"{base} ORDER BY score LIMIT ?",
+                [highlight[0], highlight[1], *params, limit],
+            ).fetchall()
+        return {"total": total, "matches": [dict(row) for row in rows]}
+
+    def rebuild_from_bigquery(self, bigquery_client, table_id: str) -> int:
+        """One-off backfill for rows loaded before the index existed. Returns the number of calls added."""
+        query, columns = transcript_store.backfill_query(table_id, FIELDS)
+        added, batch = 0, []
+        for result in bigquery_client.query(query).result():
+            batch.append({column: result[column] for column in columns})
+            if len(batch) >= 1000:
+                added += self.add_rows(transcript_store.hydrate(batch, limit=None))
+                batch = []
+        return added + self.add_rows(transcript_store.hydrate(batch, limit=None))
+
+
+_index: Optional[TranscriptIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> TranscriptIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = TranscriptIndex()
+        return _index
+
+
+def index_rows(rows: List[Dict[str, Any]]):
+    """Adds freshly loaded rows to the index. The index is a derived cache, so failures never fail ingest."""
+    try:
+        get_index().add_rows(rows)
+    except Exception as e:
+        print(f"⚠️ Could not update the transcript index: {e}")
+
+
+if __name__ == "__main__":
+    if "--rebuild" not in sys.argv:
+        print("Usage: python transcript_index.py --rebuild   (backfills the index from BigQuery)")
+        raise SystemExit(1)
+    from nlp_sql import bigquery_client, BIGQUERY_PROJECT_ID, BIGQUERY_DATASET, BIGQUERY_TABLE
+    count = get_index().rebuild_from_bigquery(bigquery_client, f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}")
+    print(f"✅ Indexed {count} calls ({len(get_index())} in total).")
@@ -0,0 +1,149 @@
+# two_phase.py
+# Two-phase call analysis (TWO_PHASE=1). Output tokens dominate Gemini latency, and the corrected transcript
+# is by far the largest part of the unified answer. Phase one therefore asks only for the four small fields
+# with a tiny output budget and loads the row right away (transcript_status "pending"); phase two asks for
+# the transcript in the background and fills it into the loaded row with one UPDATE per chunk of rows.
+# The audio is sent to the model twice, so this trades some input-token spend for time-to-first-result.
+import os
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+from google.cloud import bigquery
+import call_schema
+import transcript_store
+import model_scheduler
+
+# --- CONFIGURATION ---
+TWO_PHASE = os.getenv("TWO_PHASE", "0") == "1"
+FIELDS_MAX_OUTPUT_TOKENS = int(os.getenv("FIELDS_MAX_OUTPUT_TOKENS", "1024"))  # 2.5 models count thinking tokens here too
+TRANSCRIPT_WORKERS = int(os.getenv("TRANSCRIPT_WORKERS", "4"))  # background phase-two calls per process
+TRANSCRIPT_UPDATE_ROWS = int(os.getenv("TRANSCRIPT_UPDATE_ROWS", "100"))  # rows filled in by one UPDATE statement
+TRANSCRIPT_JOBS_MAX = 1000  # finished phase-two jobs remembered for polling
+
+PENDING, READY, FAILED = "pending", "ready", "failed"
+SCHEMA_FIELDS = [
+    bigquery.SchemaField("source_uri", "STRING"),
+    bigquery.SchemaField("transcript_status", "STRING"),
+]
+FIELD_NAMES = ("phone_number", "problem_solved", "problem_type", "sentiment")
+FIELDS_SCHEMA = call_schema.response_schema(exclude=("full_transcript",))
+TRANSCRIPT_SCHEMA = call_schema.response_schema(exclude=FIELD_NAMES)
+
+FIELDS_PROMPT = """
+    You are an expert Airtel call analyst. Listen to this entire customer care recording; if another company
+    is mentioned, treat it as Airtel. Do NOT transcribe it. Return valid JSON only with:
+        - "phone_number": the number heard in the call (10 digits, or the digits heard, or "Missing phone number")
+        - "problem_solved": "Solved" or "Pending"
+        - "problem_type": one of "Payment", "Network", "Recharge"
+        - "sentiment": the customer's emotional tone from start to end in maximum 20 words
+    """
+
+TRANSCRIPT_PROMPT = """
+    You are an expert Airtel call analyst. Transcribe this entire customer care recording clearly, correcting
+    grammar and labeling speakers as "Customer" and "Support"; if another company is mentioned, change it to
+    Airtel. Return valid JSON only: {"full_transcript": "..."}
+    """
+
+
+def enabled() -> bool:
+    return TWO_PHASE
+
+
+def table_schema(schema: List[bigquery.SchemaField]) -> List[bigquery.SchemaField]:
+    """The call table schema, plus source_uri and transcript_status in two-phase mode."""
+    return schema + SCHEMA_FIELDS if enabled() else schema
+
+
+def schema_update_options() -> List[str]:
+    # Lets the first two-phase load add its columns to an existing table
+    if enabled() and not transcript_store.schema_update_options():
+        return [bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION]
+    return transcript_store.schema_update_options()
+
+
+def parse_transcript(text: str) -> Optional[str]:
+    parsed = call_schema.repair_json(text)
+    transcript = (parsed or {}).get("full_transcript")
+    return transcript.strip() if isinstance(transcript, str) and transcript.strip() else None
+
+
+# --- PHASE TWO: WRITE-BACK ---
+_PARAM_TYPES = {"transcript_length": "INT64"}
+
+
+def update_transcripts(bigquery_client, storage_client, table_id: str,
+                       updates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Fills in phase-two results: each update is {"source_uri", "full_transcript", "transcript_status"}.
+    Offloaded transcripts (see transcript_store.py) set the pointer columns instead of the text. Rows are
+    matched on source_uri, TRANSCRIPT_UPDATE_ROWS per statement (DML is too slow to run once per row).
+    Returns the updates as written, for the local replica (see replica.update_rows)."""
+    written = []
+    for start in range(0, len(updates), TRANSCRIPT_UPDATE_ROWS):
+        chunk = transcript_store.offload_rows(storage_client, updates[start:start + TRANSCRIPT_UPDATE_ROWS])
+        columns = sorted({name for row in chunk for name in row} - {"source_uri"})
+        params = [bigquery.ScalarQueryParameter(f"u{i}", "STRING", row["source_uri"]) for i, row in enumerate(chunk)]
+        assignments = []
+        for column in columns:
+            cases = " ".join(f"WHEN @u{i} THEN @{column}_{i}" for i in range(len(chunk)))
+            assignments.append(f"{column} = CASE source_uri {cases} ELSE {column} END")
+            params += [
+                bigquery.ScalarQueryParameter(f"{column}_{i}", _PARAM_TYPES.get(column, "STRING"), row.get(column))
+                for i, row in enumerate(chunk)
+            ]
+        where = ", ".join(f"@u{i}" for i in range(len(chunk)))
+        sql = f"UPDATE `{table_id}` SET {', '.join(assignments)} WHERE source_uri IN ({where})"
+        bigquery_client.query(sql, job_config=bigquery.QueryJobConfig(query_parameters=params)).result()
+        written += chunk
+    return written
+
+
+# --- PHASE TWO: BACKGROUND JOBS (upload path) ---
+class TranscriptJobs:
+    """Status of background transcript jobs, for polling. Bounded: the oldest finished jobs are forgotten."""
+
+    def __init__(self, max_jobs: int = TRANSCRIPT_JOBS_MAX):
+        self.lock = threading.Lock()
+        self.jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.max_jobs = max_jobs
+
+    def set(self, job_id: str, **state):
+        with self.lock:
+            self.jobs.setdefault(job_id, {}).update(state)
+            self.jobs.move_to_end(job_id)
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def find(self, source_uri: str) -> Optional[str]:
+        """The id of the most recently updated job for `source_uri`, if it is still remembered."""
+        with self.lock:
+            return next((job_id for job_id in reversed(self.jobs) if self.jobs[job_id].get("source_uri") == source_uri), None)
+
+
+jobs = TranscriptJobs()
+_executor = ThreadPoolExecutor(max_workers=TRANSCRIPT_WORKERS, thread_name_prefix="transcript-phase")
+
+
+def start(source_uri: str, complete: Callable[[], str]) -> str:
+    """Runs `complete()` (generates and stores the transcript, returns it) in the background at batch
+    priority, so phase-one work of other users is admitted first. Returns the job id to poll."""
+    job_id = uuid.uuid4().hex
+    jobs.set(job_id, status=PENDING, source_uri=source_uri)
+
+    def run():
+        try:
+            with model_scheduler.priority(model_scheduler.BATCH):
+                transcript = complete()
+            jobs.set(job_id, status=READY, full_transcript=transcript)
+        except Exception as e:
+            print(f"❌ Transcript phase failed for {source_uri}: {e}")
+            jobs.set(job_id, status=FAILED, error=str(e))
+
+    _executor.submit(run)
+    return job_id
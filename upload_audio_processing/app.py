@@ -2,11 +2,15 @@
 import os
 import tempfile
 import uuid
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from google.cloud import bigquery
 import audio_processing as ap
+import bulk_upload
+import deadlines
+import metrics
+import two_phase
+from metrics import track, BYTES_PROCESSED
 
 load_dotenv()
 
@@ -16,9 +20,9 @@ BIGQUERY_PROJECT = ap.BIGQUERY_PROJECT_ID
 ALLOWED_EXTENSIONS = {"wav", "flac", "mp3", "m4a", "ogg"}
 
 app = Flask(__name__)
-app.config["MAX_CONTENT_LENGTH"] = 200 * 1024 * 1024  # 200MB max
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_UPLOAD_MB", "200")) * 1024 * 1024  # 200MB max by default; raise for bulk uploads
 
-bq_client = bigquery.Client(project=BIGQUERY_PROJECT)
+bq_client = ap.bigquery_client  # the pipeline's client (a local stand-in with AUDIO_BACKEND=fake)
 
 
 def allowed_file(filename):
@@ -46,13 +50,18 @@ def upload():
     tmpdir = tempfile.mkdtemp()
     local_path = os.path.join(tmpdir, filename)
     file.save(local_path)
+    BYTES_PROCESSED.inc(os.path.getsize(local_path), stage="http_upload")
 
     dest_name = f"upload_audio/{uuid.uuid4().hex}_{filename}"  # here upload_audio is the sub folder in GCS Bucket where the audio files will be uploaded
 
     try:
-        result = ap.process_local_file_and_upload(local_path, GCS_BUCKET, dest_name)
+        with track("http_upload"), deadlines.deadline(deadlines.UPLOAD_DEADLINE_S):
+            result = ap.process_local_file_and_upload(local_path, GCS_BUCKET, dest_name)
         return jsonify({"status": "ok", "data": result})
 
+    except deadlines.DeadlineExceeded as e:
+        return jsonify({"status": "error", "message": str(e)}), 504
+
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
@@ -63,5 +72,53 @@ def upload():
             pass
 
 
+def process_bulk_entry(name, data):
+    filename = secure_filename(os.path.basename(name)) or "audio"
+    dest_name = f"upload_audio/{uuid.uuid4().hex}_{filename}"
+    return ap.process_bytes_and_upload(data, filename, GCS_BUCKET, dest_name)
+
+
+@app.route("/upload/bulk", methods=["POST"])
+def upload_bulk():
+    """Accepts any number of 'audio' files and/or zip/tar 'archive' files and returns a job to poll."""
+    files = [f for f in request.files.getlist("audio") + request.files.getlist("archive") if f.filename]
+    if not files:
+        return jsonify({"status": "error", "message": "No 'audio' or 'archive' files in request"}), 400
+
+    # The uploads are kept as sent (archives are not extracted) until the background job has read them
+    workdir = tempfile.mkdtemp(prefix="bulk_upload_")
+    sources = []
+    for i, file in enumerate(files):
+        path = os.path.join(workdir, f"{i}_{secure_filename(file.filename) or 'upload'}")
+        file.save(path)
+        BYTES_PROCESSED.inc(os.path.getsize(path), stage="http_upload")
+        sources.append((file.filename, path))
+
+    job = bulk_upload.start_job(workdir, sources, allowed_file, process_bulk_entry)
+    return jsonify({"status": "ok", "job_id": job.id, "progress_url": f"/upload/bulk/{job.id}"}), 202
+
+
+@app.route("/upload/bulk/<job_id>")
+def upload_bulk_progress(job_id):
+    job = bulk_upload.get_job(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    return jsonify({"status": "ok", "data": job.to_dict()})
+
+
+@app.route("/upload/transcript/<job_id>")
+def upload_transcript_progress(job_id):
+    # TWO_PHASE: the transcript of an upload whose analysis fields were already returned
+    job = two_phase.jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    return jsonify({"status": "ok", "data": job})
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render_prometheus(), mimetype=metrics.PROMETHEUS_CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)), debug=True)
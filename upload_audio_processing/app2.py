@@ -1,9 +1,15 @@
 from dotenv import load_dotenv
 import os
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), ".env"))
-from flask import Flask, render_template, request, jsonify
-from nlp_sql import nl_to_sql, execute_query, interpret_results, get_table_schema
+from flask import Flask, Response, render_template, request, jsonify
+from nlp_sql import nl_to_sql, execute_query, interpret_results, get_table_schema, answer_keyword_question
+from nlp_sql import answer_similarity_question, answer_follow_up
 from nlp_sql import BIGQUERY_PROJECT_ID, BIGQUERY_DATASET, BIGQUERY_TABLE
+import metrics
+import usage
+import sessions
+import deadlines
+from metrics import track
 
 app = Flask(__name__, template_folder='templates2', static_folder='style2')
 
@@ -20,15 +26,49 @@ def ask():
         user_question = request.json.get("question", "")
         if not user_question:
             return jsonify({"response": "Please enter a question."})
+        session = sessions.store.get(request.json.get("session_id"))
 
-        sql_query = nl_to_sql(user_question, schema)
-        results = execute_query(sql_query)
-        answer = interpret_results(user_question, results)
-        return jsonify({"response": answer})
+        # One http_ask observation per request; the steps below are timed under their own stages
+        with track("http_ask"), session.lock, deadlines.deadline(deadlines.ASK_DEADLINE_S):
+            # Follow-ups about the previous answer ("of those, which are still pending?") are answered from its rows
+            follow_up = answer_follow_up(session, user_question)
+            if follow_up is not None:
+                return jsonify({"response": follow_up, "metadata": {"source": "session", "session_id": session.id}})
+
+            # "Calls like customer N" and keyword questions ("calls that mention roaming") are answered locally
+            similar_answer = answer_similarity_question(user_question)
+            keyword_answer = answer_keyword_question(user_question) if similar_answer is None else None
+            if similar_answer is not None:
+                session.remember(user_question, similar_answer["matches"])
+                return jsonify({"response": similar_answer["response"], "metadata": {
+                    "source": "call_vectors", "matches": similar_answer["matches"], "session_id": session.id,
+                }})
+            if keyword_answer is not None:
+                session.remember(user_question, keyword_answer["matches"])
+                return jsonify({"response": keyword_answer["response"], "metadata": {
+                    "source": "transcript_index", "total": keyword_answer["total"], "matches": keyword_answer["matches"],
+                    "session_id": session.id,
+                }})
+
+            with usage.collect() as model_calls:
+                sql_query = nl_to_sql(user_question, schema, session.previous_sql)
+                results = execute_query(sql_query)
+                session.remember(user_question, results, sql_query)
+                answer = interpret_results(user_question, results)
+            return jsonify({"response": answer, "metadata": {
+                "token_usage": usage.combine(model_calls), "session_id": session.id,
+            }})
+
+    except deadlines.DeadlineExceeded:
+        return jsonify({"response": "Sorry, that question took too long to answer. Please try again."}), 504
 
     except Exception as e:
         print(e)
         return jsonify({"response": f"Error: {str(e)}"})
 
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render_prometheus(), mimetype=metrics.PROMETHEUS_CONTENT_TYPE)
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -4,13 +4,29 @@ import random
 import json
 import mimetypes
 import time
+import threading
 from pathlib import Path
 from typing import Dict, Any
 from dotenv import load_dotenv
 from google.cloud import bigquery, storage
 from vertexai import init
-from vertexai.generative_models import GenerativeModel, Part
-from pydantic import BaseModel, Field
+from vertexai.generative_models import GenerativeModel, GenerationConfig, Part
+from call_schema import CallAnalysis, parse_call_analysis, response_schema
+from metrics import track, FAILURES, BYTES_PROCESSED
+import usage
+import fingerprint
+import customer_ids
+import identity_index
+import transcript_index
+import call_vectors
+import replica
+import transcript_store
+import model_scheduler
+import model_router
+import hedging
+import deadlines
+import rollups
+import two_phase
 
 load_dotenv()
 
@@ -20,31 +36,52 @@ BIGQUERY_DATASET = # your BigQuery Dataset name
 BIGQUERY_TABLE = # your BigQuery Table name
 GEMINI_MODEL = "gemini-2.5-flash"
 GCS_BUCKET = os.environ.get("GCS_BUCKET", "your-gcs-bucket-name")
+BIGQUERY_USAGE_TABLE = os.environ.get("BIGQUERY_USAGE_TABLE", f"{BIGQUERY_TABLE}_token_usage")  # per-call token usage side table
+BIGQUERY_ROLLUP_TABLE = os.environ.get("BIGQUERY_ROLLUP_TABLE", f"{BIGQUERY_TABLE}_daily_rollup")  # call counts per day and category
+AUDIO_BACKEND = os.environ.get("AUDIO_BACKEND", "gcp")  # "gcp" or "fake" (offline stand-ins from fake_backends.py)
 
 # --- CLIENT INITIALIZATION ---
 try:
-    bigquery_client = bigquery.Client(project=BIGQUERY_PROJECT_ID)
-    storage_client = storage.Client()
-    init(project=BIGQUERY_PROJECT_ID, location="us-central1")
-    gemini_model = GenerativeModel(GEMINI_MODEL)
-    print("✅ Clients initialized successfully.")
+    if AUDIO_BACKEND == "fake":
+        from fake_backends import build_fake_clients
+        bigquery_client, storage_client, gemini_model = build_fake_clients(GEMINI_MODEL)
+    else:
+        bigquery_client = bigquery.Client(project=BIGQUERY_PROJECT_ID)
+        storage_client = storage.Client()
+        init(project=BIGQUERY_PROJECT_ID, location="us-central1")
+        gemini_model = GenerativeModel(GEMINI_MODEL)
+    print(f"✅ Clients initialized successfully ({AUDIO_BACKEND} backend).")
 except Exception as e:
     print(f"❌ Error initializing clients: {e}")
     raise SystemExit(1)
 
 
 # --- STRUCTURE FOR OUTPUT ---
-class CallAnalysis(BaseModel):
-    phone_number: str = Field(description="10-digit number, or 'Incomplete phone number' / 'Missing phone number'")
-    problem_solved: str = Field(description="Solved or Pending")
-    problem_type: str = Field(description="Payment, Network, Recharge")
-    sentiment: str = Field(description="Summary of customer’s emotional tone")
-    full_transcript: str = Field(description="Full corrected transcript text")
+# CallAnalysis (see call_schema.py) constrains generation and validates the response locally
+CALL_ANALYSIS_SCHEMA = response_schema(CallAnalysis)
 
 
 # --- HELPERS ---
 def generate_customer_id() -> int:
-    return random.randint(10000, 99999)
+    return customer_ids.next_customer_id()
+
+
+_identity_synced = False
+
+
+def assign_customer_id(phone_number: str) -> int:
+    """Returns the customer_id already known for this phone number, or a new one.
+    The identity index catches up with BigQuery once per process before its first use."""
+    global _identity_synced
+    index = identity_index.get_index()
+    if not _identity_synced:
+        _identity_synced = True
+        try:
+            with track("identity_sync"):
+                index.sync_from_bigquery(bigquery_client, f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}")
+        except Exception as e:
+            print(f"⚠️ Could not sync identity index from BigQuery: {e}")
+    return index.customer_id_for(phone_number, generate_customer_id)
 
 
 def clean_phone_number(phone: str) -> str:
@@ -63,16 +100,32 @@ def upload_file_to_gcs(local_path: str, bucket_name: str, dest_blob_name: str) -
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(dest_blob_name)
     print(f"⬆️ Uploading {local_path} → gs://{bucket_name}/{dest_blob_name}")
-    blob.upload_from_filename(local_path)
+    with track("gcs_upload"):
+        blob.upload_from_filename(local_path)
+    BYTES_PROCESSED.inc(os.path.getsize(local_path), stage="gcs_upload")
+    return f"gs://{bucket_name}/{dest_blob_name}", mime_type
+
+
+def upload_bytes_to_gcs(data: bytes, filename: str, bucket_name: str, dest_blob_name: str) -> (str, str):
+    """Uploads an in-memory recording (e.g. an archive entry) without writing it to disk first."""
+    mime_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    blob = storage_client.bucket(bucket_name).blob(dest_blob_name)
+    print(f"⬆️ Uploading {filename} → gs://{bucket_name}/{dest_blob_name}")
+    with track("gcs_upload"):
+        blob.upload_from_string(data, content_type=mime_type)
+    BYTES_PROCESSED.inc(len(data), stage="gcs_upload")
     return f"gs://{bucket_name}/{dest_blob_name}", mime_type
 
 
 # --- MAIN PROCESSING FUNCTION ---
-def transcribe_and_analyze_audio(gcs_uri: str, mime_type: str = None) -> Dict[str, Any]:
+def transcribe_and_analyze_audio(gcs_uri: str, mime_type: str = None, audio_bytes: int = None) -> Dict[str, Any]:
     """
     Single Gemini prompt that does BOTH:
     - Transcription
     - Analysis (phone number, problem solved, type, sentiment)
+    With MODEL_CASCADE the cheapest suitable model answers first (see model_router.py).
+    With TWO_PHASE only the analysis fields are generated here; the transcript is left pending
+    for complete_transcript (see two_phase.py).
     """
     mime_type = mime_type or mimetypes.guess_type(gcs_uri)[0] or "audio/wav"
     print(f"🎧 Starting combined transcription + analysis for {gcs_uri} ({mime_type})")
@@ -100,40 +153,125 @@ def transcribe_and_analyze_audio(gcs_uri: str, mime_type: str = None) -> Dict[st
     }
     """
 
-    try:
-        response = gemini_model.generate_content([audio_part, unified_prompt])
+    exclude = ("full_transcript",) if two_phase.enabled() else ()
+    if two_phase.enabled():
+        prompt, generation_config = two_phase.FIELDS_PROMPT, GenerationConfig(
+            response_mime_type="application/json",
+            response_schema=two_phase.FIELDS_SCHEMA,
+            max_output_tokens=two_phase.FIELDS_MAX_OUTPUT_TOKENS,
+        )
+    else:
+        prompt, generation_config = unified_prompt, GenerationConfig(
+            response_mime_type="application/json",
+            response_schema=CALL_ANALYSIS_SCHEMA,
+        )
+
+    def generate(model_name: str):
+        usage.ledger.check_budget()
+        model_scheduler.admit()
+        model = model_router.get_model(model_name, GEMINI_MODEL, gemini_model)
+        with track("gemini_call"):
+            response = hedging.generate(
+                model, model_name, "transcribe_and_analyze_audio",
+                [audio_part, prompt],
+                generation_config=generation_config,
+            )
+        token_usage = usage.record_response(response, model_name, "transcribe_and_analyze_audio")
         raw = response.text.strip()
+        BYTES_PROCESSED.inc(len(raw), stage="gemini_call")
+        return raw, token_usage
 
-        match = re.search(r"```json(.*?)```", raw, re.DOTALL)
-        if match:
-            raw = match.group(1).strip()
+    try:
+        raw, token_usage, _ = model_router.run(
+            "transcribe_and_analyze_audio",
+            model_router.plan(GEMINI_MODEL, audio_bytes=audio_bytes),
+            generate,
+            lambda raw: model_router.check_call_analysis(raw, clean_phone_number, exclude, require_transcript=not exclude),
+        )
 
-        try:
-            parsed = json.loads(raw)
-        except json.JSONDecodeError:
-            print(f"⚠️ Failed to parse JSON from Gemini output. Raw content:\n{raw}")
-            return {"error": "Invalid JSON", "raw_output": raw}
+        with track("json_parse"):
+            parsed, parse_error = parse_call_analysis(raw, exclude)
+        if parse_error:
+            FAILURES.inc(stage="json_parse", error_class="InvalidJSON")
+            print(f"⚠️ Failed to parse JSON from Gemini output ({parse_error}). Raw content:\n{raw}")
+            return {"error": "Invalid JSON", "raw_output": raw, "token_usage": token_usage}
 
         # Validate and clean phone number
         parsed["phone_number"] = clean_phone_number(parsed.get("phone_number", ""))
+        parsed["token_usage"] = token_usage
+        if two_phase.enabled():
+            parsed.update(full_transcript="", transcript_status=two_phase.PENDING, source_uri=gcs_uri)
         return parsed
 
+    except deadlines.DeadlineExceeded:
+        raise  # the request is over: nothing may be stored for it (app.py answers 504)
     except Exception as e:
         print(f"❌ Error during Gemini processing: {e}")
         return {"error": str(e)}
 
 
+def complete_transcript(gcs_uri: str, mime_type: str, customer_id: int, analysis: Dict[str, Any], recording_id: int = None) -> str:
+    """Phase two of TWO_PHASE: generates the transcript of an already loaded call and fills it into its row,
+    and into the analysis stored with its fingerprint (`recording_id`), which near-duplicates reuse.
+    If no transcript can be generated, the row is marked failed (as in batch_processing.py) and the error re-raised."""
+    mime_type = mime_type or mimetypes.guess_type(gcs_uri)[0] or "audio/wav"
+    table_id = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}"
+    try:
+        usage.ledger.check_budget()
+        model_scheduler.admit()
+        with track("transcript_phase"):
+            response = gemini_model.generate_content(
+                [Part.from_uri(gcs_uri, mime_type=mime_type), two_phase.TRANSCRIPT_PROMPT],
+                generation_config=GenerationConfig(
+                    response_mime_type="application/json",
+                    response_schema=two_phase.TRANSCRIPT_SCHEMA,
+                ),
+            )
+        token_usage = usage.record_response(response, GEMINI_MODEL, "complete_transcript")
+        transcript = two_phase.parse_transcript(response.text)
+        if transcript is None:
+            FAILURES.inc(stage="transcript_phase", error_class="EmptyTranscript")
+            raise ValueError("No transcript in the model response")
+    except Exception:
+        try:
+            with track("transcript_update"):
+                written = two_phase.update_transcripts(bigquery_client, storage_client, table_id, [
+                    {"source_uri": gcs_uri, "full_transcript": None, "transcript_status": two_phase.FAILED},
+                ])
+            replica.update_rows(written)
+            update_fingerprint(recording_id, analysis, customer_id, transcript_status=two_phase.FAILED)
+        except Exception as e:
+            print(f"❌ Could not mark the transcript of {gcs_uri} as failed: {e}")
+        raise
+    BYTES_PROCESSED.inc(len(transcript), stage="transcript_phase")
+
+    with track("transcript_update"):
+        written = two_phase.update_transcripts(bigquery_client, storage_client, table_id, [
+            {"source_uri": gcs_uri, "full_transcript": transcript, "transcript_status": two_phase.READY},
+        ])
+    replica.update_rows(written)
+    update_fingerprint(recording_id, analysis, customer_id, full_transcript=transcript, transcript_status=two_phase.READY)
+    if token_usage:
+        usage_table_id = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_USAGE_TABLE}"
+        usage.insert_usage_rows(bigquery_client, usage_table_id, [usage.usage_row(token_usage, customer_id, gcs_uri)])
+    row = [{"customer_id": customer_id, **{key: analysis.get(key, "") for key in two_phase.FIELD_NAMES}, "full_transcript": transcript}]
+    transcript_index.index_rows(row)
+    call_vectors.index_rows(row)
+    print(f"📝 Transcript stored for {gcs_uri}.")
+    return transcript
+
+
 def insert_to_bigquery(data: dict, customer_id: int):
     """Inserts combined results into BigQuery."""
     table_id = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}"
-    schema = [
+    schema = two_phase.table_schema(transcript_store.table_schema([
         bigquery.SchemaField("customer_id", "INTEGER"),
         bigquery.SchemaField("phone_number", "STRING"),
         bigquery.SchemaField("full_transcript", "STRING"),
         bigquery.SchemaField("problem_solved", "STRING"),
         bigquery.SchemaField("problem_type", "STRING"),
         bigquery.SchemaField("sentiment", "STRING"),
-    ]
+    ]))
 
     row = [{
         "customer_id": customer_id,
@@ -143,12 +281,85 @@ def insert_to_bigquery(data: dict, customer_id: int):
         "problem_type": data.get("problem_type", ""),
         "sentiment": data.get("sentiment", ""),
     }]
+    if two_phase.enabled():
+        row[0].update(source_uri=data.get("source_uri"), transcript_status=data.get("transcript_status", two_phase.READY))
 
     print(f"📦 Uploading results for Customer ID {customer_id} to BigQuery...")
-    job_config = bigquery.LoadJobConfig(schema=schema)
-    job = bigquery_client.load_table_from_json(row, table_id, job_config=job_config)
-    job.result()
+    # With TRANSCRIPT_STORE set the table row carries a pointer; the local indexes below still get the full text
+    table_rows = transcript_store.offload_rows(storage_client, row)
+    job_config = bigquery.LoadJobConfig(schema=schema, schema_update_options=two_phase.schema_update_options())
+    deadlines.remaining()  # raises before submitting: a load started after the deadline would still land
+    with track("bigquery_load"):
+        job = bigquery_client.load_table_from_json(table_rows, table_id, job_config=job_config)
+        job.result(timeout=deadlines.remaining())
+    BYTES_PROCESSED.inc(len(json.dumps(table_rows)), stage="bigquery_load")
     print("✅ Data inserted successfully.")
+    if row[0]["full_transcript"]:
+        # A pending two-phase row is indexed by complete_transcript once its transcript exists
+        transcript_index.index_rows(row)
+        call_vectors.index_rows(row)
+    replica.append_rows(table_rows)
+    rollups.record_rows(bigquery_client, f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_ROLLUP_TABLE}", row)
+
+
+def fingerprint_bytes(data: bytes, filename: str):
+    """Returns the fingerprint of a recording, or None when dedup is off or the audio cannot be decoded."""
+    if not fingerprint.FINGERPRINT_DEDUP:
+        return None
+    try:
+        with track("fingerprint"):
+            return fingerprint.fingerprint_audio(data, filename)
+    except Exception as e:
+        FAILURES.inc(stage="fingerprint", error_class=type(e).__name__)
+        print(f"⚠️ Fingerprinting failed for {filename}, analyzing without dedup: {e}")
+        return None
+
+
+def fingerprint_local_file(local_path: str):
+    if not fingerprint.FINGERPRINT_DEDUP:
+        return None
+    return fingerprint_bytes(Path(local_path).read_bytes(), local_path)
+
+
+_pending_analyses: Dict[int, threading.Event] = {}  # fingerprint id → set once its analysis is stored
+_pending_lock = threading.Lock()
+
+
+def claim_fingerprint(fp, gs_uri: str):
+    """Returns (match, None) when an analyzed near-duplicate exists, else (None, recording id) that
+    this upload must analyze. A copy of a recording another thread is still analyzing (e.g. two files
+    of one bulk upload) waits for that analysis instead of running its own, at most until the request deadline."""
+    index = fingerprint.get_index()
+    while True:
+        with _pending_lock:
+            match, recording_id = index.find_or_add(fp, gs_uri)
+            if match is not None and match.analysis is not None:
+                return match, None
+            event = _pending_analyses.get(recording_id)
+            if event is None:
+                # New, or left pending by an upload that failed: this upload analyzes it
+                _pending_analyses[recording_id] = threading.Event()
+                return None, recording_id
+        event.wait(deadlines.remaining())
+
+
+def release_fingerprint(recording_id, analysis: Dict[str, Any] = None, customer_id: int = None):
+    if recording_id is None:
+        return
+    if analysis is not None:
+        fingerprint.get_index().attach_analysis(recording_id, analysis, customer_id)
+    with _pending_lock:
+        event = _pending_analyses.pop(recording_id, None)
+    if event is not None:
+        event.set()
+
+
+def update_fingerprint(recording_id, analysis: Dict[str, Any], customer_id: int, **changes):
+    """Replaces the analysis stored with a fingerprint, e.g. once phase two has the transcript."""
+    if recording_id is None:
+        return
+    analysis = {key: value for key, value in analysis.items() if key != "token_usage"}
+    fingerprint.get_index().attach_analysis(recording_id, {**analysis, **changes}, customer_id)
 
 
 # --- MAIN EXECUTION ---
@@ -156,19 +367,62 @@ def process_local_file_and_upload(local_path: str, bucket_name: str = GCS_BUCKET
     """
     Uploads a local audio file to GCS and runs the complete call analysis pipeline.
     Returns structured analysis data (dict) and gs:// URI.
+    A near-duplicate of an earlier call is neither uploaded nor analyzed: the earlier
+    analysis and customer ID are returned with "duplicate_of" set.
     """
     if dest_blob_name is None:
         dest_blob_name = f"upload_audio/{Path(local_path).stem}_{random.randint(1000,9999)}{Path(local_path).suffix}" # sub folder in GCS Bucket
 
-    gs_uri, mime_type = upload_file_to_gcs(local_path, bucket_name, dest_blob_name)
-    
-    # 🔥 FIXED: call unified transcribe+analyze
-    result = transcribe_and_analyze_audio(gs_uri, mime_type)
+    return _analyze_upload(Path(local_path).name, fingerprint_local_file(local_path), f"gs://{bucket_name}/{dest_blob_name}",
+                           lambda: upload_file_to_gcs(local_path, bucket_name, dest_blob_name), os.path.getsize(local_path))
+
+
+def process_bytes_and_upload(data: bytes, filename: str, bucket_name: str = GCS_BUCKET, dest_blob_name: str = None):
+    """Same pipeline as process_local_file_and_upload for a recording held in memory."""
+    if dest_blob_name is None:
+        dest_blob_name = f"upload_audio/{Path(filename).stem}_{random.randint(1000,9999)}{Path(filename).suffix}"
+
+    return _analyze_upload(filename, fingerprint_bytes(data, filename), f"gs://{bucket_name}/{dest_blob_name}",
+                           lambda: upload_bytes_to_gcs(data, filename, bucket_name, dest_blob_name), len(data))
+
+
+def _analyze_upload(name: str, fp, gs_uri: str, upload, audio_bytes: int = None) -> Dict[str, Any]:
+    match, recording_id = claim_fingerprint(fp, gs_uri) if fp is not None else (None, None)
+    if match is not None:
+        # Linked under the URI it would have been uploaded to, like every other source_uri in the index
+        fingerprint.get_index().link(match.recording_id, gs_uri, fp.duration_s)
+        print(f"♻️ {name} is a near-duplicate of {match.source_uri} (score {match.score}); reusing its analysis.")
+        response = {"gs_uri": match.source_uri, "customer_id": match.customer_id, "result": match.analysis, "duplicate_of": match.source_uri}
+        # The original's transcript is still being generated: poll the same job
+        job_id = two_phase.jobs.find(match.source_uri) if match.analysis.get("transcript_status") == two_phase.PENDING else None
+        if job_id is not None:
+            response["transcript_url"] = f"/upload/transcript/{job_id}"
+        return response
+
+    analysis = customer_id = None
+    try:
+        gs_uri, mime_type = upload()
+
+        # 🔥 FIXED: call unified transcribe+analyze
+        result = transcribe_and_analyze_audio(gs_uri, mime_type, audio_bytes)
+
+        # Failed analyses are returned to the caller but never stored as calls
+        if "error" not in result:
+            customer_id = assign_customer_id(result.get("phone_number", ""))
+            insert_to_bigquery(result, customer_id)
+        if result.get("token_usage"):
+            usage_table_id = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_USAGE_TABLE}"
+            usage.insert_usage_rows(bigquery_client, usage_table_id, [usage.usage_row(result["token_usage"], customer_id, gs_uri)])
 
-    # Optional: insert to BigQuery directly if you want
-    customer_id = generate_customer_id()
-    insert_to_bigquery(result, customer_id)
+        if "error" not in result:
+            analysis = {key: value for key, value in result.items() if key != "token_usage"}
+    finally:
+        # Stores the analysis (or leaves the recording pending after a failure) and wakes up waiting copies
+        release_fingerprint(recording_id, analysis, customer_id)
 
+    if result.get("transcript_status") == two_phase.PENDING:
+        job_id = two_phase.start(gs_uri, lambda: complete_transcript(gs_uri, mime_type, customer_id, result, recording_id))
+        return {"gs_uri": gs_uri, "customer_id": customer_id, "result": result, "transcript_url": f"/upload/transcript/{job_id}"}
     return {"gs_uri": gs_uri, "customer_id": customer_id, "result": result}
 
 if __name__ == "__main__":
@@ -4,6 +4,7 @@ import re
 import random
 import json
 import time  # Added for waiting on async transcription
+import asyncio
 from pathlib import Path
 from google import genai
 from google.genai import types
@@ -11,8 +12,23 @@ from google.cloud import bigquery, storage  # storage added
 from google.cloud import speech_v1p1beta1 as speech  # NEW IMPORT
 from pydantic import BaseModel, Field
 from vertexai import init
-from vertexai.generative_models import GenerativeModel
+from vertexai.generative_models import GenerativeModel, GenerationConfig
 import mimetypes
+import usage
+import customer_ids
+import identity_index
+import transcript_index
+import call_vectors
+import replica
+import transcript_store
+import model_scheduler
+import model_router
+import hedging
+import deadlines
+import rollups
+from call_schema import repair_json
+from stt_async import build_diarized_transcript, recognition_config, transcribe_many
+from transcript_batching import analyze_transcripts_batched
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -22,6 +38,8 @@ BIGQUERY_DATASET = # your BigQuery Dataset name
 BIGQUERY_TABLE = # your BigQuery Table name
 GEMINI_MODEL = "gemini-2.5-pro"
 GCS_BUCKET = os.environ.get("GCS_BUCKET", "your-gcs-bucket-name")  # NEW
+BIGQUERY_USAGE_TABLE = os.environ.get("BIGQUERY_USAGE_TABLE", f"{BIGQUERY_TABLE}_token_usage")
+BIGQUERY_ROLLUP_TABLE = os.environ.get("BIGQUERY_ROLLUP_TABLE", f"{BIGQUERY_TABLE}_daily_rollup")
 
 # --- SPEECH-TO-TEXT CONFIG ---
 # Adjust these based on your audio file properties (e.g., mono/stereo, sample rate)
@@ -88,62 +106,43 @@ def process_local_file_and_upload(local_path: str, bucket_name: str = GCS_BUCKET
 # --- CORE FUNCTIONS ---
 
 def generate_customer_id():
-    """Generates a random 4-5 digit number for the customer ID."""
-    return random.randint(10000, 99999)
+    """Allocates a unique, time-ordered customer ID (see customer_ids.py)."""
+    return customer_ids.next_customer_id()
+
+
+def assign_customer_id(phone_number: str) -> int:
+    """Repeat callers keep the customer_id first assigned to their phone number."""
+    return identity_index.get_index().customer_id_for(phone_number, generate_customer_id)
 
 
 def get_audio_transcript(gcs_uri: str) -> str:
     print(f"Starting Speech-to-Text transcription for: {gcs_uri}")
 
     audio = speech.RecognitionAudio(uri=gcs_uri)
-    config = speech.RecognitionConfig(
-        encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-        language_code="en-US",
-        alternative_language_codes=["en-IN", "hi-IN", "ta-IN", "mr-IN"],
-        enable_speaker_diarization=True,
-        diarization_speaker_count=MAX_SPEAKER_COUNT,
-        model="latest_long",
-    )
-
-    operation = speech_client.long_running_recognize(config=config, audio=audio)
+    operation = speech_client.long_running_recognize(config=recognition_config(), audio=audio)
     print("Waiting for transcription operation to complete...")
     response = operation.result(timeout=10000)
 
     if not response.results:
         raise Exception("Transcription failed: No results returned.")
 
-    words = response.results[-1].alternatives[0].words
-
-    # Determine which speaker spoke first
-    first_speaker_tag = words[0].speaker_tag
-    if first_speaker_tag == 1:
-        speaker_map = {1: "Support", 2: "Customer"}
-    else:
-        speaker_map = {1: "Customer", 2: "Support"}
-
-    transcript_lines = []
-    current_speaker = words[0].speaker_tag
-    current_line = []
-
-    for w in words:
-        if w.speaker_tag != current_speaker:
-            transcript_lines.append(f"{speaker_map[current_speaker]}: {' '.join(current_line)}")
-            current_speaker = w.speaker_tag
-            current_line = []
-        current_line.append(w.word)
+    # Single pass over every result segment (see stt_async.build_diarized_transcript)
+    return build_diarized_transcript(response.results)
 
-    # Add final line
-    if current_line:
-        transcript_lines.append(f"{speaker_map[current_speaker]}: {' '.join(current_line)}")
 
-    reconstructed_transcript = "\n".join(transcript_lines)
-    return reconstructed_transcript
+async def get_audio_transcripts_async(gcs_uris: list) -> dict:
+    """
+    Transcribes many files at once: all long-running operations are submitted up front
+    (bounded by STT_MAX_IN_FLIGHT) and polled together with backoff.
+    Returns {gcs_uri: transcript or Exception}.
+    """
+    return await transcribe_many(speech_client, gcs_uris)
 
 
 
 # Initialize Vertex AI Gemini
 init(project=BIGQUERY_PROJECT_ID, location="us-central1")  # or your region
-gemini_model = GenerativeModel("gemini-2.5-pro")
+gemini_model = GenerativeModel(GEMINI_MODEL)
 
 def analyze_transcript_with_gemini(transcript: str) -> dict:
     """Uses Vertex AI Gemini (authenticated with ADC) to analyze the transcript and parse structured JSON."""
@@ -163,27 +162,61 @@ def analyze_transcript_with_gemini(transcript: str) -> dict:
     Return valid JSON only.
     """
 
-    response = gemini_model.generate_content(prompt)
-    raw = response.text.strip()
+    def generate(model_name: str):
+        usage.ledger.check_budget()
+        model_scheduler.admit()
+        model = model_router.get_model(model_name, GEMINI_MODEL, gemini_model)
+        response = hedging.generate(model, model_name, "analyze_transcript_with_gemini", prompt)
+        token_usage = usage.record_response(response, model_name, "analyze_transcript_with_gemini")
+        raw = response.text.strip()
+
+        # Tolerates ```json fences, trailing commas and truncated output
+        parsed = repair_json(raw)
+        if parsed is None:
+            # fallback if Gemini didn't produce usable JSON
+            parsed = {"raw_text": raw}
+
+        # Normalize keys to match your table fields
+        return {
+            "phone_number": parsed.get("Phone Number", ""),
+            "problem_solved": str(parsed.get("Problem Solved", "")),
+            "problem_type": parsed.get("Problem Type", ""),
+            "sentiment": parsed.get("Sentiment", ""),  # store dict as string
+        }, token_usage
+
+    # With MODEL_CASCADE a cheaper model answers first and the next one only if the answer is unusable
+    analysis, token_usage, _ = model_router.run(
+        "analyze_transcript_with_gemini",
+        model_router.plan(GEMINI_MODEL, transcript_chars=len(transcript)),
+        generate,
+        lambda analysis: model_router.check_analysis_fields(analysis),
+    )
+    analysis["token_usage"] = token_usage
+    return analysis
 
-    # If Gemini wraps the JSON in ```json ... ```
-    match = re.search(r"```json(.*?)```", raw, re.DOTALL)
-    if match:
-        raw = match.group(1).strip()
 
-    try:
-        parsed = json.loads(raw)
-    except Exception:
-        # fallback if Gemini didn't produce clean JSON
-        parsed = {"raw_text": raw}
-
-    # Normalize keys to match your table fields
-    return {
-        "phone_number": parsed.get("Phone Number", ""),
-        "problem_solved": str(parsed.get("Problem Solved", "")),
-        "problem_type": parsed.get("Problem Type", ""),
-        "sentiment": parsed.get("Sentiment", ""),  # store dict as string
-    }
+def analyze_transcripts_with_gemini_batched(transcripts: dict) -> dict:
+    """
+    Batched variant of analyze_transcript_with_gemini: packs many transcripts into each request
+    (under ANALYSIS_BATCH_TOKEN_BUDGET) with the instruction preamble sent once per request.
+    Returns {key: analysis dict or Exception}; failed entries are re-split and retried.
+    """
+    async def generate(prompt: str, schema: dict, max_output_tokens: int):
+        usage.ledger.check_budget()
+        await model_scheduler.admit_async()
+        response = await asyncio.to_thread(
+            gemini_model.generate_content,
+            prompt,
+            generation_config=GenerationConfig(
+                response_mime_type="application/json",
+                response_schema=schema,
+                max_output_tokens=max_output_tokens,
+            ),
+        )
+        token_usage = usage.record_response(response, GEMINI_MODEL, "analyze_transcripts_batched")
+        return response.text, token_usage
+
+    return asyncio.run(analyze_transcripts_batched(transcripts, generate))
 
 
 def insert_to_bigquery(data: dict, transcript: str, customer_id: int):
@@ -191,14 +224,14 @@ def insert_to_bigquery(data: dict, transcript: str, customer_id: int):
 
     table_id = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}"
 
-    schema = [
+    schema = transcript_store.table_schema([
         bigquery.SchemaField("customer_id", "INTEGER"),
         bigquery.SchemaField("phone_number", "STRING"),
         bigquery.SchemaField("full_transcript", "STRING"),
         bigquery.SchemaField("problem_solved", "STRING"),
         bigquery.SchemaField("problem_type", "STRING"),
         bigquery.SchemaField("sentiment", "STRING"),
-    ]
+    ])
 
     row_to_insert = [{
         "customer_id": str(customer_id),
@@ -211,11 +244,17 @@ def insert_to_bigquery(data: dict, transcript: str, customer_id: int):
 
     print(f"Inserting data for Customer ID: {customer_id} into BigQuery...")
 
-    job_config = bigquery.LoadJobConfig(schema=schema)
-    job = bigquery_client.load_table_from_json(row_to_insert, table_id, job_config=job_config)
-    job.result()  # Wait for job to finish
+    table_rows = transcript_store.offload_rows(storage_client, row_to_insert)
+    job_config = bigquery.LoadJobConfig(schema=schema, schema_update_options=transcript_store.schema_update_options())
+    deadlines.remaining()  # raises before submitting: a load started after the deadline would still land
+    job = bigquery_client.load_table_from_json(table_rows, table_id, job_config=job_config)
+    job.result(timeout=deadlines.remaining())  # Wait for job to finish
 
     print("✅ Data successfully loaded into BigQuery.")
+    transcript_index.index_rows(row_to_insert)
+    call_vectors.index_rows(row_to_insert)
+    replica.append_rows(table_rows)
+    rollups.record_rows(bigquery_client, f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_ROLLUP_TABLE}", row_to_insert)
 
 
 
@@ -231,6 +270,8 @@ def process_call_analysis(gcs_uri: str):
     # 1. Transcription
     try:
         transcript = get_audio_transcript(gcs_uri)
+    except deadlines.DeadlineExceeded:
+        raise
     except Exception as e:
         print(f"Transcription Error: {e}")
         return {"error": f"Transcription failed: {e}"}
@@ -240,13 +281,17 @@ def process_call_analysis(gcs_uri: str):
     try:
         analysis_data = analyze_transcript_with_gemini(transcript)
         print("Analysis successful.")
+    except deadlines.DeadlineExceeded:
+        raise
     except Exception as e:
         print(f"Error during Gemini analysis: {e}")
         return {"error": f"Gemini analysis failed: {e}"}
 
     # 3. BigQuery Insert
-    customer_id = generate_customer_id()
+    customer_id = assign_customer_id(analysis_data.get("phone_number", ""))
     insert_to_bigquery(analysis_data, transcript, customer_id)
+    usage_table_id = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_USAGE_TABLE}"
+    usage.insert_usage_rows(bigquery_client, usage_table_id, [usage.usage_row(analysis_data["token_usage"], customer_id, gcs_uri)])
 
     summary = {
         "customer_id": customer_id,
@@ -260,6 +305,36 @@ def process_call_analysis(gcs_uri: str):
     return summary
 
 
+def process_call_analyses(gcs_uris: list) -> list:
+    """
+    Batch variant of process_call_analysis: concurrent Speech-to-Text for every file,
+    batched Gemini analysis of the transcripts, then BigQuery storage per call.
+    """
+    transcripts = asyncio.run(get_audio_transcripts_async(gcs_uris))
+    summaries = []
+    for gcs_uri, transcript in transcripts.items():
+        if isinstance(transcript, Exception):
+            print(f"Transcription Error for {gcs_uri}: {transcript}")
+            summaries.append({"gcs_uri": gcs_uri, "error": f"Transcription failed: {transcript}"})
+    transcripts = {uri: t for uri, t in transcripts.items() if not isinstance(t, Exception)}
+    print(f"Sending {len(transcripts)} transcripts to Gemini for batched analysis...")
+    analyses = analyze_transcripts_with_gemini_batched(transcripts)
+    for gcs_uri, transcript in transcripts.items():
+        analysis_data = analyses.get(gcs_uri, ValueError("Transcript was not analyzed"))
+        if isinstance(analysis_data, Exception):
+            print(f"Error during Gemini analysis for {gcs_uri}: {analysis_data}")
+            summaries.append({"gcs_uri": gcs_uri, "error": f"Gemini analysis failed: {analysis_data}"})
+            continue
+        analysis_data.setdefault("token_usage", {})
+        customer_id = assign_customer_id(analysis_data.get("phone_number", ""))
+        insert_to_bigquery(analysis_data, transcript, customer_id)
+        usage_table_id = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_USAGE_TABLE}"
+        if analysis_data["token_usage"]:
+            usage.insert_usage_rows(bigquery_client, usage_table_id, [usage.usage_row(analysis_data["token_usage"], customer_id, gcs_uri)])
+        summaries.append({"gcs_uri": gcs_uri, "customer_id": customer_id, "transcript": transcript, "analysis_data": analysis_data})
+    return summaries
+
+
 # --- MAIN EXECUTION (for direct testing) ---
 if __name__ == "__main__":
     # Example local path test
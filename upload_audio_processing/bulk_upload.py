@@ -0,0 +1,233 @@
+# bulk_upload.py
+# Bulk uploads: many recordings or zip/tar archives in one request, processed as a background job.
+# Archive entries are streamed out one at a time (never extracted to disk) into a bounded worker pool,
+# and every file's progress and result can be polled while the job runs.
+import os
+import bz2
+import gzip
+import lzma
+import time
+import uuid
+import shutil
+import tarfile
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from metrics import track, FAILURES, BYTES_PROCESSED
+import model_scheduler
+
+# --- CONFIGURATION ---
+BULK_UPLOAD_CONCURRENCY = int(os.getenv("BULK_UPLOAD_CONCURRENCY", "8"))  # files analyzed at once, across jobs
+BULK_MAX_ENTRY_BYTES = int(os.getenv("BULK_MAX_ENTRY_MB", "100")) * 1024 * 1024
+BULK_MAX_FILES = int(os.getenv("BULK_MAX_FILES", "5000"))  # per job
+BULK_JOB_TTL_S = int(os.getenv("BULK_JOB_TTL_S", "86400"))  # finished jobs are forgotten after this long
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+COMPRESSED_SUFFIXES = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}  # one compressed recording
+
+Entry = Tuple[str, Optional[bytes], str]  # (name, data, reason it was skipped)
+
+
+def is_archive(filename: str) -> bool:
+    return filename.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def _decompressor(filename: str) -> Optional[Callable]:
+    return None if is_archive(filename) else COMPRESSED_SUFFIXES.get(os.path.splitext(filename.lower())[1])
+
+
+def _is_metadata(name: str) -> bool:
+    # Folders and OS droppings (__MACOSX/, ._foo.wav, .DS_Store) are not recordings
+    parts = name.replace("\\", "/").split("/")
+    return name.endswith("/") or "__MACOSX" in parts or parts[-1].startswith(".")
+
+
+def _read_entry(name: str, stream, allowed: Callable[[str], bool]) -> Optional[Entry]:
+    if _is_metadata(name):
+        return None
+    if not allowed(name):
+        return name, None, "File type not allowed"
+    # Read one byte past the limit so a lying header (zip bomb) cannot make us buffer more
+    data = stream.read(BULK_MAX_ENTRY_BYTES + 1)
+    if len(data) > BULK_MAX_ENTRY_BYTES:
+        return name, None, f"Larger than {BULK_MAX_ENTRY_BYTES // (1024 * 1024)} MB"
+    return name, data, ""
+
+
+def iter_archive_entries(path: str, allowed: Callable[[str], bool]) -> Iterator[Entry]:
+    """Yields the audio entries of a zip or tar archive one at a time."""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                with archive.open(info) as stream:
+                    entry = _read_entry(info.filename, stream, allowed)
+                if entry:
+                    yield entry
+        return
+    # "r|*" reads the tar sequentially, whatever its compression, without seeking back
+    with tarfile.open(path, mode="r|*") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            entry = _read_entry(member.name, archive.extractfile(member), allowed)
+            if entry:
+                yield entry
+
+
+def iter_sources(sources: List[Tuple[str, str]], allowed: Callable[[str], bool]) -> Iterator[Entry]:
+    """`sources` are (display name, saved path) of uploaded parts: loose recordings or archives."""
+    for name, path in sources:
+        if is_archive(name):
+            try:
+                for entry_name, data, skipped in iter_archive_entries(path, allowed):
+                    yield f"{name}/{entry_name}", data, skipped
+            except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError) as e:
+                yield name, None, f"Unreadable archive: {e}"
+        elif _decompressor(name):
+            # A single compressed recording (call.wav.gz) is analyzed as the file inside it
+            inner = os.path.splitext(name)[0]
+            try:
+                with _decompressor(name)(path, "rb") as stream:
+                    entry = _read_entry(inner, stream, allowed)
+            except (EOFError, OSError, lzma.LZMAError) as e:
+                entry = name, None, f"Unreadable compressed file: {e}"
+            yield entry or (inner, None, "Not an audio file")
+        else:
+            with open(path, "rb") as stream:
+                yield _read_entry(name, stream, allowed) or (name, None, "Not an audio file")
+
+
+class BulkJob:
+    """Progress of one bulk upload. Files move from queued → processing → done/duplicate/failed
+    (or are skipped before queueing)."""
+
+    def __init__(self, workdir: str):
+        self.id = uuid.uuid4().hex
+        self.workdir = workdir
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.reading = True
+        self.error = ""
+        self.files: List[Dict[str, Any]] = []
+        self.lock = threading.Lock()
+
+    def add_file(self, name: str, status: str = "queued", error: str = "") -> Dict[str, Any]:
+        entry = {"name": name, "status": status}
+        if error:
+            entry["error"] = error
+        with self.lock:
+            self.files.append(entry)
+        return entry
+
+    def update(self, entry: Dict[str, Any], **fields):
+        with self.lock:
+            entry.update(fields)
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            files = [dict(entry) for entry in self.files]
+        counts: Dict[str, int] = {}
+        for entry in files:
+            counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+        return {
+            "job_id": self.id,
+            "state": "finished" if self.finished else ("reading" if self.reading else "processing"),
+            "total": len(files),
+            "counts": counts,
+            "elapsed_s": round((self.finished_at or time.time()) - self.created_at, 1),
+            "error": self.error,
+            "files": files,
+        }
+
+
+_executor = ThreadPoolExecutor(max_workers=BULK_UPLOAD_CONCURRENCY, thread_name_prefix="bulk-upload")
+_jobs: Dict[str, BulkJob] = {}
+_jobs_lock = threading.Lock()
+
+
+def get_job(job_id: str) -> Optional[BulkJob]:
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def _prune_jobs():
+    cutoff = time.time() - BULK_JOB_TTL_S
+    with _jobs_lock:
+        for job_id in [j.id for j in _jobs.values() if j.finished and j.finished_at < cutoff]:
+            del _jobs[job_id]
+
+
+def start_job(workdir: str, sources: List[Tuple[str, str]], allowed: Callable[[str], bool],
+              process: Callable[[str, bytes], Dict[str, Any]]) -> BulkJob:
+    """Starts processing the saved uploads in `workdir` (removed when the job ends).
+    `process(name, data)` returns the same dict as audio_processing.process_bytes_and_upload."""
+    _prune_jobs()
+    job = BulkJob(workdir)
+    with _jobs_lock:
+        _jobs[job.id] = job
+    threading.Thread(target=_run_job, args=(job, sources, allowed, process), name=f"bulk-{job.id[:8]}", daemon=True).start()
+    return job
+
+
+def _summarize(outcome: Dict[str, Any]) -> Dict[str, Any]:
+    # Transcripts stay out of the progress payload; they are in BigQuery
+    result = outcome.get("result") or {}
+    summary = {key: result.get(key, "") for key in ("phone_number", "problem_type", "problem_solved", "sentiment")}
+    summary.update({"gs_uri": outcome.get("gs_uri", ""), "customer_id": outcome.get("customer_id")})
+    if outcome.get("duplicate_of"):
+        summary["duplicate_of"] = outcome["duplicate_of"]
+    return summary
+
+
+def _process_entry(job: BulkJob, entry: Dict[str, Any], data: bytes, process, slots: threading.BoundedSemaphore):
+    try:
+        job.update(entry, status="processing")
+        # Bulk files are backlog work: they only use model capacity left over by interactive requests
+        with track("bulk_upload_file"), model_scheduler.priority(model_scheduler.BATCH):
+            outcome = process(entry["name"], data)
+        error = (outcome.get("result") or {}).get("error")
+        if error:
+            job.update(entry, status="failed", error=str(error), result=_summarize(outcome))
+        else:
+            job.update(entry, status="duplicate" if outcome.get("duplicate_of") else "done", result=_summarize(outcome))
+    except Exception as e:
+        job.update(entry, status="failed", error=str(e))
+    finally:
+        slots.release()
+
+
+def _run_job(job: BulkJob, sources, allowed, process):
+    # At most two recordings per worker are held in memory: the reader blocks until a slot frees up
+    slots = threading.BoundedSemaphore(BULK_UPLOAD_CONCURRENCY * 2)
+    futures = []
+    try:
+        for name, data, skipped in iter_sources(sources, allowed):
+            if skipped:
+                job.add_file(name, "skipped", skipped)
+                continue
+            if len(futures) >= BULK_MAX_FILES:
+                job.add_file(name, "skipped", f"More than {BULK_MAX_FILES} files in one job")
+                continue
+            BYTES_PROCESSED.inc(len(data), stage="bulk_upload")
+            entry = job.add_file(name)
+            slots.acquire()
+            futures.append(_executor.submit(_process_entry, job, entry, data, process, slots))
+        job.reading = False
+        wait(futures)
+    except Exception as e:
+        FAILURES.inc(stage="bulk_upload", error_class=type(e).__name__)
+        job.error = str(e)
+        print(f"❌ Bulk upload {job.id} stopped reading its uploads: {e}")
+        wait(futures)
+    finally:
+        job.reading = False
+        shutil.rmtree(job.workdir, ignore_errors=True)
+        job.finished_at = time.time()
+        counts = job.to_dict()["counts"]
+        print(f"🏁 Bulk upload {job.id} finished in {round(job.finished_at - job.created_at, 1)}s: {counts}")
@@ -0,0 +1,216 @@
+# call_schema.py
+# Structured output contract for call analysis: the pydantic model, the Gemini response schema
+# derived from it, and a local repair/validation layer for almost-valid JSON.
+import re
+import json
+from enum import Enum
+from typing import Dict, Any, List, Optional, Sequence, Tuple
+from pydantic import BaseModel, Field, ValidationError, field_validator
+
+
+class ProblemSolved(str, Enum):
+    SOLVED = "Solved"
+    PENDING = "Pending"
+
+
+class ProblemType(str, Enum):
+    PAYMENT = "Payment"
+    NETWORK = "Network"
+    RECHARGE = "Recharge"
+
+
+# Lower-cased phrases the model sometimes uses instead of the exact enum value
+PROBLEM_SOLVED_SYNONYMS = {
+    "solved": ProblemSolved.SOLVED, "resolved": ProblemSolved.SOLVED, "fixed": ProblemSolved.SOLVED,
+    "fully solved": ProblemSolved.SOLVED, "completed": ProblemSolved.SOLVED, "yes": ProblemSolved.SOLVED,
+    "true": ProblemSolved.SOLVED,
+    "pending": ProblemSolved.PENDING, "unsolved": ProblemSolved.PENDING, "not solved": ProblemSolved.PENDING,
+    "unresolved": ProblemSolved.PENDING, "partially solved": ProblemSolved.PENDING, "open": ProblemSolved.PENDING,
+    "escalated": ProblemSolved.PENDING, "no": ProblemSolved.PENDING, "false": ProblemSolved.PENDING,
+}
+PROBLEM_TYPE_KEYWORDS = (
+    (ProblemType.RECHARGE, ("recharge", "top-up", "top up", "topup", "plan", "pack")),
+    (ProblemType.PAYMENT, ("payment", "pay", "bill", "refund", "charge", "debit", "upi", "card")),
+    (ProblemType.NETWORK, ("network", "signal", "internet", "data", "roaming", "coverage", "call drop", "speed")),
+)
+
+
+class CallAnalysis(BaseModel):
+    phone_number: str = Field(default="Missing phone number", description="10-digit number, or 'Incomplete phone number' / 'Missing phone number'")
+    problem_solved: ProblemSolved = Field(description="Solved or Pending")
+    problem_type: ProblemType = Field(description="Payment, Network, Recharge")
+    sentiment: str = Field(default="", description="Summary of customer’s emotional tone")
+    full_transcript: str = Field(default="", description="Full corrected transcript text")
+
+    @field_validator("phone_number", "sentiment", "full_transcript", mode="before")
+    @classmethod
+    def _coerce_text(cls, value):
+        if value is None:
+            return ""
+        if isinstance(value, list):
+            return "\n".join(v if isinstance(v, str) else json.dumps(v) for v in value)
+        if isinstance(value, dict):
+            return json.dumps(value)
+        return str(value)
+
+    @field_validator("problem_solved", mode="before")
+    @classmethod
+    def _coerce_problem_solved(cls, value):
+        if isinstance(value, bool):
+            return ProblemSolved.SOLVED if value else ProblemSolved.PENDING
+        key = str(value or "").strip().strip(".").lower()
+        return PROBLEM_SOLVED_SYNONYMS.get(key, value)
+
+    @field_validator("problem_type", mode="before")
+    @classmethod
+    def _coerce_problem_type(cls, value):
+        text = str(value or "").strip().lower()
+        for problem_type, keywords in PROBLEM_TYPE_KEYWORDS:
+            if text == problem_type.value.lower():
+                return problem_type
+        for problem_type, keywords in PROBLEM_TYPE_KEYWORDS:
+            if any(k in text for k in keywords):
+                return problem_type
+        return value
+
+
+def response_schema(model=CallAnalysis, exclude: Sequence[str] = ()) -> Dict[str, Any]:
+    """Builds the Vertex AI `response_schema` (OpenAPI subset) for `model`, in field order."""
+    properties = {}
+    for name, field in model.model_fields.items():
+        if name in exclude:
+            continue
+        prop = {"type": "STRING", "description": field.description or name}
+        if isinstance(field.annotation, type) and issubclass(field.annotation, Enum):
+            prop["enum"] = [member.value for member in field.annotation]
+        properties[name] = prop
+    return {
+        "type": "OBJECT",
+        "properties": properties,
+        "required": list(properties),
+        "property_ordering": list(properties),
+    }
+
+
+# --- LOCAL REPAIR ---
+def _strip_wrapping(text: str, opener: str = "{") -> str:
+    text = text.strip()
+    fenced = re.search(r"```(?:json)?\s*(.*?)(?:```|$)", text, re.DOTALL | re.IGNORECASE)
+    if fenced:
+        text = fenced.group(1).strip()
+    start = text.find(opener)
+    if start > 0:
+        text = text[start:]
+    return text
+
+
+def _close_structure(text: str) -> Tuple[str, List[int]]:
+    """Single pass that escapes raw control characters inside strings, drops trailing commas and
+    closes an unterminated string plus any open objects/arrays. Also returns the input offsets of
+    structural commas so a dangling key/value can be cut off if the result still doesn't parse."""
+    out = []
+    stack = []
+    commas = []
+    in_string = escape = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            elif ch in "\n\r\t":
+                out.append({"\n": "\\n", "\r": "\\r", "\t": "\\t"}[ch])
+                continue
+            out.append(ch)
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            if not stack:
+                continue
+            stack.pop()
+        elif ch == ",":
+            commas.append(i)
+        out.append(ch)
+        if not stack and ch in "}]":
+            break
+    if escape:
+        out.pop()
+    if in_string:
+        out.append('"')
+    tail = "".join(out).rstrip()
+    if tail.endswith(","):
+        tail = tail[:-1]
+    elif tail.endswith(":"):
+        tail += ' ""'
+    return tail + "".join(reversed(stack)), commas
+
+
+def _loads_as(text: str, kind: type):
+    try:
+        parsed = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    return parsed if isinstance(parsed, kind) else None
+
+
+def _repair(text: str, kind: type):
+    if not text:
+        return None
+    body = _strip_wrapping(text, "{" if kind is dict else "[")
+    parsed = _loads_as(body, kind)
+    if parsed is not None:
+        return parsed
+    candidate, commas = _close_structure(body)
+    parsed = _loads_as(candidate, kind)
+    if parsed is not None:
+        return parsed
+    # Truncated in the middle of a key or element: cut back to the last complete member
+    for offset in reversed(commas[-5:]):
+        parsed = _loads_as(_close_structure(body[:offset])[0], kind)
+        if parsed is not None:
+            return parsed
+    return None
+
+
+def repair_json(text: str) -> Optional[Dict[str, Any]]:
+    """Parses almost-valid model JSON (fenced blocks, trailing commas, truncated output).
+    Returns None when nothing usable can be recovered."""
+    return _repair(text, dict)
+
+
+def repair_json_array(text: str) -> Optional[List[Any]]:
+    """repair_json for responses whose top level is an array (batched analysis)."""
+    return _repair(text, list)
+
+
+def validate_call_analysis(data: Dict[str, Any], exclude: Sequence[str] = ()) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """Validates (and coerces) a parsed payload against CallAnalysis.
+    Returns (clean_dict, None) or (None, error_message)."""
+    payload = dict(data)
+    for name in exclude:
+        payload.setdefault(name, "")
+    try:
+        analysis = CallAnalysis.model_validate(payload)
+    except ValidationError as e:
+        return None, "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+    result = analysis.model_dump(mode="json")
+    for name in exclude:
+        result.pop(name, None)
+    return result, None
+
+
+def parse_call_analysis(text: str, exclude: Sequence[str] = ()) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """repair_json + validate_call_analysis in one step."""
+    data = repair_json(text)
+    if data is None:
+        return None, "No JSON object could be recovered"
+    return validate_call_analysis(data, exclude)
@@ -0,0 +1,260 @@
+# call_vectors.py
+# "Similar calls" retrieval without model calls: every analyzed call becomes a hashed word/bigram vector
+# of its transcript and sentiment, appended to a memory-mapped float32 matrix, and queries are a batched
+# NumPy dot product (cosine on unit vectors) with an IDF-weighted query and top-k selection.
+import os
+import re
+import zlib
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+import numpy as np
+from transcript_index import call_key
+import transcript_store
+
+# --- CONFIGURATION ---
+SIMILARITY_DIR = os.getenv("SIMILARITY_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "call_vectors"))
+SIMILARITY_DIM = int(os.getenv("SIMILARITY_DIM", "256"))  # power of two; 256 × 4 bytes per call
+SENTIMENT_WEIGHT = float(os.getenv("SIMILARITY_SENTIMENT_WEIGHT", "0.5"))
+SCAN_CHUNK_ROWS = 65536
+EXCERPT_CHARS = 240
+
+TOKEN = re.compile(r"[a-z0-9]+")
+STOPWORDS = {
+    "customer", "support", "the", "a", "an", "and", "or", "but", "is", "are", "was", "were", "be", "been", "to",
+    "of", "in", "on", "for", "with", "at", "by", "it", "its", "this", "that", "i", "im", "me", "my", "you", "your",
+    "we", "our", "he", "she", "they", "them", "can", "will", "would", "could", "please", "thank", "thanks", "yes",
+    "no", "ok", "okay", "so", "do", "does", "did", "have", "has", "had", "not", "let", "may", "how", "what", "just",
+    "sir", "madam", "hello", "hi", "s", "t", "ll", "ve", "re", "m", "d", "am", "there", "here", "from", "as", "if",
+}
+
+
+def _features(text: str) -> List[str]:
+    words = [w for w in TOKEN.findall((text or "").lower()) if w not in STOPWORDS]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+def _hashed(text: str, dim: int) -> np.ndarray:
+    """Signed feature hashing with sublinear term frequency, L2-normalized."""
+    vector = np.zeros(dim, dtype=np.float32)
+    features = _features(text)
+    if not features:
+        return vector
+    hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) for f in features), dtype=np.uint32, count=len(features))
+    buckets = (hashes & (dim - 1)).astype(np.intp)
+    signs = np.where((hashes >> 20) & 1, 1.0, -1.0).astype(np.float32)
+    np.add.at(vector, buckets, signs)
+    vector = np.sign(vector) * np.log1p(np.abs(vector))
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def vectorize(full_transcript: str, sentiment: str = "", dim: int = SIMILARITY_DIM) -> np.ndarray:
+    vector = _hashed(full_transcript, dim) + SENTIMENT_WEIGHT * _hashed(sentiment, dim)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class CallVectors:
+    """Append-only matrix of call vectors (`vectors.f32`) plus an SQLite table mapping matrix rows to
+    calls. Appends from several processes are serialized by the SQLite write lock; readers remap the
+    matrix when they see more rows, so ingest and `/ask` can run in different processes."""
+
+    def __init__(self, directory: str = SIMILARITY_DIR, dim: int = SIMILARITY_DIM):
+        if dim & (dim - 1):
+            raise ValueError(f"SIMILARITY_DIM must be a power of two, got {dim}")
+        os.makedirs(directory, exist_ok=True)
+        self.dim = dim
+        self.matrix_path = os.path.join(directory, "vectors.f32")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(directory, "calls.sqlite"), check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS calls (
+                row INTEGER PRIMARY KEY,
+                call_key TEXT NOT NULL UNIQUE,
+                customer_id INTEGER,
+                phone_number TEXT,
+                problem_type TEXT,
+                problem_solved TEXT,
+                sentiment TEXT,
+                excerpt TEXT,
+                source_uri TEXT
+            );
+            CREATE INDEX IF NOT EXISTS calls_by_customer ON calls (customer_id);
+            CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value INTEGER);
+            INSERT OR IGNORE INTO settings (key, value) VALUES ('dim', {dim});
+        """)
+        (stored_dim,) = self.conn.execute("SELECT value FROM settings WHERE key = 'dim'").fetchone()
+        if stored_dim != dim:
+            raise ValueError(f"{directory} holds {stored_dim}-dimensional vectors; SIMILARITY_DIM is {dim}")
+        if not os.path.exists(self.matrix_path):
+            open(self.matrix_path, "wb").close()
+        self._matrix: Optional[np.ndarray] = None
+        self._rows = 0
+        self._df = np.zeros(dim, dtype=np.float64)  # calls with a non-zero weight per bucket, for query IDF
+        self._df_rows = 0
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM calls").fetchone()[0]
+
+    # --- writes ---
+    def add_rows(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """Vectorizes and appends analyzed rows (BigQuery row dicts). Calls already present are skipped."""
+        candidates = {}
+        for row in rows:
+            if row.get("full_transcript") and not row.get("duplicate_of"):
+                candidates.setdefault(call_key(row), row)
+        if not candidates:
+            return 0
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                keys = list(candidates)
+                known = set()
+                for i in range(0, len(keys), 900):
+                    chunk = keys[i:i + 900]
+                    known.update(k for (k,) in self.conn.execute(
+                        f"SELECT call_key FROM calls WHERE call_key IN ({','.join('?' * len(chunk))})", chunk))
+                new = [(key, row) for key, row in candidates.items() if key not in known]
+                if not new:
+                    self.conn.execute("COMMIT")
+                    return 0
+                start = self.conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM calls").fetchone()[0]
+                vectors = np.stack([vectorize(row["full_transcript"], row.get("sentiment") or "", self.dim) for _, row in new])
+                # Written before the rows are committed: readers never map rows that are not yet visible
+                with open(self.matrix_path, "r+b") as f:
+                    f.seek(start * self.dim * 4)
+                    f.write(vectors.astype(np.float32).tobytes())
+                self.conn.executemany(
+                    "INSERT INTO calls (row, call_key, customer_id, phone_number, problem_type, problem_solved, sentiment, excerpt, source_uri) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (start + i, key, row.get("customer_id"), row.get("phone_number"), row.get("problem_type"),
+                         row.get("problem_solved"), row.get("sentiment"), (row["full_transcript"] or "")[:EXCERPT_CHARS],
+                         row.get("source_uri"))
+                        for i, (key, row) in enumerate(new)
+                    ],
+                )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return len(new)
+
+    # --- reads ---
+    def _refresh(self) -> np.ndarray:
+        rows = self.conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM calls").fetchone()[0]
+        if rows != self._rows or self._matrix is None:
+            self._matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r", shape=(rows, self.dim)) if rows else np.zeros((0, self.dim), np.float32)
+            # Document frequencies only need the newly appended rows
+            for start in range(self._df_rows, rows, SCAN_CHUNK_ROWS):
+                self._df += np.count_nonzero(self._matrix[start:start + SCAN_CHUNK_ROWS], axis=0)
+            self._df_rows = self._rows = rows
+        return self._matrix
+
+    def _top_k(self, query: np.ndarray, k: int, exclude: Iterable[int] = ()) -> List[tuple]:
+        matrix = self._refresh()
+        if not len(matrix):
+            return []
+        idf = np.log((1 + len(matrix)) / (1 + self._df)).astype(np.float32) + 1
+        weighted = query * idf
+        weighted /= np.linalg.norm(weighted) or 1
+        excluded = set(exclude)
+        wanted = k + len(excluded)
+        best_rows, best_scores = np.empty(0, np.int64), np.empty(0, np.float32)
+        for start in range(0, len(matrix), SCAN_CHUNK_ROWS):
+            scores = matrix[start:start + SCAN_CHUNK_ROWS] @ weighted
+            if len(scores) > wanted:
+                top = np.argpartition(scores, -wanted)[-wanted:]
+            else:
+                top = np.arange(len(scores))
+            best_rows = np.concatenate([best_rows, top + start])
+            best_scores = np.concatenate([best_scores, scores[top]])
+            if len(best_rows) > wanted:
+                keep = np.argpartition(best_scores, -wanted)[-wanted:]
+                best_rows, best_scores = best_rows[keep], best_scores[keep]
+        order = np.argsort(-best_scores)
+        return [(int(best_rows[i]), float(best_scores[i])) for i in order if int(best_rows[i]) not in excluded][:k]
+
+    def _describe(self, hits: List[tuple]) -> List[Dict[str, Any]]:
+        if not hits:
+            return []
+        by_row = {r["row"]: dict(r) for r in self._fetch(f"row IN ({','.join('?' * len(hits))})", [row for row, _ in hits])}
+        results = []
+        for row, score in hits:
+            call = by_row.get(row)
+            if call is not None:
+                call.pop("call_key", None)
+                call["similarity"] = round(score, 4)
+                results.append(call)
+        return results
+
+    def _fetch(self, where: str, params: list) -> List[sqlite3.Row]:
+        cursor = self.conn.execute(f"SELECT * FROM calls WHERE {where}", params)
+        cursor.row_factory = sqlite3.Row
+        return cursor.fetchall()
+
+    def similar_to_customer(self, customer_id: int, k: int = 10) -> Optional[List[Dict[str, Any]]]:
+        """Calls most similar to this customer's calls (their own calls excluded). None if the customer is unknown."""
+        with self.lock:
+            own = [r["row"] for r in self._fetch("customer_id = ?", [customer_id])]
+            if not own:
+                return None
+            matrix = self._refresh()
+            query = np.asarray(matrix[own]).mean(axis=0)
+            return self._describe(self._top_k(query, k, exclude=own))
+
+    def similar_to_text(self, text: str, k: int = 10) -> List[Dict[str, Any]]:
+        with self.lock:
+            return self._describe(self._top_k(vectorize(text, "", self.dim), k))
+
+
+_index: Optional[CallVectors] = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> CallVectors:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = CallVectors()
+        return _index
+
+
+def index_rows(rows: List[Dict[str, Any]]):
+    """Appends freshly loaded rows. The vectors are a derived cache, so failures never fail ingest."""
+    try:
+        get_index().add_rows(rows)
+    except Exception as e:
+        print(f"⚠️ Could not update the similar-calls index: {e}")
+
+
+def rebuild_from_bigquery(bigquery_client, table_id: str) -> int:
+    """One-off backfill for rows loaded before the index existed. Returns the number of calls added."""
+    fields = ("customer_id", "phone_number", "problem_type", "problem_solved", "sentiment", "full_transcript")
+    query, columns = transcript_store.backfill_query(table_id, fields)
+    added, batch = 0, []
+    for result in bigquery_client.query(query).result():
+        batch.append({column: result[column] for column in columns})
+        if len(batch) >= 5000:
+            added += get_index().add_rows(transcript_store.hydrate(batch, limit=None))
+            batch = []
+    return added + get_index().add_rows(transcript_store.hydrate(batch, limit=None))
+
+
+def similar_calls(customer_id: int = None, text: str = None, k: int = 10) -> Optional[List[Dict[str, Any]]]:
+    """Python entry point: calls like a customer's calls, or like a free-text description."""
+    if customer_id is not None:
+        return get_index().similar_to_customer(int(customer_id), k)
+    return get_index().similar_to_text(text or "", k)
+
+
+if __name__ == "__main__":
+    import sys
+    if "--rebuild" not in sys.argv:
+        print("Usage: python call_vectors.py --rebuild   (backfills the similar-calls index from BigQuery)")
+        raise SystemExit(1)
+    from nlp_sql import bigquery_client, BIGQUERY_PROJECT_ID, BIGQUERY_DATASET, BIGQUERY_TABLE
+    count = rebuild_from_bigquery(bigquery_client, f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}")
+    print(f"✅ Vectorized {count} calls ({len(get_index())} in total).")
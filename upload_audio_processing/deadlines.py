@@ -0,0 +1,47 @@
+# deadlines.py
+# Per-request deadlines: an HTTP handler opens `deadline(seconds)` and every model or BigQuery call made
+# while handling it reads `remaining()` to bound its own wait, so no single slow call outlives the request.
+import os
+import time
+import contextvars
+from contextlib import contextmanager
+from typing import Optional
+
+# --- CONFIGURATION ---
+UPLOAD_DEADLINE_S = float(os.getenv("UPLOAD_DEADLINE_S", "300"))
+ASK_DEADLINE_S = float(os.getenv("ASK_DEADLINE_S", "60"))
+
+_deadline: contextvars.ContextVar = contextvars.ContextVar("deadline", default=None)  # time.monotonic() value
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+@contextmanager
+def deadline(seconds: float):
+    """Bounds the enclosed work to `seconds` from now (or less, if an outer deadline is sooner)."""
+    at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(current, at))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the current deadline (None when there is none). Raises once it has passed."""
+    at = _deadline.get()
+    if at is None:
+        return None
+    left = at - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("request deadline exceeded")
+    return left
+
+
+def expired() -> bool:
+    """True once the current deadline has passed (False when there is none)."""
+    at = _deadline.get()
+    return at is not None and time.monotonic() >= at
@@ -0,0 +1,277 @@
+# fingerprint.py
+# Acoustic fingerprints for near-duplicate call detection: spectral peak-pair hashes over decoded audio,
+# kept in a small SQLite index together with the analysis of the first copy that was processed.
+import io
+import os
+import json
+import wave
+import shutil
+import sqlite3
+import threading
+import subprocess
+from datetime import datetime, timezone
+from typing import Dict, Any, NamedTuple, Optional, Tuple
+import numpy as np
+
+# --- CONFIGURATION ---
+FINGERPRINT_DEDUP = os.getenv("FINGERPRINT_DEDUP", "0") == "1"  # opt-in: every recording is downloaded and decoded first
+FINGERPRINT_DB = os.getenv("FINGERPRINT_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fingerprints.sqlite"))
+FINGERPRINT_MIN_MATCHES = int(os.getenv("FINGERPRINT_MIN_MATCHES", "20"))  # aligned hash hits needed for a match
+FINGERPRINT_MATCH_RATIO = float(os.getenv("FINGERPRINT_MATCH_RATIO", "0.2"))  # share of the query's hashes that must align
+SAMPLE_RATE = 8000  # telephone bandwidth is all a call recording carries
+WINDOW = 512
+HOP = 256
+PEAK_FREQ_RADIUS = 10  # bins
+PEAK_TIME_RADIUS = 5  # frames
+FAN_OUT = 5
+MAX_PAIR_DT = 63  # frames; fits in 6 bits of the hash
+QUERY_PHASES = 4  # a copy can start anywhere within a hop, so queries are also hashed at HOP/4, HOP/2, ...
+
+
+class Fingerprint(NamedTuple):
+    hashes: np.ndarray  # uint32 peak-pair hashes
+    times: np.ndarray  # anchor frame of each hash
+    duration_s: float
+    phases: Tuple[Tuple[np.ndarray, np.ndarray], ...] = ()  # (hashes, times) of the sub-hop shifted frame grids
+
+
+class Match(NamedTuple):
+    recording_id: int
+    source_uri: str
+    customer_id: Optional[int]
+    analysis: Optional[Dict[str, Any]]
+    score: int
+    ratio: float
+
+
+# --- DECODING ---
+def _decode_wav(data: bytes) -> Tuple[np.ndarray, int]:
+    with wave.open(io.BytesIO(data), "rb") as w:
+        channels, width, rate = w.getnchannels(), w.getsampwidth(), w.getframerate()
+        frames = w.readframes(w.getnframes())
+    if width == 1:
+        samples = np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128.0
+    elif width == 3:
+        raw = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 3)
+        samples = (raw[:, 0].astype(np.int32) | (raw[:, 1].astype(np.int32) << 8) | (raw[:, 2].astype(np.int8).astype(np.int32) << 16)).astype(np.float32)
+    else:
+        samples = np.frombuffer(frames, dtype={2: np.int16, 4: np.int32}[width]).astype(np.float32)
+    if channels > 1:
+        samples = samples[: len(samples) // channels * channels].reshape(-1, channels).mean(axis=1)
+    return samples, rate
+
+
+def _decode_other(data: bytes) -> Optional[Tuple[np.ndarray, int]]:
+    try:
+        import soundfile
+        samples, rate = soundfile.read(io.BytesIO(data), dtype="float32", always_2d=True)
+        return samples.mean(axis=1), rate
+    except Exception:
+        pass
+    if shutil.which("ffmpeg"):
+        result = subprocess.run(
+            ["ffmpeg", "-v", "quiet", "-i", "pipe:0", "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"],
+            input=data, capture_output=True, timeout=120,
+        )
+        if result.returncode == 0 and result.stdout:
+            return np.frombuffer(result.stdout, dtype=np.int16).astype(np.float32), SAMPLE_RATE
+    return None
+
+
+def decode_audio(data: bytes, filename: str = "") -> Optional[np.ndarray]:
+    """Decodes to mono float32 at SAMPLE_RATE. WAV is read natively; MP3 and others need
+    `soundfile` or an `ffmpeg` binary. Returns None when the audio can't be decoded."""
+    decoded = None
+    if data[:4] == b"RIFF" or filename.lower().endswith(".wav"):
+        try:
+            decoded = _decode_wav(data)
+        except (wave.Error, EOFError, KeyError):
+            decoded = None
+    if decoded is None:
+        decoded = _decode_other(data)
+    if decoded is None:
+        return None
+    samples, rate = decoded
+    if rate != SAMPLE_RATE and len(samples):
+        positions = np.arange(0, len(samples) * SAMPLE_RATE / rate) * rate / SAMPLE_RATE
+        samples = np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+    return samples
+
+
+# --- HASHING ---
+def _local_maxima(spectrogram: np.ndarray) -> np.ndarray:
+    # Separable max filter over a (2*PEAK_FREQ_RADIUS+1) x (2*PEAK_TIME_RADIUS+1) neighbourhood
+    neighbourhood = spectrogram.copy()
+    for axis, radius in ((1, PEAK_FREQ_RADIUS), (0, PEAK_TIME_RADIUS)):
+        source = neighbourhood.copy()
+        for shift in range(1, min(radius, source.shape[axis] - 1) + 1):
+            ahead = [slice(None)] * 2
+            behind = [slice(None)] * 2
+            ahead[axis], behind[axis] = slice(shift, None), slice(None, -shift)
+            np.maximum(neighbourhood[tuple(behind)], source[tuple(ahead)], out=neighbourhood[tuple(behind)])
+            np.maximum(neighbourhood[tuple(ahead)], source[tuple(behind)], out=neighbourhood[tuple(ahead)])
+    return (spectrogram == neighbourhood) & (spectrogram > spectrogram.mean())
+
+
+def _peak_pair_hashes(samples: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    if len(samples) < WINDOW:
+        return np.empty(0, np.uint32), np.empty(0, np.int32)
+    frames = np.lib.stride_tricks.sliding_window_view(samples, WINDOW)[::HOP] * np.hanning(WINDOW)
+    spectrogram = np.log1p(np.abs(np.fft.rfft(frames, axis=1)))
+    times, freqs = np.nonzero(_local_maxima(spectrogram))  # row-major: sorted by time, then frequency
+    hashes, anchors = [], []
+    for k in range(1, FAN_OUT + 1):
+        dt = times[k:] - times[:-k]
+        keep = dt <= MAX_PAIR_DT
+        hashes.append((freqs[:-k][keep].astype(np.uint32) << 15) | (freqs[k:][keep].astype(np.uint32) << 6) | dt[keep].astype(np.uint32))
+        anchors.append(times[:-k][keep])
+    return np.concatenate(hashes), np.concatenate(anchors).astype(np.int32)
+
+
+def fingerprint_samples(samples: np.ndarray, query: bool = True) -> Fingerprint:
+    """Hashes `samples`; with `query` the shifted frame grids used for matching are hashed as well."""
+    hashes, times = _peak_pair_hashes(samples)
+    phases = tuple(
+        _peak_pair_hashes(samples[HOP * phase // QUERY_PHASES:]) for phase in range(1, QUERY_PHASES)
+    ) if query else ()
+    return Fingerprint(hashes, times, len(samples) / SAMPLE_RATE, phases)
+
+
+def fingerprint_audio(data: bytes, filename: str = "") -> Optional[Fingerprint]:
+    samples = decode_audio(data, filename)
+    if samples is None:
+        return None
+    return fingerprint_samples(samples)
+
+
+# --- INDEX ---
+class FingerprintIndex:
+    """SQLite-backed hash → (recording, frame) postings plus the analysis of every canonical recording.
+    Near-duplicates are not indexed again; they are linked to the recording they matched."""
+
+    def __init__(self, path: str = FINGERPRINT_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS recordings (
+                id INTEGER PRIMARY KEY,
+                source_uri TEXT NOT NULL,
+                duration_s REAL,
+                hash_count INTEGER,
+                customer_id INTEGER,
+                analysis TEXT,
+                duplicate_of INTEGER,
+                created_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS hashes (hash INTEGER NOT NULL, recording_id INTEGER NOT NULL, t INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS hashes_by_hash ON hashes (hash);
+        """)
+
+    def _postings(self, hashes: np.ndarray) -> np.ndarray:
+        rows = []
+        values = [int(h) for h in hashes]
+        for i in range(0, len(values), 900):  # stay under SQLite's host parameter limit
+            chunk = values[i:i + 900]
+            rows.extend(self.conn.execute(
+                f"SELECT hash, recording_id, t FROM hashes WHERE hash IN ({','.join('?' * len(chunk))})", chunk
+            ))
+        return np.array(rows, dtype=np.int64).reshape(-1, 3)
+
+    def _best_alignment(self, hashes: np.ndarray, times: np.ndarray) -> Tuple[int, int, float]:
+        """Returns (recording_id, aligned hits, share of the query's hashes) of the best candidate."""
+        if len(hashes) == 0:
+            return 0, 0, 0.0
+        query_hashes, first = np.unique(hashes, return_index=True)
+        postings = self._postings(query_hashes)
+        if len(postings) == 0:
+            return 0, 0, 0.0
+        offsets = postings[:, 2] - times[first][np.searchsorted(query_hashes, postings[:, 0])]
+        # Count aligned hits per (recording, offset); neighbouring offsets are merged because a copy
+        # that starts a fraction of a hop later lands half of its peaks one frame over
+        keys, counts = np.unique(postings[:, 1] * (1 << 32) + offsets + (1 << 31), return_counts=True)
+        merged = counts.copy()
+        adjacent = np.searchsorted(keys, keys + 1)
+        has_next = adjacent < len(keys)
+        has_next[has_next] = keys[adjacent[has_next]] == keys[has_next] + 1
+        merged[has_next] += counts[adjacent[has_next]]
+        best = int(np.argmax(merged))
+        return int(keys[best] >> 32), int(merged[best]), int(merged[best]) / len(query_hashes)
+
+    def _find(self, fp: Fingerprint) -> Optional[Match]:
+        recording_id, score, ratio = max(
+            (self._best_alignment(hashes, times) for hashes, times in ((fp.hashes, fp.times), *fp.phases)),
+            key=lambda candidate: candidate[2],
+        )
+        if score < FINGERPRINT_MIN_MATCHES or ratio < FINGERPRINT_MATCH_RATIO:
+            return None
+        source_uri, customer_id, analysis = self.conn.execute(
+            "SELECT source_uri, customer_id, analysis FROM recordings WHERE id = ?", (recording_id,)
+        ).fetchone()
+        return Match(recording_id, source_uri, customer_id, json.loads(analysis) if analysis else None, score, round(ratio, 3))
+
+    def find(self, fp: Fingerprint) -> Optional[Match]:
+        with self.lock:
+            return self._find(fp)
+
+    def _add(self, fp: Fingerprint, source_uri: str, analysis: Optional[Dict[str, Any]] = None,
+             customer_id: Optional[int] = None) -> int:
+        hashes, first = np.unique(fp.hashes, return_index=True)
+        with self.conn:
+            recording_id = self.conn.execute(
+                "INSERT INTO recordings (source_uri, duration_s, hash_count, customer_id, analysis, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (source_uri, fp.duration_s, len(hashes), customer_id, json.dumps(analysis) if analysis else None,
+                 datetime.now(timezone.utc).isoformat()),
+            ).lastrowid
+            self.conn.executemany(
+                "INSERT INTO hashes (hash, recording_id, t) VALUES (?, ?, ?)",
+                ((int(h), recording_id, int(t)) for h, t in zip(hashes, fp.times[first])),
+            )
+        return recording_id
+
+    def add(self, fp: Fingerprint, source_uri: str, analysis: Optional[Dict[str, Any]] = None,
+            customer_id: Optional[int] = None) -> int:
+        with self.lock:
+            return self._add(fp, source_uri, analysis, customer_id)
+
+    def find_or_add(self, fp: Fingerprint, source_uri: str) -> Tuple[Optional[Match], int]:
+        """Atomically returns (match, its recording id), or (None, id of a new pending recording)."""
+        with self.lock:
+            match = self._find(fp)
+            if match is not None:
+                return match, match.recording_id
+            return None, self._add(fp, source_uri)
+
+    def attach_analysis(self, recording_id: int, analysis: Dict[str, Any], customer_id: int):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE recordings SET analysis = ?, customer_id = ? WHERE id = ?",
+                (json.dumps(analysis), customer_id, recording_id),
+            )
+
+    def link(self, recording_id: int, source_uri: str, duration_s: float = 0.0):
+        """Records `source_uri` as a near-duplicate of `recording_id` (without indexing its hashes)."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO recordings (source_uri, duration_s, hash_count, duplicate_of, created_at) VALUES (?, ?, 0, ?, ?)",
+                (source_uri, duration_s, recording_id, datetime.now(timezone.utc).isoformat()),
+            )
+
+    def duplicates_of(self, recording_id: int):
+        with self.lock:
+            return [uri for (uri,) in self.conn.execute(
+                "SELECT source_uri FROM recordings WHERE duplicate_of = ? ORDER BY id", (recording_id,)
+            )]
+
+
+_index: Optional[FingerprintIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> FingerprintIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = FingerprintIndex()
+        return _index
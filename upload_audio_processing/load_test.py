@@ -0,0 +1,427 @@
+# load_test.py
+# HTTP load test of the web apps (app.py: /upload, app2.py: /ask) against the offline fake backends.
+# Each app runs as its own server process; closed-loop clients replay a mix of uploads of varied length
+# and of questions at every concurrency level, and the server's memory is sampled while they run.
+# Example: python load_test.py --concurrency 1,4,16 --requests 100 --latency-ms 800 --output baseline.json
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import itertools
+import subprocess
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+import requests
+import fake_backends
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APPS = {"upload": "app", "ask": "app2"}  # load-test target → Flask module
+# Same threaded dev server as `python app.py`, without the reloader. Any WSGI server command can be used instead.
+SERVER_COMMAND = "{python} -m flask --app {module} run --host 127.0.0.1 --port {port} --no-reload"
+
+# (kind, weight, question); {customer_id} is filled with a customer seen in an upload response
+QUESTION_MIX = [
+    ("sql", 0.15, "Show me the pending network calls"),
+    ("sql", 0.1, "List the customers with payment problems"),
+    ("sql", 0.1, "Which recharge calls were solved?"),
+    ("rollup", 0.2, "How many calls are there per problem type?"),
+    ("keyword", 0.2, "Which calls mention my plan?"),
+    ("similar", 0.1, "Show calls similar to customer {customer_id}"),
+    ("follow_up", 0.15, "Of those, which are still pending?"),
+]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def parse_weights(spec: str) -> Dict[float, float]:
+    """ "5=0.5,60=0.3,300=0.2" → {recording seconds: share of uploads} """
+    weights = {}
+    for item in spec.split(","):
+        seconds, _, weight = item.partition("=")
+        weights[float(seconds)] = float(weight or 1)
+    return weights
+
+
+# --- SERVER PROCESSES ---
+
+def process_tree_rss_mb(pid: int) -> Optional[float]:
+    """Resident memory of a process and its children (Linux /proc; None elsewhere)."""
+    try:
+        children: Dict[int, List[int]] = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    ppid = int(Path(f"/proc/{entry}/stat").read_text().rsplit(")", 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+                children.setdefault(ppid, []).append(int(entry))
+        total_kb, stack = 0, [pid]
+        while stack:
+            current = stack.pop()
+            try:
+                for line in Path(f"/proc/{current}/status").read_text().splitlines():
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+            except OSError:
+                continue
+            stack.extend(children.get(current, []))
+        return round(total_kb / 1024, 1)
+    except OSError:
+        return None
+
+
+class Server:
+    """One app under test, started with `command` and stopped on exit; output goes to a log file."""
+
+    def __init__(self, target: str, command: str, port: int, env: Dict[str, str], log_path: str):
+        self.target = target
+        self.base_url = f"http://127.0.0.1:{port}"
+        self.log_path = log_path
+        self.log = open(log_path, "wb")
+        args = command.format(python=sys.executable, module=APPS[target], port=port).split()
+        self.process = subprocess.Popen(args, cwd=HERE, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout: float = 60.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.target} server exited with {self.process.returncode}:\n{self.log_tail()}")
+            try:
+                if requests.get(f"{self.base_url}/metrics", timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"{self.target} server did not become ready:\n{self.log_tail()}")
+
+    def log_tail(self, lines: int = 20) -> str:
+        self.log.flush()
+        return "\n".join(Path(self.log_path).read_text(errors="replace").splitlines()[-lines:])
+
+    def rss_mb(self) -> Optional[float]:
+        return process_tree_rss_mb(self.process.pid)
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+    def __enter__(self):
+        self.wait_ready()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class MemorySampler:
+    """Peak and final server memory while one concurrency level runs."""
+
+    def __init__(self, server: Server, interval_s: float = 0.2):
+        self.server = server
+        self.interval_s = interval_s
+        self.peak = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.is_set():
+            rss = self.server.rss_mb()
+            if rss is not None:
+                self.peak = max(self.peak or 0.0, rss)
+            self.stopped.wait(self.interval_s)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+# --- WORKLOADS ---
+
+class UploadWorkload:
+    """POSTs synthetic recordings to /upload; `durations` gives the share of uploads per recording length."""
+
+    def __init__(self, corpus: Dict[float, List[Path]], durations: Dict[float, float], timeout: float):
+        self.corpus = corpus
+        self.lengths, self.weights = list(durations), list(durations.values())
+        self.timeout = timeout
+        self.customer_ids: List[int] = []
+        self.lock = threading.Lock()
+
+    def request(self, http: requests.Session, base_url: str, rng: random.Random, state: Dict[str, Any]) -> Tuple[str, bool, int, str]:
+        seconds = rng.choices(self.lengths, self.weights)[0]
+        path = rng.choice(self.corpus[seconds])
+        with open(path, "rb") as f:
+            response = http.post(f"{base_url}/upload", files={"audio": (path.name, f, "audio/wav")}, timeout=self.timeout)
+        body = response.json()
+        result = (body.get("data") or {}).get("result") or {}
+        ok = response.ok and body.get("status") == "ok" and "error" not in result
+        if ok and (body.get("data") or {}).get("customer_id") is not None:
+            with self.lock:
+                self.customer_ids.append(body["data"]["customer_id"])
+        return f"{seconds:g}s", ok, response.status_code, "" if ok else str(body.get("message") or result.get("error"))[:200]
+
+
+class AskWorkload:
+    """POSTs questions to /ask; every client keeps its own session so follow-ups refer to its previous answer."""
+
+    def __init__(self, mix: List[Tuple[str, float, str]], customer_ids: List[int], timeout: float):
+        self.mix = mix
+        self.customer_ids = customer_ids or [1]
+        self.timeout = timeout
+
+    def request(self, http: requests.Session, base_url: str, rng: random.Random, state: Dict[str, Any]) -> Tuple[str, bool, int, str]:
+        kind, _, question = rng.choices(self.mix, [weight for _, weight, _ in self.mix])[0]
+        question = question.format(customer_id=rng.choice(self.customer_ids))
+        response = http.post(f"{base_url}/ask", json={"question": question, "session_id": state.get("session_id")}, timeout=self.timeout)
+        body = response.json()
+        state["session_id"] = (body.get("metadata") or {}).get("session_id", state.get("session_id"))
+        answer = str(body.get("response", ""))
+        # app2.py reports failures as a 200 whose response starts with "Error:"
+        ok = response.ok and not answer.startswith("Error:")
+        source = (body.get("metadata") or {}).get("source", "sql")
+        return f"{kind}:{source}", ok, response.status_code, "" if ok else answer[:200]
+
+
+def run_level(server: Server, workload, concurrency: int, total: int, seed: int) -> Dict[str, Any]:
+    """`total` requests from `concurrency` closed-loop clients (each sends its next request once the last returns)."""
+    records: List[Tuple[str, bool, int, float, str]] = []
+    records_lock = threading.Lock()
+    issued = itertools.count()
+
+    def client(index: int):
+        rng = random.Random(seed * 1000 + index)
+        state: Dict[str, Any] = {}
+        with requests.Session() as http:
+            while next(issued) < total:
+                start = time.perf_counter()
+                try:
+                    kind, ok, status, error = workload.request(http, server.base_url, rng, state)
+                except (requests.RequestException, ValueError) as e:
+                    kind, ok, status, error = "transport", False, 0, f"{type(e).__name__}: {e}"[:200]
+                with records_lock:
+                    records.append((kind, ok, status, time.perf_counter() - start, error))
+
+    rss_before = server.rss_mb()
+    start = time.perf_counter()
+    with MemorySampler(server) as sampler:
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = [r[3] for r in records]
+    errors = [r for r in records if not r[1]]
+    by_kind: Dict[str, Dict[str, Any]] = {}
+    for kind in sorted({r[0] for r in records}):
+        kind_latencies = [r[3] for r in records if r[0] == kind]
+        by_kind[kind] = {
+            "requests": len(kind_latencies),
+            "errors": sum(1 for r in records if r[0] == kind and not r[1]),
+            "latency_p50_s": round(percentile(kind_latencies, 50), 4),
+            "latency_p95_s": round(percentile(kind_latencies, 95), 4),
+        }
+    status_codes: Dict[str, int] = {}
+    for r in records:
+        status_codes[str(r[2])] = status_codes.get(str(r[2]), 0) + 1
+    return {
+        "app": server.target,
+        "concurrency": concurrency,
+        "requests": len(records),
+        "errors": len(errors),
+        "error_rate": round(len(errors) / len(records), 4) if records else 0.0,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(records) / elapsed, 2) if elapsed else 0.0,
+        "latency_p50_s": round(percentile(latencies, 50), 4),
+        "latency_p95_s": round(percentile(latencies, 95), 4),
+        "latency_p99_s": round(percentile(latencies, 99), 4),
+        "latency_max_s": round(max(latencies), 4) if latencies else 0.0,
+        "server_rss_mb_start": rss_before,
+        "server_rss_mb_peak": sampler.peak,
+        "server_rss_mb_end": server.rss_mb(),
+        "status_codes": status_codes,
+        "by_kind": by_kind,
+        "sample_errors": sorted({r[4] for r in errors})[:5],
+    }
+
+
+# --- SETUP ---
+
+def configure_environment(args, workdir: str) -> Dict[str, str]:
+    env = dict(os.environ)  # anything else set by the caller (e.g. TWO_PHASE, QUERY_ENGINE) reaches the servers
+    env.update({
+        "AUDIO_BACKEND": "fake",
+        "FAKE_BUCKET_DIR": os.path.join(workdir, "gcs"),
+        "FAKE_SQL_DB": os.path.join(workdir, "warehouse.sqlite"),  # shared by both servers
+        "FAKE_GEMINI_LATENCY_MS": str(args.latency_ms),
+        "FAKE_GEMINI_LATENCY_SIGMA": str(args.latency_sigma),
+        "FAKE_GEMINI_ERROR_RATE": str(args.error_rate),
+        "FAKE_GEMINI_429_RATE": str(args.rate_limit_rate),
+        "FAKE_GEMINI_MS_PER_AUDIO_S": str(args.ms_per_audio_s),
+        "FAKE_SEED": str(args.seed),
+        "GCS_BUCKET": "load-test-bucket",
+        "FINGERPRINT_DEDUP": "1" if args.dedup else "0",
+        "FINGERPRINT_DB": os.path.join(workdir, "fingerprints.sqlite"),
+        "IDENTITY_DB": os.path.join(workdir, "identity_index.sqlite"),
+        "TRANSCRIPT_INDEX_DB": os.path.join(workdir, "transcript_index.sqlite"),
+        "SIMILARITY_DIR": os.path.join(workdir, "call_vectors"),
+        "REPLICA_DIR": os.path.join(workdir, "calls_replica"),
+        "CUSTOMER_ID_LEASE_DIR": os.path.join(workdir, "leases"),
+        "MODEL_SCHEDULER_DB": os.path.join(workdir, "model_scheduler.sqlite"),
+        "PYTHONUNBUFFERED": "1",
+    })
+    return env
+
+
+def write_corpus(args, workdir: str, durations: Dict[float, float]) -> Dict[float, List[Path]]:
+    """`--files-per-length` synthetic recordings of every length in the upload mix."""
+    root = os.path.join(workdir, "corpus")
+    corpus = {}
+    for i, seconds in enumerate(durations):
+        prefix = f"{seconds:g}s/"
+        fake_backends.write_synthetic_audio(
+            args.files_per_length, "audio", prefix=prefix, root=root,
+            min_seconds=seconds, max_seconds=seconds, seed=args.seed + i,
+        )
+        corpus[seconds] = sorted((Path(root) / "audio" / prefix).glob("*.wav"))
+    return corpus
+
+
+def run_load_test(args) -> Dict[str, Any]:
+    workdir = tempfile.mkdtemp(prefix="audio_load_")
+    try:
+        env = configure_environment(args, workdir)
+        levels = [int(c) for c in args.concurrency.split(",")]
+        durations = parse_weights(args.durations)
+        uploads = UploadWorkload(write_corpus(args, workdir, durations), durations, args.timeout)
+        mix = QUESTION_MIX
+        if args.questions:
+            with open(args.questions) as f:
+                mix = [(q.get("kind", "custom"), float(q.get("weight", 1)), q["question"]) for q in json.load(f)]
+        results = []
+
+        def serve(target: str, port: int) -> Server:
+            return Server(target, args.server_command, port, env, os.path.join(workdir, f"{target}.log"))
+
+        # /upload runs first: its rows are what /ask queries (with only "ask", a few uploads seed the warehouse)
+        with serve("upload", args.port) as server:
+            if "upload" in args.apps:
+                for concurrency in levels:
+                    print(f"📤 /upload at concurrency {concurrency}...", file=sys.stderr)
+                    results.append(run_level(server, uploads, concurrency, args.requests, args.seed))
+            else:
+                run_level(server, uploads, min(4, args.seed_calls), args.seed_calls, args.seed)
+        # As in a deployment, aggregate questions use the rollup table only once it has been rebuilt
+        subprocess.run([sys.executable, "rollups.py", "--rebuild"], env=env, cwd=HERE, check=True, stdout=subprocess.DEVNULL)
+        if "ask" in args.apps:
+            asks = AskWorkload(mix, uploads.customer_ids, args.timeout)
+            with serve("ask", args.port + 1) as server:
+                for concurrency in levels:
+                    print(f"💬 /ask at concurrency {concurrency}...", file=sys.stderr)
+                    results.append(run_level(server, asks, concurrency, args.requests, args.seed))
+        return {
+            "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "keep")},
+            "levels": results,
+        }
+    finally:
+        if args.keep:
+            print(f"📁 Server logs and state kept in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+# --- BASELINES ---
+COMPARED = ("throughput_rps", "latency_p50_s", "latency_p95_s", "latency_p99_s", "error_rate", "server_rss_mb_peak")
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Per app and concurrency level: each compared metric now, in the baseline, and the relative change."""
+    before = {(level["app"], level["concurrency"]): level for level in baseline.get("levels", [])}
+    rows = []
+    for level in report["levels"]:
+        old = before.get((level["app"], level["concurrency"]))
+        if old is None:
+            continue
+        for metric in COMPARED:
+            new_value, old_value = level.get(metric), old.get(metric)
+            change = None
+            if new_value is not None and old_value:
+                change = round((new_value - old_value) / old_value, 4)
+            rows.append({"app": level["app"], "concurrency": level["concurrency"], "metric": metric,
+                         "baseline": old_value, "current": new_value, "change": change})
+    return rows
+
+
+def print_summary(report: Dict[str, Any]):
+    print(f"{'app':<7}{'conc':>5}{'req/s':>9}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'errors':>8}{'rss MB':>9}", file=sys.stderr)
+    for level in report["levels"]:
+        print(f"{level['app']:<7}{level['concurrency']:>5}{level['throughput_rps']:>9}{level['latency_p50_s']:>9}"
+              f"{level['latency_p95_s']:>9}{level['latency_p99_s']:>9}{level['error_rate']:>8.1%}"
+              f"{str(level['server_rss_mb_peak']):>9}", file=sys.stderr)
+    for row in report.get("comparison", []):
+        change = f" ({row['change']:+.1%})" if row["change"] is not None else ""
+        print(f"   {row['app']} @{row['concurrency']} {row['metric']}: {row['baseline']} → {row['current']}{change}", file=sys.stderr)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline HTTP load test of /upload (app.py) and /ask (app2.py).")
+    parser.add_argument("--apps", default="upload,ask", help="Comma-separated: upload, ask.")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrent clients per level.")
+    parser.add_argument("--requests", type=int, default=50, help="Requests per app and concurrency level.")
+    parser.add_argument("--durations", default="5=0.5,60=0.3,300=0.2", help='Upload mix, "seconds=share,...".')
+    parser.add_argument("--files-per-length", type=int, default=4, help="Distinct recordings of each length.")
+    parser.add_argument("--questions", help='JSON list of {"question", "weight", "kind"} replacing the built-in mix.')
+    parser.add_argument("--seed-calls", type=int, default=20, help="Uploads that seed the warehouse when only /ask is tested.")
+    parser.add_argument("--latency-ms", type=float, default=800.0)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--ms-per-audio-s", type=float, default=0.0, help="Extra fake model latency per second of audio.")
+    parser.add_argument("--dedup", action="store_true", help="Enable fingerprint deduplication (the corpus is re-sent, so repeats hit it).")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Client timeout per request.")
+    parser.add_argument("--port", type=int, default=5050, help="/upload server port; /ask uses the next one.")
+    parser.add_argument("--server-command", default=SERVER_COMMAND, help="With {python}, {module} and {port} placeholders.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report as JSON to this path (a baseline for --compare).")
+    parser.add_argument("--compare", help="Baseline report to compare against.")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary state directory and server logs.")
+    args = parser.parse_args(argv)
+    args.apps = [app.strip() for app in args.apps.split(",") if app.strip()]
+    unknown = set(args.apps) - set(APPS)
+    if unknown:
+        parser.error(f"unknown app(s): {', '.join(sorted(unknown))}")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run_load_test(args)
+    if args.compare:
+        with open(args.compare) as f:
+            report["comparison"] = compare(report, json.load(f))
+    print_summary(report)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,197 @@
+# metrics.py
+# Minimal in-process metrics registry (counters, gauges, histograms) with Prometheus text
+# exposition for the Flask apps and a JSON summary for batch runs.
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, List, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: Dict[str, str] = None) -> str:
+        pairs = list(zip(self.labelnames, key)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{self._format_labels(k)} {v}" for k, v in self.values.items()]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {",".join(k) or "_": v for k, v in self.values.items()}
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.series: Dict[Tuple[str, ...], Dict[str, Any]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            index = len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    index = i
+                    break
+            series["counts"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def quantile(self, q: float, **labels) -> float:
+        """Estimates a quantile by linear interpolation inside the matching bucket."""
+        series = self.series.get(self._key(labels))
+        if not series or not series["count"]:
+            return 0.0
+        rank = q * series["count"]
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets + (float("inf"),), series["counts"]):
+            if seen + count >= rank and count:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return lower
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for key, series in self.series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), series["counts"]):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{self.name}_bucket{self._format_labels(key, {'le': le})} {cumulative}")
+                lines.append(f"{self.name}_sum{self._format_labels(key)} {series['sum']}")
+                lines.append(f"{self.name}_count{self._format_labels(key)} {series['count']}")
+        return lines
+
+    def snapshot(self) -> Dict[str, Any]:
+        result = {}
+        for key, series in list(self.series.items()):
+            labels = dict(zip(self.labelnames, key))
+            result[",".join(key) or "_"] = {
+                "count": series["count"],
+                "sum": round(series["sum"], 4),
+                "p50": round(self.quantile(0.5, **labels), 4),
+                "p95": round(self.quantile(0.95, **labels), 4),
+                "p99": round(self.quantile(0.99, **labels), 4),
+            }
+        return result
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        return self.metrics.setdefault(metric.name, metric)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> Dict[str, Any]:
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+
+REGISTRY = Registry()
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# --- PIPELINE METRICS ---
+STAGE_LATENCY = REGISTRY.register(Histogram(
+    "audio_stage_latency_seconds", "Latency of each pipeline stage.", ("stage",)))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    "audio_stage_in_flight", "Operations currently running per stage.", ("stage",)))
+FAILURES = REGISTRY.register(Counter(
+    "audio_stage_failures_total", "Failed stage executions by error class.", ("stage", "error_class")))
+RETRIES = REGISTRY.register(Counter(
+    "audio_stage_retries_total", "Retries scheduled per stage by error class.", ("stage", "error_class")))
+BYTES_PROCESSED = REGISTRY.register(Counter(
+    "audio_bytes_processed_total", "Bytes handled per stage.", ("stage",)))
+
+
+@contextmanager
+def track(stage: str):
+    """Times a block, keeps the in-flight gauge current and counts failures by exception class."""
+    IN_FLIGHT.inc(stage=stage)
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        FAILURES.inc(stage=stage, error_class=type(e).__name__)
+        raise
+    finally:
+        STAGE_LATENCY.observe(time.perf_counter() - start, stage=stage)
+        IN_FLIGHT.dec(stage=stage)
+
+
+def record_retry(stage: str):
+    """Returns a tenacity `before_sleep` callback that counts retries for `stage`."""
+    def before_sleep(retry_state):
+        exc = retry_state.outcome.exception() if retry_state.outcome else None
+        RETRIES.inc(stage=stage, error_class=type(exc).__name__ if exc else "unknown")
+    return before_sleep
+
+
+def render_prometheus() -> str:
+    return REGISTRY.render_prometheus()
+
+
+def summary() -> Dict[str, Any]:
+    return REGISTRY.summary()
@@ -0,0 +1,163 @@
+# model_scheduler.py
+# Shared admission control for Gemini requests across processes (upload app, NL-SQL app, batch jobs).
+# Requests are admitted against one requests-per-minute budget kept in a SQLite ledger: interactive
+# traffic may use all of it, batch traffic only what is left after INTERACTIVE_HEADROOM, and when both
+# are waiting, classes take turns in proportion to their weights (weighted fair queuing over the window).
+import os
+import time
+import uuid
+import random
+import sqlite3
+import asyncio
+import tempfile
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Tuple
+from metrics import REGISTRY, Counter, track
+import deadlines
+
+# --- CONFIGURATION ---
+MODEL_RPM = int(os.getenv("MODEL_RPM", "0"))  # shared Gemini requests/minute; 0 disables scheduling
+INTERACTIVE_HEADROOM = float(os.getenv("INTERACTIVE_HEADROOM", "0.2"))  # share of MODEL_RPM batch never uses
+MODEL_WEIGHTS = {
+    name: float(weight)
+    for name, weight in (item.split("=") for item in os.getenv("MODEL_WEIGHTS", "interactive=4,batch=1").split(","))
+}
+# Every process on the host must see the same ledger file to share the budget
+MODEL_SCHEDULER_DB = os.getenv("MODEL_SCHEDULER_DB", os.path.join(tempfile.gettempdir(), "genai_audio_model_scheduler.sqlite"))
+WINDOW_S = 60.0
+POLL_S = 0.05
+WAITER_TTL_S = 10.0  # waiters of crashed processes stop blocking their class after this
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+PRIORITY = contextvars.ContextVar("model_priority", default=os.getenv("MODEL_PRIORITY", INTERACTIVE))
+
+ADMITTED = REGISTRY.register(Counter(
+    "model_requests_admitted_total", "Gemini requests admitted by the scheduler per priority class.", ("priority",)))
+
+
+@contextmanager
+def priority(name: str):
+    """Runs the enclosed model calls in priority class `name` (e.g. BATCH for backfills)."""
+    token = PRIORITY.set(name)
+    try:
+        yield
+    finally:
+        PRIORITY.reset(token)
+
+
+def _limit(name: str) -> int:
+    if name == INTERACTIVE:
+        return MODEL_RPM
+    return max(1, int(MODEL_RPM * (1 - INTERACTIVE_HEADROOM)))
+
+
+class Scheduler:
+    """The ledger holds grants from the last minute and the requests currently waiting, per class."""
+
+    def __init__(self, path: str = MODEL_SCHEDULER_DB):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=1.0, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS grants (granted_at REAL NOT NULL, priority TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS grants_time ON grants (granted_at);
+            CREATE TABLE IF NOT EXISTS waiters (
+                id TEXT PRIMARY KEY, priority TEXT NOT NULL, enqueued_at REAL NOT NULL, heartbeat REAL NOT NULL
+            );
+        """)
+
+    def try_admit(self, waiter_id: str, name: str, enqueued_at: float) -> Tuple[bool, float]:
+        """One admission attempt. Returns (admitted, seconds to wait before the next attempt)."""
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError:
+                return False, POLL_S  # another process holds the ledger
+            try:
+                now = time.time()
+                self.conn.execute("DELETE FROM grants WHERE granted_at < ?", (now - WINDOW_S,))
+                self.conn.execute("DELETE FROM waiters WHERE heartbeat < ?", (now - WAITER_TTL_S,))
+                self.conn.execute("INSERT OR REPLACE INTO waiters VALUES (?, ?, ?, ?)", (waiter_id, name, enqueued_at, now))
+                used: Dict[str, int] = dict(self.conn.execute("SELECT priority, COUNT(*) FROM grants GROUP BY priority"))
+                total = sum(used.values())
+                if total >= _limit(name):
+                    oldest = self.conn.execute("SELECT MIN(granted_at) FROM grants").fetchone()[0] or now
+                    self.conn.execute("COMMIT")
+                    return False, min(max(oldest + WINDOW_S - now, POLL_S), 1.0)
+                # Of the classes that could be admitted now, the one furthest below its weighted share goes first
+                waiting = [
+                    (row[0], row[1]) for row in self.conn.execute(
+                        "SELECT priority, MIN(enqueued_at) FROM waiters GROUP BY priority")
+                    if total < _limit(row[0])
+                ]
+                turn = min(waiting, key=lambda w: ((used.get(w[0], 0) + 1) / MODEL_WEIGHTS.get(w[0], 1.0), w[1]))[0]
+                first = self.conn.execute(
+                    "SELECT id FROM waiters WHERE priority = ? ORDER BY enqueued_at, id LIMIT 1", (name,)).fetchone()[0]
+                if turn != name or first != waiter_id:
+                    self.conn.execute("COMMIT")
+                    return False, POLL_S
+                self.conn.execute("INSERT INTO grants VALUES (?, ?)", (now, name))
+                self.conn.execute("DELETE FROM waiters WHERE id = ?", (waiter_id,))
+                self.conn.execute("COMMIT")
+                return True, 0.0
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def leave(self, waiter_id: str):
+        with self.lock:
+            self.conn.execute("DELETE FROM waiters WHERE id = ?", (waiter_id,))
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> Scheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
+
+
+def admit(name: str = None):
+    """Blocks until a model request of class `name` (default: the current priority) may be sent.
+    Raises deadlines.DeadlineExceeded if the current request deadline passes while waiting."""
+    if MODEL_RPM <= 0:
+        return
+    name = name or PRIORITY.get()
+    scheduler, waiter_id, enqueued_at = get_scheduler(), uuid.uuid4().hex, time.time()
+    with track(f"model_queue_{name}"):
+        try:
+            while True:
+                admitted, delay = scheduler.try_admit(waiter_id, name, enqueued_at)
+                if admitted:
+                    break
+                left = deadlines.remaining()
+                time.sleep(min(delay * random.uniform(0.8, 1.2), left if left is not None else WINDOW_S))
+        finally:
+            scheduler.leave(waiter_id)
+    ADMITTED.inc(priority=name)
+
+
+async def admit_async(name: str = None):
+    """`admit` for coroutines: waits with asyncio.sleep so the event loop keeps running."""
+    if MODEL_RPM <= 0:
+        return
+    name = name or PRIORITY.get()
+    scheduler, waiter_id, enqueued_at = get_scheduler(), uuid.uuid4().hex, time.time()
+    with track(f"model_queue_{name}"):
+        try:
+            while True:
+                admitted, delay = scheduler.try_admit(waiter_id, name, enqueued_at)
+                if admitted:
+                    break
+                left = deadlines.remaining()
+                await asyncio.sleep(min(delay * random.uniform(0.8, 1.2), left if left is not None else WINDOW_S))
+        finally:
+            scheduler.leave(waiter_id)
+    ADMITTED.inc(priority=name)
@@ -0,0 +1,176 @@
+# rollups.py
+# Daily call-count rollups (day × problem_type × problem_solved × sentiment label) kept next to the call
+# table so dashboard questions read a few hundred rows instead of scanning every transcript.
+# Each committed batch appends its counts as delta rows (a load job: no DML quota or MERGE conflicts
+# between concurrent writers); closed days are periodically compacted to one row per group.
+# The table is created by `python rollups.py --rebuild`, which also labels it as complete; until then
+# ingest skips it and /ask answers aggregate questions from the call table.
+import re
+import sys
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional
+from google.cloud import bigquery
+from google.api_core import exceptions as google_exceptions
+
+ROLLUP_TABLE_SCHEMA = [
+    bigquery.SchemaField("day", "DATE"),
+    bigquery.SchemaField("problem_type", "STRING"),
+    bigquery.SchemaField("problem_solved", "STRING"),
+    bigquery.SchemaField("sentiment_label", "STRING"),
+    bigquery.SchemaField("call_count", "INTEGER"),
+    bigquery.SchemaField("compacted", "BOOLEAN"),
+]
+GROUP_FIELDS = ("day", "problem_type", "problem_solved", "sentiment_label")
+REBUILT_LABEL = ("rollup_state", "rebuilt")  # set by rebuild(): the table covers every call
+
+# --- SENTIMENT LABEL ---
+# Sentiment is stored as a free-text summary; dashboards need a category. Words after a turn
+# ("but", "eventually", ...) describe how the call ended and count double.
+POSITIVE_WORDS = {
+    "satisfied", "happy", "relieved", "grateful", "appreciative", "thankful", "pleased", "calm", "positive",
+    "content", "glad", "reassured", "delighted", "impressed", "appreciated", "satisfaction", "relief",
+}
+NEGATIVE_WORDS = {
+    "angry", "frustrated", "annoyed", "upset", "disappointed", "dissatisfied", "irritated", "anxious", "worried",
+    "negative", "furious", "impatient", "unhappy", "stressed", "frustration", "anger", "concerned", "agitated",
+}
+TURN_WORDS = re.compile(r"\b(?:but|however|eventually|finally|ultimately|ended|ending|later|after)\b", re.IGNORECASE)
+
+
+def sentiment_label(sentiment: Optional[str]) -> str:
+    """Returns "positive", "negative", "mixed" or "neutral" for a sentiment summary."""
+    text = (sentiment or "").lower()
+    turn = TURN_WORDS.search(text)
+    before, after = (text[:turn.start()], text[turn.end():]) if turn else (text, "")
+    score = {"positive": 0, "negative": 0}
+    for part, weight in ((before, 1), (after, 2)):
+        words = re.findall(r"[a-z]+", part)
+        score["positive"] += weight * sum(w in POSITIVE_WORDS for w in words)
+        score["negative"] += weight * sum(w in NEGATIVE_WORDS for w in words)
+    if score["positive"] > score["negative"]:
+        return "positive"
+    if score["negative"] > score["positive"]:
+        return "negative"
+    return "mixed" if score["positive"] else "neutral"
+
+
+def rollup_rows(rows: Iterable[Dict[str, Any]], day: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Aggregates call rows into delta rows for `day` (default: today, UTC)."""
+    day = day or datetime.now(timezone.utc).date().isoformat()
+    counts = Counter(
+        (row.get("problem_type") or "", row.get("problem_solved") or "", sentiment_label(row.get("sentiment")))
+        for row in rows
+        if not row.get("duplicate_of")
+    )
+    return [
+        {"day": day, "problem_type": problem_type, "problem_solved": problem_solved,
+         "sentiment_label": label, "call_count": count, "compacted": False}
+        for (problem_type, problem_solved, label), count in counts.items()
+    ]
+
+
+def is_rebuilt(bigquery_client, table_id: str) -> bool:
+    """True once `--rebuild` has filled the table from the call table, so its counts cover older calls."""
+    try:
+        labels = bigquery_client.get_table(table_id).labels or {}
+    except google_exceptions.NotFound:
+        return False
+    return labels.get(REBUILT_LABEL[0]) == REBUILT_LABEL[1]
+
+
+_compacted_through: Dict[str, str] = {}
+_compact_lock = threading.Lock()
+_missing_tables = set()
+
+
+def record_rows(bigquery_client, table_id: str, rows: List[Dict[str, Any]]):
+    """Adds committed call rows to the rollup table. Failures are logged; `--rebuild` repairs drift.
+    A missing table is never created here: it would only count calls from now on."""
+    deltas = rollup_rows(rows)
+    if not deltas:
+        return
+    try:
+        job_config = bigquery.LoadJobConfig(schema=ROLLUP_TABLE_SCHEMA, create_disposition="CREATE_NEVER")
+        bigquery_client.load_table_from_json(deltas, table_id, job_config=job_config).result()
+    except google_exceptions.NotFound:
+        if table_id not in _missing_tables:
+            _missing_tables.add(table_id)
+            print(f"⚠️ Rollup table {table_id} does not exist; run `python rollups.py --rebuild` to create it.")
+        return
+    except Exception as e:
+        print(f"⚠️ Failed to update rollups in {table_id}: {e}")
+        return
+    # Once per process and day, fold the delta rows of closed days together. Other writers skip while one
+    # compacts; a failed compaction is retried with the next batch.
+    closed = (datetime.now(timezone.utc).date() - timedelta(days=2)).isoformat()
+    if _compacted_through.get(table_id) == closed or not _compact_lock.acquire(blocking=False):
+        return
+    try:
+        if _compacted_through.get(table_id) != closed and compact(bigquery_client, table_id, closed):
+            _compacted_through[table_id] = closed
+    finally:
+        _compact_lock.release()
+
+
+def compact(bigquery_client, table_id: str, through_day: str) -> bool:
+    """Replaces the delta rows of every day up to `through_day` with one row per group, atomically.
+    Only closed days are compacted: deltas are always written for the current day. Returns False on failure."""
+    group = ", ".join(GROUP_FIELDS)
+    script = f"""
+        BEGIN TRANSACTION;
+        INSERT INTO `{table_id}` ({group}, call_count, compacted)
+            SELECT {group}, SUM(call_count), TRUE FROM `{table_id}`
+            WHERE day <= '{through_day}' AND NOT compacted GROUP BY {group};
+        DELETE FROM `{table_id}` WHERE day <= '{through_day}' AND NOT compacted;
+        COMMIT TRANSACTION;
+    """
+    try:
+        bigquery_client.query(script).result()
+    except Exception as e:
+        print(f"⚠️ Rollup compaction of {table_id} failed (will retry later): {e}")
+        return False
+    return True
+
+
+def rebuild(bigquery_client, calls_table_id: str, table_id: str, customer_id_epoch_ms: int, timestamp_shift: int) -> int:
+    """Recomputes the rollups from the call table (a one-off full scan) and labels the table as rebuilt.
+    Stop ingest first: the table is replaced, so deltas appended while the scan runs are lost.
+    The call table has no timestamp, so each call is dated by its time-ordered customer_id
+    (for repeat callers, their first call); IDs that do not decode to a plausible date get day NULL."""
+    now_ms = datetime.now(timezone.utc).timestamp() * 1000
+    counts: Counter = Counter()
+    query = f"SELECT customer_id, problem_type, problem_solved, sentiment FROM `{calls_table_id}`"
+    for row in bigquery_client.query(query).result():
+        minted_ms = (int(row["customer_id"] or 0) >> timestamp_shift) + customer_id_epoch_ms
+        day = (datetime.fromtimestamp(minted_ms / 1000, timezone.utc).date().isoformat()
+               if customer_id_epoch_ms < minted_ms <= now_ms else None)
+        counts[(day, row["problem_type"] or "", row["problem_solved"] or "", sentiment_label(row["sentiment"]))] += 1
+    rows = [
+        {"day": day, "problem_type": problem_type, "problem_solved": problem_solved,
+         "sentiment_label": label, "call_count": count, "compacted": True}
+        for (day, problem_type, problem_solved, label), count in counts.items()
+    ]
+    job_config = bigquery.LoadJobConfig(schema=ROLLUP_TABLE_SCHEMA, write_disposition="WRITE_TRUNCATE")
+    bigquery_client.load_table_from_json(rows, table_id, job_config=job_config).result()
+    table = bigquery_client.get_table(table_id)
+    table.labels = {**(table.labels or {}), REBUILT_LABEL[0]: REBUILT_LABEL[1]}
+    bigquery_client.update_table(table, ["labels"])
+    return len(rows)
+
+
+if __name__ == "__main__":
+    if "--rebuild" not in sys.argv:
+        print("Usage: python rollups.py --rebuild   (recomputes the rollup table from the call table; stop ingest first)")
+        raise SystemExit(1)
+    import customer_ids
+    from nlp_sql import bigquery_client, BIGQUERY_PROJECT_ID, BIGQUERY_DATASET, BIGQUERY_TABLE, BIGQUERY_ROLLUP_TABLE
+    groups = rebuild(
+        bigquery_client,
+        f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}",
+        f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_ROLLUP_TABLE}",
+        customer_ids.EPOCH_MS,
+        customer_ids.WORKER_BITS + customer_ids.SEQUENCE_BITS,
+    )
+    print(f"✅ Rebuilt rollups: {groups} groups.")
@@ -0,0 +1,159 @@
+# stt_async.py
+# Concurrent Cloud Speech-to-Text backend: many long-running recognitions in flight at once,
+# one polling loop with backoff, and diarized transcript assembly in a single pass.
+import os
+import time
+import asyncio
+from typing import Dict, List, Optional, Iterable, Set, Tuple
+from google.cloud import speech_v1p1beta1 as speech
+
+# --- CONFIGURATION ---
+STT_MAX_IN_FLIGHT = int(os.getenv("STT_MAX_IN_FLIGHT", "50"))
+STT_POLL_INITIAL_S = float(os.getenv("STT_POLL_INITIAL_S", "2"))
+STT_POLL_MAX_S = float(os.getenv("STT_POLL_MAX_S", "30"))
+STT_TIMEOUT_S = float(os.getenv("STT_TIMEOUT_S", "10000"))
+MAX_SPEAKER_COUNT = 2
+
+
+def recognition_config() -> speech.RecognitionConfig:
+    return speech.RecognitionConfig(
+        encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+        language_code="en-US",
+        alternative_language_codes=["en-IN", "hi-IN", "ta-IN", "mr-IN"],
+        enable_speaker_diarization=True,
+        diarization_speaker_count=MAX_SPEAKER_COUNT,
+        model="latest_long",
+    )
+
+
+def _seconds(offset) -> float:
+    if offset is None:
+        return 0.0
+    if hasattr(offset, "total_seconds"):
+        return offset.total_seconds()
+    return getattr(offset, "seconds", 0) + getattr(offset, "nanos", 0) / 1e9
+
+
+def build_diarized_transcript(results: Iterable) -> str:
+    """Assembles "Support:/Customer:" turns in one pass over every result segment.
+
+    Only speaker-tagged words are used. When the service repeats the whole conversation in a
+    final diarized segment, its words are skipped if the same word at the same start time was
+    already emitted, so both per-segment and aggregate-only diarization layouts produce each word once.
+    """
+    lines: List[str] = []
+    speaker_map: Dict[int, str] = {}
+    current_speaker: Optional[int] = None
+    current_words: List[str] = []
+    emitted: Set[Tuple[float, str]] = set()
+    for result in results:
+        if not result.alternatives:
+            continue
+        for word in result.alternatives[0].words:
+            if not word.speaker_tag:
+                continue
+            key = (_seconds(word.start_time), word.word)
+            if key in emitted:
+                continue
+            emitted.add(key)
+            if not speaker_map:
+                # The first speaker is the support agent greeting the customer
+                speaker_map[word.speaker_tag] = "Support"
+            speaker_map.setdefault(word.speaker_tag, "Customer")
+            if word.speaker_tag != current_speaker and current_words:
+                lines.append(f"{speaker_map[current_speaker]}: {' '.join(current_words)}")
+                current_words = []
+            current_speaker = word.speaker_tag
+            current_words.append(word.word)
+    if current_words:
+        lines.append(f"{speaker_map[current_speaker]}: {' '.join(current_words)}")
+    if not lines:
+        raise Exception("Transcription failed: No results returned.")
+    return "\n".join(lines)
+
+
+class AsyncTranscriber:
+    """Submits long-running recognitions as callers arrive and resolves them from a single poller.
+
+    `await transcriber.transcribe(uri)` from as many tasks as you like; at most `max_in_flight`
+    operations are outstanding and completed operations are detected by one loop whose interval
+    backs off exponentially while nothing finishes.
+    """
+
+    def __init__(
+        self,
+        speech_client,
+        config: Optional[speech.RecognitionConfig] = None,
+        max_in_flight: int = STT_MAX_IN_FLIGHT,
+        poll_initial: float = STT_POLL_INITIAL_S,
+        poll_max: float = STT_POLL_MAX_S,
+        timeout: float = STT_TIMEOUT_S,
+    ):
+        self.client = speech_client
+        self.config = config or recognition_config()
+        self.poll_initial = poll_initial
+        self.poll_max = poll_max
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._pending: Dict[int, tuple] = {}
+        self._poller: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+
+    async def transcribe(self, gcs_uri: str) -> str:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+            self._wake = asyncio.Event()
+        async with self._slots:
+            audio = speech.RecognitionAudio(uri=gcs_uri)
+            operation = await asyncio.to_thread(self.client.long_running_recognize, config=self.config, audio=audio)
+            future = asyncio.get_running_loop().create_future()
+            self._pending[id(future)] = (operation, future, time.monotonic() + self.timeout)
+            if self._poller is None or self._poller.done():
+                self._poller = asyncio.create_task(self._poll_loop())
+            self._wake.set()
+            return await future
+
+    async def _poll_loop(self):
+        delay = self.poll_initial
+        while self._pending:
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                # New submissions shouldn't be polled immediately; give them one initial interval
+                await asyncio.sleep(self.poll_initial)
+            except asyncio.TimeoutError:
+                pass
+            items = list(self._pending.items())
+            states = await asyncio.gather(
+                *(asyncio.to_thread(operation.done) for _, (operation, _, _) in items),
+                return_exceptions=True,
+            )
+            finished = 0
+            now = time.monotonic()
+            for (key, (operation, future, deadline)), state in zip(items, states):
+                if future.done():
+                    self._pending.pop(key, None)
+                    continue
+                if isinstance(state, Exception):
+                    future.set_exception(state)
+                elif state:
+                    try:
+                        response = operation.result()
+                        future.set_result(build_diarized_transcript(response.results))
+                    except Exception as e:
+                        future.set_exception(e)
+                elif now > deadline:
+                    future.set_exception(TimeoutError(f"Speech-to-Text operation exceeded {self.timeout}s"))
+                else:
+                    continue
+                self._pending.pop(key, None)
+                finished += 1
+            delay = self.poll_initial if finished else min(delay * 2, self.poll_max)
+
+
+async def transcribe_many(speech_client, gcs_uris: List[str], **kwargs) -> Dict[str, object]:
+    """Transcribes all URIs concurrently. Values are transcripts or the exception for that file."""
+    transcriber = AsyncTranscriber(speech_client, **kwargs)
+    results = await asyncio.gather(*(transcriber.transcribe(uri) for uri in gcs_uris), return_exceptions=True)
+    return dict(zip(gcs_uris, results))
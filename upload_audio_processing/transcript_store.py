@@ -0,0 +1,176 @@
+# transcript_store.py
+# Optional out-of-table storage for full transcripts. With TRANSCRIPT_STORE set, each transcript is written
+# compressed to the bucket (gs://...) or a local directory, keyed by its content hash, and the call table
+# keeps only transcript_uri, transcript_length and a short transcript_excerpt, so queries no longer scan
+# every transcript. Full text is fetched lazily, only for the rows an answer actually shows.
+import os
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from google.cloud import bigquery
+
+# --- CONFIGURATION ---
+TRANSCRIPT_STORE = os.getenv("TRANSCRIPT_STORE", "").rstrip("/")  # "gs://bucket/prefix" or a directory; "" = keep in table
+TRANSCRIPT_COMPRESSION = os.getenv("TRANSCRIPT_COMPRESSION", "gzip")  # "gzip" or "zstd" (needs `pip install zstandard`)
+TRANSCRIPT_EXCERPT_CHARS = int(os.getenv("TRANSCRIPT_EXCERPT_CHARS", "300"))
+TRANSCRIPT_HYDRATE_ROWS = int(os.getenv("TRANSCRIPT_HYDRATE_ROWS", "20"))  # full texts fetched per answer
+TRANSCRIPT_IO_CONCURRENCY = int(os.getenv("TRANSCRIPT_IO_CONCURRENCY", "16"))
+TRANSCRIPT_CACHE_ITEMS = 256
+
+SCHEMA_FIELDS = [
+    bigquery.SchemaField("transcript_uri", "STRING"),
+    bigquery.SchemaField("transcript_length", "INTEGER"),
+    bigquery.SchemaField("transcript_excerpt", "STRING"),
+]
+
+
+def enabled() -> bool:
+    return bool(TRANSCRIPT_STORE)
+
+
+def table_schema(schema: List[bigquery.SchemaField]) -> List[bigquery.SchemaField]:
+    """The call table schema, plus the pointer columns when transcripts are offloaded."""
+    return schema + SCHEMA_FIELDS if enabled() else schema
+
+
+def schema_update_options() -> List[str]:
+    # Lets the first offloaded load add the pointer columns to an existing table
+    return [bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION] if enabled() else []
+
+
+# --- CODEC ---
+def _compress(text: str) -> bytes:
+    data = text.encode("utf-8")
+    if TRANSCRIPT_COMPRESSION == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return gzip.compress(data, compresslevel=9)
+
+
+def _decompress(uri: str, data: bytes) -> str:
+    # The codec comes from the object name, so changing TRANSCRIPT_COMPRESSION never breaks older rows
+    if uri.endswith(".zst"):
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+    return gzip.decompress(data).decode("utf-8")
+
+
+# --- STORAGE ---
+_storage_client = None
+_client_lock = threading.Lock()
+
+
+def _client(storage_client=None):
+    global _storage_client
+    if storage_client is not None:
+        return storage_client
+    with _client_lock:
+        if _storage_client is None:
+            from google.cloud import storage
+            _storage_client = storage.Client()
+        return _storage_client
+
+
+def _split_gs(uri: str):
+    bucket, _, name = uri[len("gs://"):].partition("/")
+    return bucket, name
+
+
+def put(text: str, storage_client=None) -> str:
+    """Stores one transcript and returns its URI. Identical transcripts share one object."""
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    extension = "zst" if TRANSCRIPT_COMPRESSION == "zstd" else "gz"
+    uri = f"{TRANSCRIPT_STORE}/{digest[:2]}/{digest}.txt.{extension}"
+    if uri.startswith("gs://"):
+        bucket, name = _split_gs(uri)
+        blob = _client(storage_client).bucket(bucket).blob(name)
+        try:
+            # Content-addressed: an existing object already holds these exact bytes
+            blob.upload_from_string(_compress(text), content_type="application/octet-stream", if_generation_match=0)
+        except Exception as e:
+            if getattr(e, "code", None) != 412:
+                raise
+    elif not os.path.exists(uri):
+        os.makedirs(os.path.dirname(uri), exist_ok=True)
+        with open(uri + ".tmp", "wb") as f:
+            f.write(_compress(text))
+        os.replace(uri + ".tmp", uri)
+    return uri
+
+
+_cache: "OrderedDict[str, str]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def get(uri: str, storage_client=None) -> str:
+    with _cache_lock:
+        if uri in _cache:
+            _cache.move_to_end(uri)
+            return _cache[uri]
+    if uri.startswith("gs://"):
+        bucket, name = _split_gs(uri)
+        data = _client(storage_client).bucket(bucket).blob(name).download_as_bytes()
+    else:
+        with open(uri, "rb") as f:
+            data = f.read()
+    text = _decompress(uri, data)
+    with _cache_lock:
+        _cache[uri] = text
+        while len(_cache) > TRANSCRIPT_CACHE_ITEMS:
+            _cache.popitem(last=False)
+    return text
+
+
+# --- ROWS ---
+_pool = ThreadPoolExecutor(max_workers=TRANSCRIPT_IO_CONCURRENCY, thread_name_prefix="transcript-io")
+
+
+def offload_rows(storage_client, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Returns table rows with transcripts moved to the store (full_transcript NULL, pointer columns set).
+    A transcript that cannot be stored stays inline, so a store outage never loses data."""
+    if not enabled():
+        return rows
+
+    def offload(row: Dict[str, Any]) -> Dict[str, Any]:
+        text = row.get("full_transcript")
+        if not text:
+            return row
+        try:
+            uri = put(text, storage_client)
+        except Exception as e:
+            print(f"⚠️ Keeping transcript inline for customer {row.get('customer_id')}: {e}")
+            return row
+        return {**row, "full_transcript": None, "transcript_uri": uri, "transcript_length": len(text),
+                "transcript_excerpt": text[:TRANSCRIPT_EXCERPT_CHARS]}
+
+    return list(_pool.map(offload, rows))
+
+
+def hydrate(rows: List[Dict[str, Any]], limit: Optional[int] = TRANSCRIPT_HYDRATE_ROWS,
+            storage_client=None) -> List[Dict[str, Any]]:
+    """Fills full_transcript from the store for the first `limit` rows that point to one (None: all rows).
+    Rows beyond the limit, or whose fetch fails, keep their excerpt."""
+    wanted = [row for row in rows if row.get("transcript_uri") and not row.get("full_transcript")]
+    wanted = wanted if limit is None else wanted[:limit]
+
+    def fill(row: Dict[str, Any]):
+        try:
+            row["full_transcript"] = get(row["transcript_uri"], storage_client)
+        except Exception as e:
+            print(f"⚠️ Could not fetch {row['transcript_uri']}: {e}")
+
+    list(_pool.map(fill, wanted))
+    return rows
+
+
+def backfill_query(table_id: str, fields: tuple) -> tuple:
+    """SELECT for index backfills that need every transcript, offloaded ones included (pass each batch of
+    rows through `hydrate(rows, limit=None)`). Returns (sql, selected columns)."""
+    if not enabled():
+        return f"SELECT {', '.join(fields)} FROM `{table_id}` WHERE full_transcript IS NOT NULL", fields
+    columns = fields + ("transcript_uri",)
+    return (f"SELECT {', '.join(columns)} FROM `{table_id}` "
+            f"WHERE full_transcript IS NOT NULL OR transcript_uri IS NOT NULL"), columns
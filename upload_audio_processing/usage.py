@@ -0,0 +1,204 @@
+# usage.py
+# Token usage and cost accounting for every Gemini call, with optional per-run budgets.
+import os
+import json
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional
+from google.cloud import bigquery
+from metrics import REGISTRY, Counter
+
+# --- CONFIGURATION ---
+# USD per 1M tokens. Override with MODEL_PRICES_JSON='{"gemini-2.5-flash": {"text": 0.3, ...}}'
+MODEL_PRICES_PER_MILLION = {
+    "gemini-2.5-flash-lite": {"text": 0.10, "audio": 0.30, "output": 0.40},
+    "gemini-2.5-flash": {"text": 0.30, "audio": 1.00, "output": 2.50},
+    "gemini-2.5-pro": {"text": 1.25, "audio": 1.25, "output": 10.00},
+}
+MODEL_PRICES_PER_MILLION.update(json.loads(os.getenv("MODEL_PRICES_JSON", "{}")))
+RUN_TOKEN_BUDGET = int(os.getenv("RUN_TOKEN_BUDGET", "0"))  # 0 = unlimited
+RUN_COST_BUDGET_USD = float(os.getenv("RUN_COST_BUDGET_USD", "0"))  # 0 = unlimited
+
+TOKENS_USED = REGISTRY.register(Counter(
+    "model_tokens_total", "Gemini tokens consumed by call site and token kind.", ("call_site", "model", "kind")))
+COST_USD = REGISTRY.register(Counter(
+    "model_cost_usd_total", "Estimated Gemini spend in USD by call site.", ("call_site", "model")))
+
+USAGE_FIELDS = ["prompt_tokens", "audio_tokens", "text_tokens", "output_tokens", "total_tokens", "cost_usd"]
+
+_current_collector: contextvars.ContextVar[Optional[List[Dict[str, Any]]]] = contextvars.ContextVar(
+    "usage_collector", default=None
+)
+
+
+class BudgetExceeded(RuntimeError):
+    """Raised once the run has consumed more tokens or money than its configured budget."""
+
+
+def _modality_name(detail) -> str:
+    modality = getattr(detail, "modality", "")
+    return str(getattr(modality, "name", modality)).upper()
+
+
+def price_tokens(model_name: str, text_tokens: int, audio_tokens: int, output_tokens: int) -> float:
+    """USD cost of the given token counts at `model_name`'s prices."""
+    prices = MODEL_PRICES_PER_MILLION.get(model_name, {})
+    return (
+        text_tokens * prices.get("text", 0)
+        + audio_tokens * prices.get("audio", prices.get("text", 0))
+        + output_tokens * prices.get("output", 0)
+    ) / 1_000_000
+
+
+def extract_usage(response, model_name: str, call_site: str) -> Dict[str, Any]:
+    """Reads `usage_metadata` from a Gemini response and prices it."""
+    meta = getattr(response, "usage_metadata", None)
+    prompt_tokens = int(getattr(meta, "prompt_token_count", 0) or 0)
+    # Thinking tokens of 2.5 models are billed as output
+    output_tokens = int(getattr(meta, "candidates_token_count", 0) or 0) + int(getattr(meta, "thoughts_token_count", 0) or 0)
+    audio_tokens = sum(
+        int(getattr(detail, "token_count", 0) or 0)
+        for detail in (getattr(meta, "prompt_tokens_details", None) or [])
+        if "AUDIO" in _modality_name(detail)
+    )
+    text_tokens = max(prompt_tokens - audio_tokens, 0)
+    cost = price_tokens(model_name, text_tokens, audio_tokens, output_tokens)
+    return {
+        "call_site": call_site,
+        "model": model_name,
+        "prompt_tokens": prompt_tokens,
+        "audio_tokens": audio_tokens,
+        "text_tokens": text_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": prompt_tokens + output_tokens,
+        "cost_usd": round(cost, 8),
+    }
+
+
+class UsageLedger:
+    """Thread-safe running totals for one run (a batch job or the lifetime of a web app)."""
+
+    def __init__(self, token_budget: int = RUN_TOKEN_BUDGET, cost_budget_usd: float = RUN_COST_BUDGET_USD):
+        self.token_budget = token_budget
+        self.cost_budget_usd = cost_budget_usd
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.totals = {field: 0 for field in USAGE_FIELDS}
+        self.by_call_site: Dict[str, Dict[str, float]] = {}
+
+    @property
+    def budget_exceeded(self) -> bool:
+        return bool(
+            (self.token_budget and self.totals["total_tokens"] >= self.token_budget)
+            or (self.cost_budget_usd and self.totals["cost_usd"] >= self.cost_budget_usd)
+        )
+
+    def record(self, usage: Dict[str, Any]) -> Dict[str, Any]:
+        site = usage["call_site"]
+        with self.lock:
+            self.calls += 1
+            per_site = self.by_call_site.setdefault(site, {"calls": 0, **{field: 0 for field in USAGE_FIELDS}})
+            per_site["calls"] += 1
+            for field in USAGE_FIELDS:
+                self.totals[field] += usage[field]
+                per_site[field] += usage[field]
+        for kind in ("audio_tokens", "text_tokens", "output_tokens"):
+            TOKENS_USED.inc(usage[kind], call_site=site, model=usage["model"], kind=kind.replace("_tokens", ""))
+        COST_USD.inc(usage["cost_usd"], call_site=site, model=usage["model"])
+        collector = _current_collector.get()
+        if collector is not None:
+            collector.append(usage)
+        return usage
+
+    def check_budget(self):
+        if self.budget_exceeded:
+            raise BudgetExceeded(
+                f"Run budget exhausted: {self.totals['total_tokens']} tokens "
+                f"(budget {self.token_budget or '∞'}), ${self.totals['cost_usd']:.4f} "
+                f"(budget {self.cost_budget_usd or '∞'})"
+            )
+
+    def summary(self) -> Dict[str, Any]:
+        with self.lock:
+            totals = dict(self.totals)
+            totals["cost_usd"] = round(totals["cost_usd"], 6)
+            return {
+                "calls": self.calls,
+                "totals": totals,
+                "by_call_site": {k: dict(v, cost_usd=round(v["cost_usd"], 6)) for k, v in self.by_call_site.items()},
+                "token_budget": self.token_budget,
+                "cost_budget_usd": self.cost_budget_usd,
+                "budget_exceeded": self.budget_exceeded,
+            }
+
+
+ledger = UsageLedger()
+
+
+def record_response(response, model_name: str, call_site: str) -> Dict[str, Any]:
+    """Extracts, prices and records the usage of one response on the process-wide ledger."""
+    return ledger.record(extract_usage(response, model_name, call_site))
+
+
+@contextmanager
+def collect():
+    """Collects the usage of every call made inside the block, e.g. for one `/ask` request."""
+    calls: List[Dict[str, Any]] = []
+    token = _current_collector.set(calls)
+    try:
+        yield calls
+    finally:
+        _current_collector.reset(token)
+
+
+def combine(calls: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Sums a list of per-call usage dicts into a single usage dict."""
+    combined = {field: 0 for field in USAGE_FIELDS}
+    for usage in calls:
+        for field in USAGE_FIELDS:
+            combined[field] += usage[field]
+    combined["cost_usd"] = round(combined["cost_usd"], 8)
+    combined["calls"] = len(calls)
+    return combined
+
+
+# --- SIDE TABLE ---
+USAGE_TABLE_SCHEMA = [
+    bigquery.SchemaField("customer_id", "INTEGER"),
+    bigquery.SchemaField("source_uri", "STRING"),
+    bigquery.SchemaField("call_site", "STRING"),
+    bigquery.SchemaField("model", "STRING"),
+    bigquery.SchemaField("prompt_tokens", "INTEGER"),
+    bigquery.SchemaField("audio_tokens", "INTEGER"),
+    bigquery.SchemaField("text_tokens", "INTEGER"),
+    bigquery.SchemaField("output_tokens", "INTEGER"),
+    bigquery.SchemaField("total_tokens", "INTEGER"),
+    bigquery.SchemaField("cost_usd", "FLOAT"),
+    bigquery.SchemaField("recorded_at", "TIMESTAMP"),
+]
+
+
+def usage_row(usage: Dict[str, Any], customer_id: int, source_uri: str = "") -> Dict[str, Any]:
+    row = {field: usage.get(field, 0) for field in USAGE_FIELDS}
+    row.update({
+        "customer_id": customer_id,
+        "source_uri": source_uri,
+        "call_site": usage.get("call_site", ""),
+        "model": usage.get("model", ""),
+        "recorded_at": datetime.now(timezone.utc).isoformat(),
+    })
+    return row
+
+
+def insert_usage_rows(bigquery_client, table_id: str, rows: List[Dict[str, Any]]):
+    """Loads per-file usage rows into the token usage side table."""
+    if not rows:
+        return
+    try:
+        job_config = bigquery.LoadJobConfig(schema=USAGE_TABLE_SCHEMA)
+        job = bigquery_client.load_table_from_json(rows, table_id, job_config=job_config)
+        job.result()
+    except Exception as e:
+        print(f"⚠️ Failed to record token usage in {table_id}: {e}")